@@ -0,0 +1,251 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+
+import arviz as az
+import numpy as np
+import polars as pl
+
+from design import Encoding
+from fit import ENCODING_FILE, MODEL_NAMES, fit_all, fit_seconds
+from survey import group_codes
+
+
+APPROX_METHODS = ("advi", "fullrank_advi", "pathfinder")
+
+# weighted quantiles of the predicted percent ranks compared by the benchmark
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def _clean(model, idata: az.InferenceData) -> az.InferenceData:
+    # likelihood parameters (mu, p) are per-observation deterministics that
+    # the NUTS path never stores; drop them, then let bambi apply the same
+    # post-processing as after pm.sample (offsets dropped, dims ordered,
+    # intercept un-centered). _clean_results is private to bambi: checked
+    # against the pinned 0.17.x (requirements.txt)
+    backend = model.backend
+    clean = getattr(backend, "_clean_results", None)
+    if clean is None:
+        raise RuntimeError(
+            "this bambi has no PyMCModel._clean_results; fit_approx needs bambi 0.17.x"
+        )
+    deterministic = {v.name for v in backend.model.deterministics}
+    drop = [v for v in backend.spec.family.likelihood.params
+            if v in deterministic and v in idata.posterior]
+    idata.posterior = idata.posterior.drop_vars(drop)
+    return clean(idata, omit_offsets=True, include_response_params=False)
+
+
+def fit_approx(
+    model,
+    method: str = "advi",
+    *,
+    draws: int = 1000,
+    n: int = 30_000,
+    random_seed: Optional[int] = None,
+    **kwargs,
+) -> az.InferenceData:
+    """
+    Fit a bambi model with a fast approximation instead of NUTS and return
+    an InferenceData shaped like model.fit()'s, so predict_allmodels (either
+    engine), posterior_store.export_store and az.summary take it unchanged.
+
+    method:
+      - "advi" / "fullrank_advi": pm.fit for `n` iterations, then `draws`
+        samples from the fitted approximation (one chain)
+      - "pathfinder": pymc_extras' multi-path Pathfinder (optional
+        dependency), `draws` samples
+
+    kwargs go to pm.fit (ADVI) or pymc_extras.fit (Pathfinder).
+
+    Notes:
+      - bambi's own inference_method="laplace" is not offered: it fails on
+        models with vector-valued terms, and its MAP collapses the group
+        sigmas of these hierarchical models anyway.
+      - Approximate posteriors understate uncertainty (mean-field ADVI in
+        particular); use them to iterate on formulas and priors, then refit
+        with NUTS. benchmark_approx measures the gap on the quantities the
+        post-stratification actually reports.
+    """
+    if method not in APPROX_METHODS:
+        raise ValueError(f"method must be one of {APPROX_METHODS}")
+
+    if method == "pathfinder":
+        try:
+            import pymc_extras as pmx
+        except ImportError as exc:
+            raise ImportError("method='pathfinder' needs pymc-extras (pip install pymc-extras)") from exc
+        model.build()
+        idata = pmx.fit(
+            method="pathfinder",
+            model=model.backend.model,
+            num_draws=draws,
+            random_seed=random_seed,
+            progressbar=kwargs.pop("progressbar", False),
+            **kwargs,
+        )
+        return _clean(model, idata)
+
+    kwargs.setdefault("progressbar", False)
+    approx = model.fit(inference_method="vi", method=method, n=n, random_seed=random_seed, **kwargs)
+    idata = approx.sample(draws, random_seed=random_seed, return_inferencedata=True)
+    return _clean(model, idata)
+
+
+def fit_models_approx(
+    sipp_model: pl.DataFrame,
+    method: str = "advi",
+    *,
+    encoding: Optional[Encoding] = None,
+    models: Sequence[str] = MODEL_NAMES,
+    draws: int = 1000,
+    random_seed: Optional[int] = None,
+    **kwargs,
+) -> Dict[str, Tuple[object, az.InferenceData, float]]:
+    """
+    The create_models specifications fitted with fit_approx, in-process.
+
+    Returns {name: (model, idata, seconds)}; the idata slot in
+    predict_allmodels takes the idata as is.
+    """
+    from models import create_models
+
+    built = dict(zip(MODEL_NAMES, create_models(sipp_model, encoding)))
+    out = {}
+    for name in models:
+        seed = None if random_seed is None else int(
+            np.random.SeedSequence(random_seed, spawn_key=(MODEL_NAMES.index(name),)).generate_state(1)[0]
+        )
+        start = time.perf_counter()
+        idata = fit_approx(built[name], method, draws=draws, random_seed=seed, **kwargs)
+        out[name] = (built[name], idata, time.perf_counter() - start)
+    return out
+
+
+def _weighted_quantiles(x: np.ndarray, w: np.ndarray, qs: np.ndarray) -> np.ndarray:
+    # smallest value whose weighted CDF reaches q (survey's qrule="math")
+    if x.size == 0:
+        return np.full(len(qs), np.nan)
+    order = np.argsort(x, kind="stable")
+    cum = np.cumsum(w[order])
+    idx = np.searchsorted(cum, qs * cum[-1] * (1 - 1e-12))
+    return x[order][np.minimum(idx, x.size - 1)]
+
+
+def poststrat_quantiles(
+    draws,
+    by: Sequence[str] = (),
+    *,
+    weight: Optional[str] = "WGT",
+    quantiles: Sequence[float] = QUANTILES,
+) -> pl.DataFrame:
+    """
+    Weighted quantiles of the predicted asset/debt percent ranks among
+    holders, per group of `by`, averaged over the draw blocks of a
+    draws.PredictionDraws (predict_allmodels(..., compact=True)).
+
+    Long output: by..., measure ("asset_rank" / "debt_rank"), quantile, value.
+    """
+    qs = np.asarray(quantiles, dtype=np.float64)
+    codes, keys = group_codes(draws.covariates, by)
+    G = int(codes.max()) + 1 if codes.size else 0
+    w = (np.ones(draws.n_rows) if weight is None
+         else draws.covariates[weight].cast(pl.Float64).to_numpy())
+
+    frames = []
+    for measure, flag, pred in (("asset_rank", draws.any_asset, draws.asset_pred),
+                                ("debt_rank", draws.any_debt, draws.debt_pred)):
+        est = np.zeros((G, len(qs)))
+        for k in range(draws.ndraw):
+            held = flag[k] == 1
+            for g in range(G):
+                rows = held & (codes == g)
+                est[g] += _weighted_quantiles(pred[k][rows].astype(np.float64), w[rows], qs)
+        est /= draws.ndraw
+        out = pl.DataFrame({
+            "_g": np.repeat(np.arange(G), len(qs)),
+            "measure": measure,
+            "quantile": np.tile(qs, G),
+            "value": est.ravel(),
+        })
+        if by:
+            out = out.join(keys.with_row_index("_g").with_columns(pl.col("_g").cast(pl.Int64)), on="_g")
+        frames.append(out.drop("_g"))
+    out = pl.concat(frames)
+    return out.select([*by, "measure", "quantile", "value"])
+
+
+def _predict_compact(pop: pl.DataFrame, fitted: Mapping[str, Tuple[object, az.InferenceData]],
+                     ndraw: int, seed: Optional[int]):
+    from predict import predict_allmodels
+
+    return predict_allmodels(
+        pop,
+        asset_class_model=fitted["any_asset"][0], asset_class_idata=fitted["any_asset"][1],
+        asset_model=fitted["pr_asset"][0], asset_idata=fitted["pr_asset"][1],
+        debt_class_model=fitted["any_debt"][0], debt_class_idata=fitted["any_debt"][1],
+        debt_model=fitted["pr_debt"][0], debt_idata=fitted["pr_debt"][1],
+        ndraw=ndraw, seed=seed, engine="native", compact=True,
+    )
+
+
+def benchmark_approx(
+    sipp_model: pl.DataFrame,
+    pop: pl.DataFrame,
+    *,
+    nuts_dir: str,
+    methods: Sequence[str] = ("advi",),
+    by: Sequence[str] = (),
+    weight: Optional[str] = "WGT",
+    quantiles: Sequence[float] = QUANTILES,
+    ndraw: int = 20,
+    draws: int = 1000,
+    seed: int = 0,
+    nuts_kwargs: Optional[Mapping] = None,
+    approx_kwargs: Optional[Mapping] = None,
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Time the fast approximations against NUTS and compare what the
+    post-stratification reports.
+
+    NUTS comes from fit.fit_all(sipp_model, nuts_dir, **nuts_kwargs), so an
+    existing checkpoint directory is reused (and its recorded fit times
+    reported) instead of refitting for days. `seed` only drives the
+    approximations and the prediction draws; pass
+    nuts_kwargs={"random_seed": ...} for a seeded NUTS run (the checkpoints
+    must then have been fitted with that seed to be reused). Every fit is then
+    post-stratified over `pop` (the ACS frame for the metro PUMAs, with the
+    `weight` column) with ndraw native prediction draws from the same seed.
+
+    Returns (timings, quantiles):
+      timings:   method, model, seconds (NUTS: per-model sampling wall-clock)
+      quantiles: by..., measure, quantile, nuts, <method>, <method>_diff
+                 (approximation minus NUTS, in percent-rank units)
+    """
+    from models import create_models
+
+    nuts_idata = fit_all(sipp_model, nuts_dir, **dict(nuts_kwargs or {}))
+    encoding = Encoding.load(os.path.join(nuts_dir, ENCODING_FILE))
+    built = dict(zip(MODEL_NAMES, create_models(sipp_model, encoding)))
+    nuts = {name: (built[name], nuts_idata[name]) for name in MODEL_NAMES}
+
+    timings = [("nuts", name, fit_seconds(nuts_dir, name)) for name in MODEL_NAMES]
+    keys = [*by, "measure", "quantile"]
+    table = (poststrat_quantiles(_predict_compact(pop, nuts, ndraw, seed), by,
+                                 weight=weight, quantiles=quantiles)
+             .rename({"value": "nuts"}))
+
+    for method in methods:
+        fitted = fit_models_approx(sipp_model, method, encoding=encoding, draws=draws,
+                                   random_seed=seed, **dict(approx_kwargs or {}))
+        timings += [(method, name, fitted[name][2]) for name in MODEL_NAMES]
+        q = poststrat_quantiles(_predict_compact(pop, fitted, ndraw, seed), by,
+                                weight=weight, quantiles=quantiles)
+        table = (table
+                 .join(q.rename({"value": method}), on=keys, how="left")
+                 .with_columns((pl.col(method) - pl.col("nuts")).alias(f"{method}_diff")))
+
+    return (pl.DataFrame(timings, schema=["method", "model", "seconds"], orient="row"),
+            table.sort(keys))
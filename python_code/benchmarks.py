@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from fit import MODEL_NAMES, checkpoint_path
+from instrument import StageTotals
+
+
+# factor sizes of the synthetic frames, close to the SIPP/ACS covariates
+# (51 states, 14 income brackets, ...), so group tables and the race_eth
+# interactions have realistic widths
+FACTOR_LEVELS = {
+    "state": 51,
+    "hh_income": 14,
+    "age": 7,
+    "race_eth": 5,
+    "edu": 5,
+    "tenure": 3,
+    "household_type": 4,
+    "class_worker": 6,
+    "homevalue": 12,
+}
+
+BINARY_COLUMNS = (
+    "male", "metro", "disability", "public_assistance", "social_security",
+    "poverty", "citizen", "english_at_home",
+)
+
+# default grid: population rows x chunk_size x ndraw x posterior samples
+POP_SIZES = (10_000, 100_000, 500_000, 2_000_000)
+CHUNK_SIZES = (50_000, 200_000)
+NDRAWS = (1, 10)
+SAMPLES = (1000, 4000)
+
+# model.predict per chunk is far slower; larger populations are skipped for it
+BAMBI_MAX_ROWS = 100_000
+
+# a case is a regression when it is this much slower or bigger than baseline
+TOLERANCE = 0.2
+
+TRAIN_FILE = "train.parquet"
+
+
+def _covariates(n_rows: int, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    # factors as integer codes here; _labelled turns them into string levels
+    cols = {name: rng.integers(0, k, n_rows) for name, k in FACTOR_LEVELS.items()}
+    cols.update({name: rng.integers(0, 2, n_rows).astype(np.float64) for name in BINARY_COLUMNS})
+    return cols
+
+
+def _labelled(cols: Dict[str, np.ndarray]) -> pl.DataFrame:
+    return pl.DataFrame(cols).with_columns(
+        (pl.lit(f"{name}_") + pl.col(name).cast(pl.String)).alias(name) for name in FACTOR_LEVELS
+    )
+
+
+def synthetic_sipp(n_rows: int = 2_000, *, seed: int = 0) -> pl.DataFrame:
+    """
+    A model frame with every create_models column: the factors of
+    FACTOR_LEVELS (string levels), the 0/1 covariates, and outcomes
+    hh_any_asset, hh_any_debt, prank_assets, prank_debts driven by state,
+    income and a few binaries, so the fitted group effects are not all zero.
+    """
+    rng = np.random.default_rng(seed)
+    cols = _covariates(n_rows, rng)
+    eta = (rng.normal(0, 0.5, FACTOR_LEVELS["state"])[cols["state"]]
+           + 0.15 * cols["hh_income"] - 1.0
+           + 0.8 * cols["citizen"] - 0.6 * cols["poverty"])
+    p = 1 / (1 + np.exp(-eta))
+    cols["hh_any_asset"] = (rng.random(n_rows) < p).astype(np.float64)
+    cols["hh_any_debt"] = (rng.random(n_rows) < 0.6).astype(np.float64)
+    cols["prank_assets"] = rng.beta(8 * p + 0.5, 8 * (1 - p) + 0.5)
+    cols["prank_debts"] = rng.beta(2, 2, n_rows)
+    return _labelled(cols)
+
+
+def synthetic_population(n_rows: int, *, seed: int = 0, n_pumas: int = 20) -> pl.DataFrame:
+    """An ACS-like prediction frame: the model covariates plus WGT and PUMA."""
+    rng = np.random.default_rng(seed)
+    cols = _covariates(n_rows, rng)
+    cols["WGT"] = rng.integers(1, 60, n_rows)
+    cols["PUMA"] = rng.integers(1, n_pumas + 1, n_rows)
+    return _labelled(cols)
+
+
+def build_models(
+    work_dir: str,
+    *,
+    n_rows: int = 2_000,
+    samples: int = max(SAMPLES),
+    seed: int = 0,
+    n: int = 3_000,
+    overwrite: bool = False,
+) -> str:
+    """
+    Fit the create_models models on synthetic_sipp(n_rows) with ADVI
+    (approx.fit_approx, `n` iterations) and checkpoint them to work_dir as
+    fit.fit_all does (<name>_model.nc, encoding.json), with the training
+    frame in train.parquet. Existing checkpoints are reused.
+
+    The fit only has to produce posteriors of the right shape: prediction
+    cost depends on the formulas, the number of levels and the number of
+    posterior samples, not on how well the models fit.
+    """
+    import arviz as az
+
+    from approx import fit_models_approx
+    from design import Encoding
+    from fit import ENCODING_FILE
+
+    done = all(os.path.exists(checkpoint_path(work_dir, name)) for name in MODEL_NAMES)
+    if done and not overwrite:
+        return work_dir
+    os.makedirs(work_dir, exist_ok=True)
+
+    train = synthetic_sipp(n_rows, seed=seed)
+    encoding = Encoding.fit(train)
+    fitted = fit_models_approx(train, "advi", encoding=encoding, draws=samples, random_seed=seed, n=n)
+    for name, (_, idata, _) in fitted.items():
+        az.to_netcdf(idata, checkpoint_path(work_dir, name))
+    encoding.save(os.path.join(work_dir, ENCODING_FILE))
+    train.write_parquet(os.path.join(work_dir, TRAIN_FILE))
+    return work_dir
+
+
+@dataclass(frozen=True)
+class Case:
+    """One benchmark configuration of predict_allmodels."""
+
+    engine: str
+    n_rows: int
+    chunk_size: int
+    ndraw: int
+    samples: int
+    workers: int = 1
+    compact: bool = False
+    hurdle: bool = False
+
+    @property
+    def key(self) -> str:
+        key = (f"{self.engine}/rows={self.n_rows}/chunk={self.chunk_size}/ndraw={self.ndraw}"
+               f"/samples={self.samples}/workers={self.workers}/compact={int(self.compact)}")
+        # only when set, so keys of baselines saved before the option still match
+        return f"{key}/hurdle=1" if self.hurdle else key
+
+
+def benchmark_cases(
+    sizes: Sequence[int] = POP_SIZES,
+    chunk_sizes: Sequence[int] = CHUNK_SIZES,
+    ndraws: Sequence[int] = NDRAWS,
+    samples: Sequence[int] = SAMPLES,
+    *,
+    engines: Sequence[str] = ("native",),
+    workers: Sequence[int] = (1,),
+    compact: bool = False,
+    hurdle: Sequence[bool] = (False,),
+    bambi_max_rows: int = BAMBI_MAX_ROWS,
+) -> List[Case]:
+    """
+    The full grid, minus combinations that measure nothing: bambi above
+    bambi_max_rows rows or with workers > 1, and chunk sizes beyond the
+    population (identical to a single chunk).
+    """
+    cases = []
+    for engine in engines:
+        for n_rows in sizes:
+            if engine == "bambi" and n_rows > bambi_max_rows:
+                continue
+            chunks = sorted({min(c, n_rows) for c in chunk_sizes})
+            for chunk in chunks:
+                for ndraw in ndraws:
+                    for s in samples:
+                        for w in workers:
+                            if engine == "bambi" and w != 1:
+                                continue
+                            cases += [Case(engine, n_rows, chunk, ndraw, s, w, compact, h) for h in hurdle]
+    return cases
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS; children covers native workers
+    scale = 1 / 1024 ** 2 if sys.platform == "darwin" else 1 / 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def _load_models(work_dir: str, samples: int) -> dict:
+    import arviz as az
+
+    from design import Encoding
+    from fit import ENCODING_FILE
+    from models import create_models
+
+    train = pl.read_parquet(os.path.join(work_dir, TRAIN_FILE))
+    encoding = Encoding.load(os.path.join(work_dir, ENCODING_FILE))
+    built = dict(zip(MODEL_NAMES, create_models(train, encoding)))
+    slots = {}
+    for name, prefix in (("any_asset", "asset_class"), ("pr_asset", "asset"),
+                         ("any_debt", "debt_class"), ("pr_debt", "debt")):
+        idata = az.from_netcdf(checkpoint_path(work_dir, name))
+        available = idata.posterior.sizes["draw"]
+        if samples > available:
+            raise ValueError(f"{name}: {samples} samples asked, {available} fitted (rebuild with more)")
+        slots[f"{prefix}_model"] = built[name]
+        slots[f"{prefix}_idata"] = idata.isel(draw=slice(0, samples))
+    return slots
+
+
+def _run_case(work_dir: str, case: Case, seed: int) -> dict:
+    # runs in a fresh process, so ru_maxrss is this case's own peak
+    import logging
+    import warnings
+
+    from predict import predict_allmodels
+
+    warnings.filterwarnings("ignore")
+    logging.getLogger("pymc").setLevel(logging.ERROR)
+
+    stages = {}
+    start = time.perf_counter()
+    slots = _load_models(work_dir, case.samples)
+    stages["load_models"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pop = synthetic_population(case.n_rows, seed=seed)
+    stages["population"] = time.perf_counter() - start
+    setup_rss = _peak_rss_mb()
+
+    totals = StageTotals()
+    start = time.perf_counter()
+    out = predict_allmodels(
+        pop, **slots, ndraw=case.ndraw, seed=seed, chunk_size=case.chunk_size,
+        engine=case.engine, workers=case.workers, compact=case.compact, hurdle=case.hurdle,
+        observer=totals,
+    )
+    seconds = time.perf_counter() - start
+    del out
+    stages.update(totals.seconds)
+
+    predicted = case.n_rows * case.ndraw
+    return {
+        **asdict(case),
+        "key": case.key,
+        "seconds": seconds,
+        "rows_per_s": predicted / seconds,
+        "peak_rss_mb": _peak_rss_mb(),
+        "setup_rss_mb": setup_rss,
+        "stages": stages,
+    }
+
+
+def run_benchmarks(
+    cases: Sequence[Case],
+    work_dir: str,
+    *,
+    seed: int = 0,
+    log=print,
+) -> List[dict]:
+    """
+    Time predict_allmodels for every case, each in its own spawned process.
+
+    Per case: predict wall-clock, rows/s (rows x ndraw predicted per
+    second), peak RSS of the process (and of its workers) and the time of
+    each stage: load_models, population, and the instrument.Tracer stages
+    of predict_allmodels summed by name (predict_allmodels itself, draw,
+    sample, assemble, ...).
+    setup_rss_mb is the peak before prediction starts, so peak_rss_mb -
+    setup_rss_mb is what prediction itself added.
+    """
+    build_models(work_dir, samples=max(c.samples for c in cases), seed=seed)
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            res = pool.submit(_run_case, work_dir, case, seed).result()
+        if log is not None:
+            log(f"{case.key}: {res['rows_per_s']:,.0f} rows/s, {res['seconds']:.2f} s, "
+                f"peak {res['peak_rss_mb']:,.0f} MB")
+        results.append(res)
+    return results
+
+
+def _environment() -> dict:
+    import numpy
+    import polars
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy.__version__,
+        "polars": polars.__version__,
+    }
+
+
+def save_results(results: Sequence[dict], path: str) -> str:
+    """Write results (e.g. a baseline) as JSON with the environment they ran in."""
+    with open(path, "w") as f:
+        json.dump({"environment": _environment(), "results": list(results)}, f, indent=1)
+    return path
+
+
+def load_results(path: str) -> List[dict]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(
+    results: Sequence[dict],
+    baseline: Sequence[dict],
+    *,
+    tolerance: float = TOLERANCE,
+) -> pl.DataFrame:
+    """
+    Cases present in both runs, side by side:
+
+      key, rows_per_s, base_rows_per_s, speed_ratio,
+      peak_rss_mb, base_peak_rss_mb, rss_ratio, regression
+
+    regression: speed fell by more than `tolerance` (speed_ratio < 1 -
+    tolerance) or peak RSS grew by more than it (rss_ratio > 1 + tolerance).
+    """
+    cols = ["key", "rows_per_s", "peak_rss_mb"]
+    now = pl.DataFrame([{c: r[c] for c in cols} for r in results])
+    base = pl.DataFrame([{c: r[c] for c in cols} for r in baseline]).rename(
+        {"rows_per_s": "base_rows_per_s", "peak_rss_mb": "base_peak_rss_mb"})
+    return (now
+            .join(base, on="key", how="inner")
+            .with_columns(
+                (pl.col("rows_per_s") / pl.col("base_rows_per_s")).alias("speed_ratio"),
+                (pl.col("peak_rss_mb") / pl.col("base_peak_rss_mb")).alias("rss_ratio"))
+            .with_columns(
+                ((pl.col("speed_ratio") < 1 - tolerance) | (pl.col("rss_ratio") > 1 + tolerance))
+                .alias("regression"))
+            .select("key", "rows_per_s", "base_rows_per_s", "speed_ratio",
+                    "peak_rss_mb", "base_peak_rss_mb", "rss_ratio", "regression"))
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark predict_allmodels on synthetic models.")
+    parser.add_argument("--work-dir", default="benchmark_models",
+                        help="synthetic model checkpoints (fitted once, then reused)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(POP_SIZES))
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=list(CHUNK_SIZES))
+    parser.add_argument("--ndraws", type=int, nargs="+", default=list(NDRAWS))
+    parser.add_argument("--samples", type=int, nargs="+", default=list(SAMPLES))
+    parser.add_argument("--engines", nargs="+", default=["native"], choices=["native", "bambi"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1])
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--hurdle", action="store_true", help="also run every case with hurdle=True")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="also write the results to --baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    cases = benchmark_cases(args.sizes, args.chunk_sizes, args.ndraws, args.samples,
+                            engines=args.engines, workers=args.workers, compact=args.compact,
+                            hurdle=(False, True) if args.hurdle else (False,))
+    results = run_benchmarks(cases, args.work_dir, seed=args.seed)
+    save_results(results, args.out)
+
+    if args.baseline and args.save_baseline:
+        save_results(results, args.baseline)
+    elif args.baseline:
+        table = compare(results, load_results(args.baseline), tolerance=args.tolerance)
+        with pl.Config(tbl_rows=-1, tbl_width_chars=200, fmt_str_lengths=80):
+            print(table)
+        if table["regression"].any():
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import numpy as np
+import polars as pl
+
+
+# lookup grid resolution: rank steps of 1/4096, far finer than the few
+# hundred distinct SIPP dollar values the curve is fitted on
+GRID_SIZE = 4097
+
+
+def weighted_prank(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    The cleaning notebook's SIPP rank: sorted by value, the weight of the
+    rows before each row over (total weight - 1),
+
+      prank = lag(cumsum(WPFINWGT), default = 0) / (sum(WPFINWGT) - 1)
+
+    Tied values keep their row order (a stable sort, like arrange). NaN
+    values get NaN and do not count towards the total.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    out = np.full(values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(values))
+    order = valid[np.argsort(values[valid], kind="stable")]
+    w = weights[order]
+    out[order] = (np.cumsum(w) - w) / (w.sum() - 1)
+    return out
+
+
+def weighted_percent_rank(values: np.ndarray, weights: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    dplyr::percent_rank with frequency weights, in O(N log N):
+
+      (weight of strictly smaller values) / (total weight - 1)
+
+    With integer weights this is percent_rank of the frame expanded by
+    uncount(weight), without expanding it. Ties share the lowest rank and
+    NaN stays NaN. A 2-D (draws, N) array is ranked row by row, so each
+    draw block is ranked on its own.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 2:
+        return np.stack([weighted_percent_rank(row, weights) for row in values])
+
+    w = np.ones(values.shape) if weights is None else np.asarray(weights, dtype=np.float64)
+    out = np.full(values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(values))
+    if valid.size == 0:
+        return out
+    order = valid[np.argsort(values[valid], kind="stable")]
+    sorted_values = values[order]
+    below = np.concatenate([[0.0], np.cumsum(w[order])])
+    first = np.searchsorted(sorted_values, sorted_values, side="left")
+    total = below[-1]
+    out[order] = below[first] / (total - 1) if total > 1 else 0.0
+    return out
+
+
+def loess(
+    x: np.ndarray,
+    y: np.ndarray,
+    at: np.ndarray,
+    *,
+    span: float = 0.75,
+    degree: int = 2,
+    block_size: int = 512,
+) -> np.ndarray:
+    """
+    R's loess(y ~ x, span, degree) evaluated exactly at `at` (surface =
+    "direct"): a tricube-weighted local polynomial over the
+    floor(n * span) nearest x.
+
+    Cost is O(len(at) * n), so evaluate it on a grid, not on every row.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    at = np.asarray(at, dtype=np.float64)
+    n = x.size
+    q = min(n, max(degree + 1, int(np.floor(n * span))))
+    powers = np.arange(2 * degree + 1)
+
+    out = np.empty(at.size)
+    for lo in range(0, at.size, block_size):
+        x0 = at[lo:lo + block_size, None]
+        d = x[None, :] - x0
+        dist = np.abs(d)
+        h = np.partition(dist, q - 1, axis=1)[:, q - 1:q]
+        if span > 1:
+            h = h * span
+        h = np.maximum(h, 1e-12)
+        w = np.clip(1 - (dist / h) ** 3, 0, None) ** 3
+
+        # centred at x0, so the fitted value is the intercept
+        mom = np.einsum("gn,gnp->gp", w, d[:, :, None] ** powers)
+        rhs = np.einsum("gn,gnp->gp", w * y[None, :], d[:, :, None] ** powers[:degree + 1])
+        idx = np.arange(degree + 1)
+        A = mom[:, idx[:, None] + idx[None, :]]
+        out[lo:lo + block_size] = np.linalg.solve(A, rhs[..., None])[:, 0, 0]
+    return out
+
+
+@dataclass
+class RankCrosswalk:
+    """
+    Percent rank -> dollars, precomputed once on a dense grid.
+
+    fit() smooths dollars against the weighted SIPP rank with loess (the
+    03b_poststrat crosswalk) and stores the curve at GRID_SIZE evenly spaced
+    ranks, forced non-decreasing; mapping is then one np.interp over any
+    number of ranks.
+
+    Notes:
+      - Ranks outside the fitted range take the curve's end values, where
+        R's predict.loess returned NA.
+      - The monotone envelope (running max) only removes loess wiggles
+        that would make a higher rank worth fewer dollars.
+    """
+
+    grid: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def fit(
+        cls,
+        ranks: np.ndarray,
+        dollars: np.ndarray,
+        *,
+        span: float = 0.1,
+        degree: int = 2,
+        grid_size: int = GRID_SIZE,
+    ) -> "RankCrosswalk":
+        ranks = np.asarray(ranks, dtype=np.float64)
+        dollars = np.asarray(dollars, dtype=np.float64)
+        keep = ~(np.isnan(ranks) | np.isnan(dollars))
+        ranks, dollars = ranks[keep], dollars[keep]
+
+        grid = np.linspace(ranks.min(), ranks.max(), grid_size)
+        values = np.maximum.accumulate(loess(ranks, dollars, grid, span=span, degree=degree))
+        return cls(grid=grid, values=values)
+
+    def __call__(self, ranks: np.ndarray) -> np.ndarray:
+        """Dollars for an array of ranks of any shape (NaN stays NaN)."""
+        ranks = np.asarray(ranks, dtype=np.float64)
+        return np.interp(ranks, self.grid, self.values)
+
+    def to_dict(self) -> dict:
+        return {"grid": self.grid.tolist(), "values": self.values.tolist()}
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "RankCrosswalk":
+        return cls(grid=np.asarray(raw["grid"]), values=np.asarray(raw["values"]))
+
+
+def fit_crosswalks(
+    sipp: pl.DataFrame,
+    *,
+    weight: str = "WPFINWGT",
+    span: float = 0.1,
+    grid_size: int = GRID_SIZE,
+) -> Dict[str, RankCrosswalk]:
+    """
+    The asset and debt crosswalks of 03b_poststrat from a SIPP frame (filter
+    it to the state first, as sipp_la was):
+
+      prank_* = weighted_prank over every row with a value
+      curve   = loess(hh_* ~ prank_*, span) over holders (hh_any_* == 1)
+
+    Returns {"asset": ..., "debt": ...}.
+    """
+    w = sipp[weight].cast(pl.Float64).to_numpy()
+    out = {}
+    for name, value, holder in (("asset", "hh_assets", "hh_any_asset"),
+                                ("debt", "hh_debts", "hh_any_debt")):
+        dollars = sipp[value].cast(pl.Float64).fill_null(np.nan).to_numpy()
+        ranks = weighted_prank(dollars, w)
+        held = (sipp[holder] == 1).fill_null(False).to_numpy()
+        out[name] = RankCrosswalk.fit(ranks[held], dollars[held], span=span, grid_size=grid_size)
+    return out
+
+
+def save_crosswalks(crosswalks: Dict[str, RankCrosswalk], path: str) -> str:
+    with open(path, "w") as f:
+        json.dump({name: cw.to_dict() for name, cw in crosswalks.items()}, f)
+    return path
+
+
+def load_crosswalks(path: str) -> Dict[str, RankCrosswalk]:
+    with open(path) as f:
+        return {name: RankCrosswalk.from_dict(raw) for name, raw in json.load(f).items()}
+
+
+def to_dollars(
+    draws,
+    crosswalks: Dict[str, RankCrosswalk],
+    *,
+    weight: Optional[str] = "WGT",
+) -> Dict[str, np.ndarray]:
+    """
+    Dollar values for every draw block of a draws.PredictionDraws, as
+    (ndraw, N) float64 arrays asset_rank, asset_dollars, debt_rank,
+    debt_dollars and networth.
+
+    Per block, following 03b_poststrat: holders are re-ranked with the
+    weighted percent rank (non-holders excluded, as the NA trick did),
+    ranks are mapped through the crosswalk, non-positive dollars become 1
+    and non-holders 0.
+    """
+    w = None if weight is None else draws.covariates[weight].cast(pl.Float64).to_numpy()
+    out: Dict[str, np.ndarray] = {}
+    for name, flag, pred in (("asset", draws.any_asset, draws.asset_pred),
+                             ("debt", draws.any_debt, draws.debt_pred)):
+        held = flag == 1
+        rank = weighted_percent_rank(np.where(held, pred, np.nan), w)
+        dollars = crosswalks[name](rank)
+        dollars = np.where(dollars <= 0, 1.0, dollars)
+        out[f"{name}_rank"] = rank
+        out[f"{name}_dollars"] = np.where(held, dollars, 0.0)
+    out["networth"] = out["asset_dollars"] - out["debt_dollars"]
+    return out
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+
+# covariates the models treat as factors (pandas category in the model frames)
+CATEGORICAL_COLUMNS = (
+    "state",
+    "hh_income",
+    "age",
+    "race_eth",
+    "edu",
+    "tenure",
+    "household_type",
+    "class_worker",
+    "homevalue",
+)
+
+# interaction columns of the rank models: name -> component factors
+INTERACTIONS = {
+    "race_eth_state": ("race_eth", "state"),
+    "race_eth_edu": ("race_eth", "edu"),
+    "race_eth_age": ("race_eth", "age"),
+    "race_eth_income": ("race_eth", "hh_income"),
+}
+
+
+def _codes(s: pl.Series, levels: Sequence) -> np.ndarray:
+    """Integer codes into `levels`; null or unseen -> -1."""
+    if len(levels) == 0:
+        return np.full(s.len(), -1, dtype=np.int32)
+    lv = pl.Series(levels)
+    return (s.cast(lv.dtype, strict=False)
+            .replace_strict(lv, np.arange(len(levels), dtype=np.int32), default=-1, return_dtype=pl.Int32)
+            .fill_null(-1)
+            .to_numpy())
+
+
+@dataclass
+class Encoding:
+    """
+    Level tables for the model covariates, shared by all four models.
+
+    Each factor column is dictionary-encoded once into int32 codes (sorted
+    levels, the order pandas' astype("category") used, so formulae keeps
+    the same reference levels). Interactions are integer codes too, built
+    from the component codes (a_code * n_b + b_code), and only combinations
+    seen at fit time get a level, labelled "a:b" as the notebook did and
+    ordered by label, as astype("category") ordered the strings.
+
+    save/load persist the tables as JSON next to the fitted models, so
+    prediction can rebuild a PosteriorEngine with exactly the training
+    encodings (PosteriorEngine.from_idata(..., levels=encoding.levels))
+    without the training frame.
+    """
+
+    levels: Dict[str, list] = field(default_factory=dict)
+    interactions: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    # observed combined codes per interaction, in label order; index = interaction code
+    combos: Dict[str, list] = field(default_factory=dict)
+
+    @classmethod
+    def fit(
+        cls,
+        data: pl.DataFrame,
+        columns: Sequence[str] = CATEGORICAL_COLUMNS,
+        interactions: Mapping[str, Tuple[str, ...]] = INTERACTIONS,
+    ) -> "Encoding":
+        enc = cls(interactions={k: tuple(v) for k, v in interactions.items()})
+        needed = list(dict.fromkeys([*columns, *(f for fs in interactions.values() for f in fs)]))
+        for col in needed:
+            if col in data.columns:
+                enc.levels[col] = data[col].drop_nulls().unique().sort().to_list()
+        codes = enc.codes(data, needed)
+        for name in interactions:
+            combined = enc._combined(codes, name)
+            observed = np.unique(combined[combined >= 0]).tolist()
+            # label order, as astype("category") sorted the "a:b" strings
+            enc.combos[name] = sorted(observed, key=lambda flat: enc._label(name, flat))
+        return enc
+
+    def _combined(self, codes: Mapping[str, np.ndarray], name: str) -> np.ndarray:
+        factors = self.interactions[name]
+        flat = np.zeros(len(codes[factors[0]]), dtype=np.int64)
+        missing = np.zeros(flat.shape, dtype=bool)
+        for f in factors:
+            c = codes[f]
+            missing |= c < 0
+            flat = flat * len(self.levels[f]) + c
+        flat[missing] = -1
+        return flat
+
+    def _label(self, name: str, flat: int) -> str:
+        factors = self.interactions[name]
+        parts = np.unravel_index(flat, [len(self.levels[f]) for f in factors])
+        return ":".join(str(self.levels[f][i]) for f, i in zip(factors, parts))
+
+    def interaction_labels(self, name: str) -> List[str]:
+        """"a:b" label per interaction code."""
+        return [self._label(name, flat) for flat in self.combos[name]]
+
+    def codes(self, data: pl.DataFrame, columns: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        int32 codes for factor and interaction columns (-1 = missing/unseen).
+        Interactions are derived from their factors' codes, never from
+        string columns.
+        """
+        columns = list(self.levels) + list(self.combos) if columns is None else list(columns)
+        out: Dict[str, np.ndarray] = {}
+        for col in columns:
+            if col in self.levels:
+                out[col] = _codes(data[col], self.levels[col])
+        for col in columns:
+            if col in self.interactions and col in self.combos:
+                parts = {f: out[f] if f in out else _codes(data[f], self.levels[f])
+                         for f in self.interactions[col]}
+                combined = self._combined(parts, col)
+                table = np.asarray(self.combos[col], dtype=np.int64)
+                if len(table) == 0:
+                    out[col] = np.full(len(combined), -1, dtype=np.int32)
+                    continue
+                order = np.argsort(table, kind="stable")
+                pos = np.minimum(np.searchsorted(table[order], combined), len(table) - 1)
+                hit = (combined >= 0) & (table[order][pos] == combined)
+                out[col] = np.where(hit, order[pos], -1).astype(np.int32)
+        return out
+
+    def frame(self, data: pl.DataFrame, columns: Sequence[str]) -> pd.DataFrame:
+        """
+        pandas frame for bambi: factor/interaction columns as Categoricals
+        built straight from the codes (no per-model astype), everything else
+        as plain NumPy columns (nulls -> NaN).
+        """
+        codes = self.codes(data, [c for c in columns if c in self.levels or c in self.combos])
+        cols = {}
+        for col in columns:
+            if col in codes:
+                cats = self.interaction_labels(col) if col in self.combos else self.levels[col]
+                cols[col] = pd.Categorical.from_codes(codes[col], categories=cats)
+            else:
+                cols[col] = data[col].to_numpy()
+        return pd.DataFrame(cols)
+
+    def save(self, path: str) -> str:
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "levels": self.levels,
+                    "interactions": {k: list(v) for k, v in self.interactions.items()},
+                    "combos": self.combos,
+                },
+                f,
+            )
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "Encoding":
+        with open(path) as f:
+            raw = json.load(f)
+        return cls(
+            levels=raw["levels"],
+            interactions={k: tuple(v) for k, v in raw["interactions"].items()},
+            combos=raw["combos"],
+        )
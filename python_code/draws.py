@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+from survey import group_codes
+
+
+PREDICTION_COLUMNS = ("any_asset", "asset_pred", "asset_draw", "any_debt", "debt_pred", "debt_draw")
+
+_DTYPES = {
+    "any_asset": np.int8,
+    "asset_pred": np.float32,
+    "asset_draw": np.int32,
+    "any_debt": np.int8,
+    "debt_pred": np.float32,
+    "debt_draw": np.int32,
+}
+
+_POLARS_DTYPES = {
+    "any_asset": pl.Int8,
+    "asset_pred": pl.Float32,
+    "asset_draw": pl.Int32,
+    "any_debt": pl.Int8,
+    "debt_pred": pl.Float32,
+    "debt_draw": pl.Int32,
+}
+
+SUMMARY_STATS = ("share_any_asset", "asset_rank_mean", "share_any_debt", "debt_rank_mean")
+
+
+@dataclass
+class PredictionDraws:
+    """
+    Draw-major result of predict_allmodels(compact=True).
+
+    The covariates are stored once (N rows, keyed by `row_id`); each of the
+    six prediction columns is a (ndraw, N) array:
+      any_asset / any_debt     int8
+      asset_pred / debt_pred   float32
+      asset_draw / debt_draw   int32
+
+    That is ~14 bytes per row per draw instead of a full copy of every
+    covariate per draw, which is what makes 100+ draws practical.
+    """
+
+    covariates: pl.DataFrame
+    any_asset: np.ndarray
+    asset_pred: np.ndarray
+    asset_draw: np.ndarray
+    any_debt: np.ndarray
+    debt_pred: np.ndarray
+    debt_draw: np.ndarray
+    row_id: str = "row_id"
+
+    @classmethod
+    def empty(cls, covariates: pl.DataFrame, ndraw: int, *, row_id: str = "row_id") -> "PredictionDraws":
+        """Preallocate arrays for `ndraw` blocks; adds a row id if missing."""
+        if row_id not in covariates.columns:
+            covariates = covariates.with_row_index(row_id)
+        N = covariates.height
+        arrays = {name: np.zeros((ndraw, N), dtype=dt) for name, dt in _DTYPES.items()}
+        return cls(covariates=covariates, row_id=row_id, **arrays)
+
+    @property
+    def ndraw(self) -> int:
+        return self.any_asset.shape[0]
+
+    @property
+    def n_rows(self) -> int:
+        return self.any_asset.shape[1]
+
+    def set_block(self, k: int, **columns: np.ndarray) -> None:
+        for name, values in columns.items():
+            getattr(self, name)[k] = values
+
+    def predictions(self, k: int) -> pl.DataFrame:
+        """row_id + the six prediction columns for draw block k (no covariates)."""
+        return pl.DataFrame(
+            [self.covariates[self.row_id]]
+            + [pl.Series(name, getattr(self, name)[k], dtype=_POLARS_DTYPES[name])
+               for name in PREDICTION_COLUMNS]
+        )
+
+    def block(self, k: int, columns: Optional[Sequence[str]] = None) -> pl.DataFrame:
+        """
+        Draw block k joined back to the covariates (all of them, or just
+        `columns`), i.e. what predict_allmodels returns for one block.
+        """
+        base = self.covariates if columns is None else self.covariates.select(
+            [self.row_id] + [c for c in columns if c != self.row_id]
+        )
+        return base.with_columns(
+            pl.Series(name, getattr(self, name)[k], dtype=_POLARS_DTYPES[name])
+            for name in PREDICTION_COLUMNS
+        )
+
+    def to_frame(
+        self,
+        draws: Optional[Sequence[int]] = None,
+        columns: Optional[Sequence[str]] = None,
+    ) -> pl.DataFrame:
+        """Long frame (one block per draw, with draw_block) for the selected draws."""
+        ks = range(self.ndraw) if draws is None else draws
+        return pl.concat(
+            [self.block(k, columns).with_columns(pl.lit(k).alias("draw_block").cast(pl.Int32))
+             for k in ks],
+            how="vertical",
+        )
+
+    def group_summary(
+        self,
+        by: Sequence[str] = (),
+        *,
+        weight: Optional[str] = None,
+        rows: Optional[np.ndarray] = None,
+    ) -> pl.DataFrame:
+        """
+        Per draw block and group of `by`, one segmented sum per block:
+
+          WGT              total weight (row count if weight is None)
+          share_any_asset  weighted share with any assets
+          asset_rank_mean  weighted mean asset_pred among asset holders
+          share_any_debt / debt_rank_mean  likewise for debts
+
+        rows: positions to aggregate (e.g. a region's members), default all.
+              Only one block's worth of them is gathered at a time, so the
+              (ndraw, N) arrays are never copied.
+        """
+        cov = self.covariates
+        if rows is not None:
+            cov = cov.select(list(dict.fromkeys([self.row_id, *by, *([weight] if weight else [])])))[rows]
+        codes, keys = group_codes(cov, by)
+        G = int(codes.max()) + 1 if codes.size else 0
+        K = self.ndraw
+        take = slice(None) if rows is None else rows
+
+        w = (np.ones(cov.height) if weight is None
+             else cov[weight].cast(pl.Float64).to_numpy())
+
+        def total(values: np.ndarray) -> np.ndarray:
+            return np.bincount(codes, weights=values * w, minlength=G)
+
+        wsum = np.bincount(codes, weights=w, minlength=G)
+        stats: Dict[str, np.ndarray] = {name: np.empty((K, G)) for name in SUMMARY_STATS}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for k in range(K):
+                any_asset, any_debt = self.any_asset[k, take], self.any_debt[k, take]
+                holders_a = total(any_asset.astype(np.float64))
+                holders_d = total(any_debt.astype(np.float64))
+                stats["share_any_asset"][k] = holders_a / wsum
+                stats["asset_rank_mean"][k] = total(self.asset_pred[k, take] * any_asset) / holders_a
+                stats["share_any_debt"][k] = holders_d / wsum
+                stats["debt_rank_mean"][k] = total(self.debt_pred[k, take] * any_debt) / holders_d
+
+        out = pl.DataFrame({
+            "draw_block": np.repeat(np.arange(K, dtype=np.int32), G),
+            "_g": np.tile(np.arange(G), K),
+            "WGT": np.tile(wsum, K),
+            **{name: v.ravel() for name, v in stats.items()},
+        })
+        if by:
+            out = out.join(keys.with_row_index("_g").with_columns(pl.col("_g").cast(pl.Int64)), on="_g")
+            out = out.select(list(by) + ["draw_block", "WGT", *SUMMARY_STATS])
+        else:
+            out = out.drop("_g")
+        return out
+
+    def group_intervals(
+        self,
+        by: Sequence[str] = (),
+        *,
+        weight: Optional[str] = None,
+        prob: float = 0.9,
+        rows: Optional[np.ndarray] = None,
+    ) -> pl.DataFrame:
+        """
+        Posterior mean and central `prob` interval across draws of each
+        group_summary stat (over `rows`, default all).
+
+        Notes:
+          - A rank mean is NaN in draws where the group has no holders; those
+            draws are left out of its mean and interval alike (all three are
+            null when no draw has a holder).
+        """
+        if not 0 < prob < 1:
+            raise ValueError("prob must be in (0, 1)")
+        lo, hi = (1 - prob) / 2, 1 - (1 - prob) / 2
+        summary = self.group_summary(by, weight=weight, rows=rows).with_columns(
+            pl.col(name).fill_nan(None) for name in SUMMARY_STATS
+        )
+        exprs = []
+        for name in SUMMARY_STATS:
+            exprs += [
+                pl.col(name).mean().alias(f"{name}_mean"),
+                pl.col(name).quantile(lo, interpolation="linear").alias(f"{name}_lower"),
+                pl.col(name).quantile(hi, interpolation="linear").alias(f"{name}_upper"),
+            ]
+        if not by:
+            return summary.select(exprs)
+        return summary.group_by(list(by), maintain_order=True).agg(exprs).sort(list(by))
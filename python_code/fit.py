@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Mapping, Optional, Sequence, Tuple
+
+import arviz as az
+import numpy as np
+import polars as pl
+
+from design import Encoding
+
+
+# create_models' return order
+MODEL_NAMES = ("any_asset", "any_debt", "pr_asset", "pr_debt")
+
+# the sampler settings used in 02_model.ipynb
+FIT_SETTINGS: Dict[str, dict] = {
+    "any_asset": dict(draws=1000, tune=1500, target_accept=0.98, sampler_kwargs={"max_treedepth": 15}),
+    "any_debt": dict(draws=1000, tune=1500, target_accept=0.98, sampler_kwargs={"max_treedepth": 15}),
+    "pr_asset": dict(draws=2500, tune=2500, target_accept=0.99),
+    "pr_debt": dict(draws=2500, tune=2500, target_accept=0.99),
+}
+
+ENCODING_FILE = "encoding.json"
+# content hash of the frame the encoding was fit on
+ENCODING_STAMP = "encoding_data.json"
+
+
+def checkpoint_path(out_dir: str, name: str) -> str:
+    return os.path.join(out_dir, f"{name}_model.nc")
+
+
+def _stamp_path(out_dir: str, name: str) -> str:
+    return os.path.join(out_dir, f"{name}_model.json")
+
+
+def frame_digest(data: pl.DataFrame) -> str:
+    """sha256 of the frame's contents (uncompressed IPC), independent of its chunking."""
+    buf = io.BytesIO()
+    data.rechunk().write_ipc(buf, compression="uncompressed")
+    return hashlib.sha256(buf.getvalue()).hexdigest()
+
+
+def _stamp(settings: Mapping, n_rows: int, data: str) -> dict:
+    # round-trip through JSON so it compares equal to what was written
+    return json.loads(json.dumps({"settings": dict(settings), "n_rows": n_rows, "data": data}, sort_keys=True))
+
+
+def _load_encoding(out_dir: str, data: str) -> Optional[Encoding]:
+    enc_path, meta = os.path.join(out_dir, ENCODING_FILE), os.path.join(out_dir, ENCODING_STAMP)
+    if not (os.path.exists(enc_path) and os.path.exists(meta)):
+        return None
+    with open(meta) as f:
+        if json.load(f).get("data") != data:
+            return None
+    return Encoding.load(enc_path)
+
+
+def _is_done(out_dir: str, name: str, stamp: dict) -> bool:
+    nc, meta = checkpoint_path(out_dir, name), _stamp_path(out_dir, name)
+    if not (os.path.exists(nc) and os.path.exists(meta)):
+        return False
+    with open(meta) as f:
+        recorded = json.load(f)
+    recorded.pop("seconds", None)
+    return recorded == stamp
+
+
+def fit_seconds(out_dir: str, name: str) -> Optional[float]:
+    """Sampling wall-clock recorded with a checkpoint (None if unknown)."""
+    meta = _stamp_path(out_dir, name)
+    if not os.path.exists(meta):
+        return None
+    with open(meta) as f:
+        return json.load(f).get("seconds")
+
+
+def plan_cores(n_models: int, chains: int, cores: int) -> Tuple[int, int]:
+    """
+    Split a core budget into (concurrent models, cores per model).
+
+    A model never gets more cores than chains (extra cores would sit idle),
+    so the budget goes to running more models side by side first; with
+    fewer cores than chains one model runs at a time on all of them.
+    """
+    cores = max(1, cores)
+    workers = max(1, min(n_models, cores // chains))
+    return workers, max(1, min(chains, cores // workers))
+
+
+def _fit_one(name: str, sipp_model: pl.DataFrame, encoding: Encoding, settings: dict,
+             out_dir: str, stamp: dict) -> str:
+    # imported here so the parent never pays for the pymc import twice
+    from models import create_model
+
+    model = create_model(name, sipp_model, encoding)
+    start = time.perf_counter()
+    idata = model.fit(**settings)
+    seconds = time.perf_counter() - start
+
+    # write-then-rename: a crash mid-write never leaves a checkpoint that looks finished
+    path = checkpoint_path(out_dir, name)
+    tmp = f"{path}.tmp"
+    az.to_netcdf(idata, tmp)
+    os.replace(tmp, path)
+    with open(_stamp_path(out_dir, name), "w") as f:
+        json.dump({**stamp, "seconds": seconds}, f, sort_keys=True)
+    return path
+
+
+def fit_all(
+    sipp_model: pl.DataFrame,
+    out_dir: str,
+    *,
+    models: Sequence[str] = MODEL_NAMES,
+    cores: Optional[int] = None,
+    chains: int = 4,
+    settings: Optional[Mapping[str, Mapping]] = None,
+    random_seed: Optional[int] = None,
+    overwrite: bool = False,
+) -> Dict[str, az.InferenceData]:
+    """
+    Fit the create_models models concurrently, one process per model, with a
+    checkpoint per finished model.
+
+    out_dir:     checkpoints go to <out_dir>/<name>_model.nc, next to the
+                 shared encoding (encoding.json).
+    cores:       total core budget (default os.cpu_count()), split between
+                 concurrent models and their chains by plan_cores.
+    settings:    per-model overrides merged into FIT_SETTINGS, e.g.
+                 {"pr_asset": {"draws": 500}}.
+    random_seed: base seed; each model gets its own stream derived from it
+                 and its name, so a subset run draws the same seeds.
+    overwrite:   refit even when a matching checkpoint exists.
+
+    Resuming: a model is skipped when its checkpoint exists and was fitted
+    with the same settings on the same data (a content hash of sipp_model),
+    so rerunning after a crash only fits what did not finish. If a model fails, the others still
+    run to completion and are checkpointed before the error is raised.
+
+    Returns {name: InferenceData} for the requested models.
+
+    Notes:
+      - The longest fits (the rank models) are started first.
+      - The encoding is fit once in the parent and reused on resume while
+        sipp_model is unchanged, so every model (and prediction) shares the
+        same level tables.
+    """
+    unknown = set(models) - set(MODEL_NAMES)
+    if unknown:
+        raise ValueError(f"unknown models: {sorted(unknown)}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    data = frame_digest(sipp_model)
+    encoding = None if overwrite else _load_encoding(out_dir, data)
+    if encoding is None:
+        encoding = Encoding.fit(sipp_model)
+        encoding.save(os.path.join(out_dir, ENCODING_FILE))
+        with open(os.path.join(out_dir, ENCODING_STAMP), "w") as f:
+            json.dump({"data": data}, f)
+
+    overrides = settings or {}
+    jobs = []
+    for name in models:
+        s = {**FIT_SETTINGS[name], "chains": chains, **overrides.get(name, {})}
+        if random_seed is not None:
+            key = (MODEL_NAMES.index(name),)
+            s["random_seed"] = int(np.random.SeedSequence(random_seed, spawn_key=key).generate_state(1)[0])
+        stamp = _stamp(s, sipp_model.height, data)
+        if overwrite or not _is_done(out_dir, name, stamp):
+            jobs.append((name, s, stamp))
+    jobs.sort(key=lambda job: -(job[1].get("draws", 1000) + job[1].get("tune", 1000)) * job[1]["chains"])
+
+    if jobs:
+        workers, per_model = plan_cores(len(jobs), chains, cores or os.cpu_count() or 1)
+        failed = {}
+        # spawn: pymc starts its own chain processes, which a forked child
+        # holding polars' thread pool cannot do safely
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {
+                pool.submit(_fit_one, name, sipp_model, encoding, {**s, "cores": per_model}, out_dir, stamp): name
+                for name, s, stamp in jobs
+            }
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as exc:
+                    failed[futures[fut]] = exc
+        if failed:
+            raise RuntimeError(
+                f"fitting failed for {sorted(failed)} (finished models are checkpointed; rerun to resume)"
+            ) from next(iter(failed.values()))
+
+    return {name: az.from_netcdf(checkpoint_path(out_dir, name)) for name in models}
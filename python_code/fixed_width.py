@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import gzip
+import os
+import shutil
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+
+
+# records per parsing batch: ~50-200 MB of raw ACS records at a time
+BATCH_ROWS = 500_000
+
+# kept rows buffered before a Parquet part file is written
+ROWS_PER_FILE = 2_000_000
+
+_SPACE, _MINUS, _ZERO, _NINE = 32, 45, 48, 57
+
+
+@dataclass(frozen=True)
+class Variable:
+    """One column of a fixed-width layout (0-based start, width in bytes)."""
+
+    name: str
+    start: int
+    width: int
+    numeric: bool = True
+    decimals: int = 0
+
+    @property
+    def dtype(self) -> pl.DataType:
+        if not self.numeric:
+            return pl.String
+        if self.decimals:
+            return pl.Float64
+        return pl.Int32 if self.width <= 9 else pl.Int64
+
+
+def read_ddi(ddi_path: str) -> List[Variable]:
+    """
+    Column layout from an IPUMS DDI codebook (the .xml next to the .dat):
+    each <var>'s <location StartPos EndPos>, <varFormat type> and dcml
+    (implied decimal places).
+    """
+    layout = []
+    for _, elem in ET.iterparse(ddi_path):
+        if elem.tag != "var" and not elem.tag.endswith("}var"):
+            continue
+        # {*} matches the DDI namespace (or none)
+        loc = elem.find("{*}location")
+        fmt = elem.find("{*}varFormat")
+        start = int(loc.get("StartPos"))
+        layout.append(Variable(
+            name=elem.get("name") or elem.get("ID"),
+            start=start - 1,
+            width=int(loc.get("EndPos")) - start + 1,
+            numeric=fmt is None or fmt.get("type", "numeric") == "numeric",
+            decimals=int(elem.get("dcml") or 0),
+        ))
+        elem.clear()
+    if not layout:
+        raise ValueError(f"no <var> layout found in {ddi_path}")
+    return layout
+
+
+def _record_length(head: bytes) -> Tuple[int, bytes]:
+    """Record length (terminator included) and the terminator, b"\n" or b"\r\n"."""
+    end = head.find(b"\n")
+    if end < 0:
+        raise ValueError("no newline in the first record; not a fixed-width extract?")
+    return end + 1, (b"\r\n" if head[end - 1:end] == b"\r" else b"\n")
+
+
+def _last_record(tail: bytes, reclen: int, newline: bytes) -> np.ndarray:
+    """Bytes after the last full record: a final record missing its newline, else an error."""
+    if len(tail) != reclen - len(newline):
+        raise ValueError(f"truncated last record: {len(tail)} bytes after the last full "
+                         f"{reclen}-byte record")
+    return np.frombuffer(tail + newline, dtype=np.uint8).reshape(1, reclen)
+
+
+def _batches(data_path: str, batch_rows: int) -> Iterator[np.ndarray]:
+    """(rows, record length) uint8 views of the file, batch_rows records at a time."""
+    if data_path.endswith(".gz"):
+        with gzip.open(data_path, "rb") as f:
+            carry = f.read(1 << 16)
+            if not carry:
+                return
+            reclen, newline = _record_length(carry)
+            size = batch_rows * reclen
+            while True:
+                # the first read can hold more than a batch: split it across batches
+                buf = carry + f.read(max(0, size - len(carry)))
+                usable = min(len(buf), size)
+                usable -= usable % reclen
+                if usable == 0:
+                    if buf:
+                        yield _last_record(buf, reclen, newline)
+                    return
+                # a partial trailing record is carried into the next batch
+                carry = buf[usable:]
+                yield np.frombuffer(buf[:usable], dtype=np.uint8).reshape(-1, reclen)
+    else:
+        if os.path.getsize(data_path) == 0:
+            return
+        raw = np.memmap(data_path, dtype=np.uint8, mode="r")
+        reclen, newline = _record_length(bytes(raw[:1 << 16]))
+        n = raw.size // reclen
+        for lo in range(0, n, batch_rows):
+            hi = min(n, lo + batch_rows)
+            yield raw[lo * reclen:hi * reclen].reshape(-1, reclen)
+        if raw.size > n * reclen:
+            yield _last_record(bytes(raw[n * reclen:]), reclen, newline)
+
+
+def _parse_numeric(field: np.ndarray, var: Variable) -> pl.Series:
+    """
+    Digits of a (rows, width) byte block -> numbers; all-blank -> null.
+    A field must be blanks, an optional minus, then digits; anything else
+    raises ValueError.
+    """
+    b = field.astype(np.int64)
+    digit = (b >= _ZERO) & (b <= _NINE)
+    minus, space = b == _MINUS, b == _SPACE
+    # non-blank bytes up to and including each position
+    filled = np.cumsum(~space, axis=1)
+    bad = (~(digit | minus | space) | (space & (filled > 0)) | (minus & (filled > 1))).any(axis=1)
+    bad |= minus.any(axis=1) & ~digit.any(axis=1)
+    if bad.any():
+        row = int(np.argmax(bad))
+        raise ValueError(f"{var.name}: malformed numeric field "
+                         f"{bytes(field[row]).decode('latin-1')!r} ({int(bad.sum())} in this batch)")
+    digits = np.where(digit, b - _ZERO, 0)
+    values = digits @ (10 ** np.arange(var.width - 1, -1, -1, dtype=np.int64))
+    values = np.where(minus.any(axis=1), -values, values)
+    blank = (b == _SPACE).all(axis=1)
+    s = pl.Series(var.name, values)
+    if var.decimals:
+        s = s / 10 ** var.decimals
+    s = s.cast(var.dtype)
+    return s.scatter(np.flatnonzero(blank), None) if blank.any() else s
+
+
+def _parse_string(field: np.ndarray, var: Variable) -> pl.Series:
+    raw = np.ascontiguousarray(field).view(f"S{var.width}").ravel()
+    return pl.Series(var.name, raw).cast(pl.String).str.strip_chars()
+
+
+def _column(records: np.ndarray, var: Variable) -> pl.Series:
+    field = records[:, var.start:var.start + var.width]
+    return _parse_numeric(field, var) if var.numeric else _parse_string(field, var)
+
+
+def iter_fixed_width(
+    data_path: str,
+    layout: Sequence[Variable],
+    *,
+    columns: Optional[Sequence[str]] = None,
+    filters: Optional[Mapping[str, Sequence[int]]] = None,
+    batch_rows: int = BATCH_ROWS,
+) -> Iterator[pl.DataFrame]:
+    """
+    Typed DataFrames of the kept records, one per batch of batch_rows
+    records of a fixed-width .dat (memory-mapped) or .dat.gz (streamed).
+
+    filters: {numeric column: allowed values}, e.g. {"STATEFIP": [22]}.
+    Only the filter columns are decoded for every record; the other
+    columns are sliced and decoded from the kept records alone. Batches
+    with no kept record are skipped.
+    """
+    by_name: Dict[str, Variable] = {v.name: v for v in layout}
+    filters = dict(filters or {})
+    wanted = list(by_name) if columns is None else list(columns)
+    missing = [c for c in [*wanted, *filters] if c not in by_name]
+    if missing:
+        raise KeyError(f"not in the layout: {missing}")
+
+    for records in _batches(data_path, batch_rows):
+        keep = np.ones(len(records), dtype=bool)
+        decoded: Dict[str, pl.Series] = {}
+        for name, allowed in filters.items():
+            s = _column(records, by_name[name])
+            keep &= s.is_in(list(allowed)).fill_null(False).to_numpy()
+            decoded[name] = s
+        if not keep.any():
+            continue
+        rows = records[keep]
+        yield pl.DataFrame([
+            decoded[name].filter(pl.Series(keep)) if name in decoded else _column(rows, by_name[name])
+            for name in wanted
+        ])
+
+
+def convert_fixed_width(
+    data_path: str,
+    ddi_path: str,
+    out_dir: str,
+    *,
+    columns: Optional[Sequence[str]] = None,
+    statefip: Optional[Sequence[int]] = None,
+    pumas: Optional[Sequence[int]] = None,
+    batch_rows: int = BATCH_ROWS,
+    rows_per_file: int = ROWS_PER_FILE,
+    overwrite: bool = False,
+) -> str:
+    """
+    Convert an IPUMS fixed-width extract to typed Parquet part files
+    (out_dir/part-00000.parquet, ...), keeping only records in `statefip`
+    and, within them, `pumas` (PUMA codes are only unique within a state).
+
+    Memory stays near-constant: one batch of raw records plus at most
+    rows_per_file kept rows, whatever the size of the national extract.
+    Read the result with pl.scan_parquet(os.path.join(out_dir, "*.parquet")).
+    """
+    if os.path.exists(out_dir) and os.listdir(out_dir):
+        if not overwrite:
+            raise FileExistsError(f"output directory is not empty: {out_dir}")
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    filters: Dict[str, Sequence[int]] = {}
+    if statefip is not None:
+        filters["STATEFIP"] = [int(x) for x in np.atleast_1d(statefip)]
+    if pumas is not None:
+        filters["PUMA"] = [int(x) for x in pumas]
+
+    layout = read_ddi(ddi_path)
+    pending: List[pl.DataFrame] = []
+    n_pending, part = 0, 0
+
+    def flush() -> None:
+        nonlocal pending, n_pending, part
+        if pending:
+            pl.concat(pending).write_parquet(os.path.join(out_dir, f"part-{part:05d}.parquet"))
+            part += 1
+        pending, n_pending = [], 0
+
+    for frame in iter_fixed_width(data_path, layout, columns=columns, filters=filters, batch_rows=batch_rows):
+        pending.append(frame)
+        n_pending += frame.height
+        if n_pending >= rows_per_file:
+            flush()
+    flush()
+    if part == 0:
+        # nothing matched: still leave a readable (empty) dataset
+        by_name = {v.name: v for v in layout}
+        names = list(by_name) if columns is None else list(columns)
+        pl.DataFrame(schema={n: by_name[n].dtype for n in names}).write_parquet(
+            os.path.join(out_dir, "part-00000.parquet"))
+    return out_dir
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Union
+
+
+Observer = Callable[[dict], None]
+
+_PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 1024 ** 2 if hasattr(os, "sysconf") else None
+
+# shared no-op: nullcontext can be entered any number of times
+_NO_STAGE = contextlib.nullcontext()
+
+
+def current_rss_mb() -> float:
+    """
+    Resident set size of this process in MB: the current value on Linux
+    (/proc/self/statm), the peak so far elsewhere (ru_maxrss).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_MB
+    except (OSError, TypeError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class _Stage:
+    __slots__ = ("tracer", "name", "fields", "start", "rss")
+
+    def __init__(self, tracer: "Tracer", name: str, fields: dict):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self) -> "_Stage":
+        self.rss = current_rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        seconds = time.perf_counter() - self.start
+        rss = current_rss_mb()
+        extra = {"error": exc_type.__name__} if exc_type is not None else {}
+        self.tracer.record(self.name, seconds, **self.fields, t=self.start - self.tracer.t0,
+                           rss_mb=rss, rss_delta_mb=rss - self.rss, **extra)
+        return False
+
+
+class Tracer:
+    """
+    Timing/memory hooks for predict_allmodels and its chunk loops.
+
+    Code under measurement wraps each stage in
+
+        with tracer.stage("predict", rows=n):
+            ...
+
+    and every observer is called with one event dict per finished stage:
+
+      stage         "to_pandas", "isel", "predict", "extract", "sample", ...
+      model, draw_block, chunk
+                    where the stage belongs (fields bound with bind() or
+                    passed to stage())
+      rows          rows processed, when it applies
+      t, seconds    start (seconds since the tracer was created), wall time
+      rows_per_s    rows / seconds
+      rss_mb, rss_delta_mb
+                    resident memory after the stage, and its change over it
+
+    With no observers the tracer is disabled: stage() returns a shared
+    no-op context and bind() returns the tracer itself, so instrumented
+    loops cost one method call per stage.
+
+    Notes:
+      - Stages nest (a chunk's "predict" inside its model's "draw"), so
+        summing every event double counts; group by stage instead.
+      - Events from worker processes (native engine, workers > 1) are
+        emitted by the parent as results come back; their rss_mb is the
+        worker's (with its pid as `worker`), and t and rss_delta_mb are
+        omitted.
+    """
+
+    def __init__(self, *observers: Observer, fields: Optional[dict] = None):
+        self.observers: List[Observer] = [o for o in observers if o is not None]
+        self.fields: dict = dict(fields or {})
+        self.t0 = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.observers)
+
+    def bind(self, **fields) -> "Tracer":
+        """A tracer adding `fields` to every event, sharing observers and clock."""
+        if not self.observers:
+            return self
+        child = Tracer(fields={**self.fields, **fields})
+        child.observers = self.observers
+        child.t0 = self.t0
+        return child
+
+    def stage(self, name: str, **fields):
+        if not self.observers:
+            return _NO_STAGE
+        return _Stage(self, name, fields)
+
+    def record(self, name: str, seconds: float, **fields) -> None:
+        """Emit a stage timed elsewhere (e.g. in a worker process)."""
+        event = {"stage": name, **self.fields, **fields, "seconds": seconds}
+        rows = event.get("rows")
+        if rows and seconds > 0:
+            event["rows_per_s"] = rows / seconds
+        self.emit(event)
+
+    def emit(self, event: dict) -> None:
+        for observer in self.observers:
+            observer(event)
+
+
+NULL_TRACER = Tracer()
+
+
+class JsonLinesTrace:
+    """Observer writing each event as one JSON line (flushed, so a crashed run keeps its trace)."""
+
+    def __init__(self, path: str, *, append: bool = False):
+        self.path = path
+        self._f = open(path, "a" if append else "w")
+
+    def __call__(self, event: dict) -> None:
+        self._f.write(json.dumps(event) + "\n")
+        self._f.flush()
+
+    def close(self) -> None:
+        if not self._f.closed:
+            self._f.close()
+
+
+class StageTotals:
+    """Observer summing seconds and counting events per stage name."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.count: Dict[str, int] = {}
+        self.peak_rss_mb = 0.0
+
+    def __call__(self, event: dict) -> None:
+        name = event["stage"]
+        self.seconds[name] = self.seconds.get(name, 0.0) + event["seconds"]
+        self.count[name] = self.count.get(name, 0) + 1
+        self.peak_rss_mb = max(self.peak_rss_mb, event.get("rss_mb") or 0.0)
+
+
+@contextlib.contextmanager
+def tracing(
+    observer: Union[None, Observer, Tracer] = None,
+    trace: Optional[str] = None,
+) -> Iterator[Tracer]:
+    """
+    The tracer for a predict_allmodels(observer=..., trace=...) call: an
+    existing Tracer is used as is, a callable becomes its observer, and
+    `trace` adds a JSON-lines file, closed on exit. Without either,
+    NULL_TRACER.
+    """
+    if observer is None and trace is None:
+        yield NULL_TRACER
+        return
+    base = observer if isinstance(observer, Tracer) else Tracer(observer)
+    if trace is None:
+        yield base
+        return
+    writer = JsonLinesTrace(trace)
+    tracer = Tracer(*base.observers, writer, fields=base.fields)
+    tracer.t0 = base.t0
+    try:
+        yield tracer
+    finally:
+        writer.close()
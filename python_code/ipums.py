@@ -1,39 +1,67 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
 import os
+import random
+import re
+import threading
 import time
 import pathlib
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
-API_KEY = os.getenv("IPUMS_API_KEY", "").strip()
-print(API_KEY)
-if not API_KEY:
-    raise SystemExit("Set IPUMS_API_KEY in your environment.")
-
 COLLECTION = "usa"
 VERSION = "beta"  # as shown in IPUMS v1 workflow examples
 
-BASE = "https://api.ipums.org"
+BASE = "https://api.ipums.org"  # default `base` of every API call
 OUT_DIR = pathlib.Path("./ipums_downloads").resolve()
-OUT_DIR.mkdir(parents=True, exist_ok=True)
+
+# {payload_key: extract number} of every extract submitted from out_dir
+SUBMITTED_FILE = "submitted.json"
+
+
+def api_key() -> str:
+    """IPUMS_API_KEY from the environment, read when a request is made."""
+    key = os.getenv("IPUMS_API_KEY", "").strip()
+    if not key:
+        raise RuntimeError("Set IPUMS_API_KEY in your environment.")
+    return key
 
 
 def headers() -> Dict[str, str]:
     # IMPORTANT: v1 uses Authorization: <API_KEY> (no "Bearer")
     return {
-        "Authorization": API_KEY,
+        "Authorization": api_key(),
         "Content-Type": "application/json",
         "Accept": "application/json",
     }
 
 
+def api_session(pool_size: int = 10) -> requests.Session:
+    """A Session with the API headers whose connection pool is shared by up to pool_size threads."""
+    s = requests.Session()
+    s.headers.update(headers())
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
 
-def submit_extract(payload: Dict[str, Any]) -> int:
-    url = f"{BASE}/extracts"
+
+
+def submit_extract(
+    payload: Dict[str, Any],
+    session: Optional[requests.Session] = None,
+    *,
+    base: str = BASE,
+) -> int:
+    url = f"{base}/extracts"
     params = {"collection": COLLECTION, "version": VERSION}
 
     h = headers()
@@ -53,8 +81,11 @@ def submit_extract(payload: Dict[str, Any]) -> int:
         print("Outgoing Authorization len:", len(v))
         print("Outgoing Authorization preview:", v[:6] + "..." + v[-4:])
 
-    with requests.Session() as s:
-        r = s.send(prepped, timeout=60, allow_redirects=False)
+    if session is not None:
+        r = session.send(prepped, timeout=60, allow_redirects=False)
+    else:
+        with requests.Session() as s:
+            r = s.send(prepped, timeout=60, allow_redirects=False)
 
     print("Status:", r.status_code)
     print("Body:", r.text)
@@ -83,18 +114,29 @@ def submit_extract(payload: Dict[str, Any]) -> int:
     return int(data["number"])
 
 
-def get_extract(extract_number: int) -> Dict[str, Any]:
-    url = f"{BASE}/extracts/{extract_number}"
+def get_extract(
+    extract_number: int,
+    session: Optional[requests.Session] = None,
+    *,
+    base: str = BASE,
+) -> Dict[str, Any]:
+    url = f"{base}/extracts/{extract_number}"
     params = {"collection": COLLECTION, "version": VERSION}
-    r = requests.get(url, params=params, headers=headers(), timeout=60)
+    r = (session or requests).get(url, params=params, headers=headers(), timeout=60)
     r.raise_for_status()
     return r.json()
 
 
-def wait_for_extract(extract_number: int, poll_seconds: int = 15, timeout_seconds: int = 60 * 60) -> Dict[str, Any]:
+def wait_for_extract(
+    extract_number: int,
+    poll_seconds: int = 15,
+    timeout_seconds: int = 60 * 60,
+    *,
+    base: str = BASE,
+) -> Dict[str, Any]:
     start = time.time()
     while True:
-        info = get_extract(extract_number)
+        info = get_extract(extract_number, base=base)
         status = (info.get("status") or "").lower()
         print(f"[extract {extract_number}] status={status}")
 
@@ -110,56 +152,345 @@ def wait_for_extract(extract_number: int, poll_seconds: int = 15, timeout_second
         time.sleep(poll_seconds)
 
 
-def download_file(url: str, dest_path: pathlib.Path) -> pathlib.Path:
+def _sha256(path: pathlib.Path, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _reported_size(r: requests.Response) -> Optional[int]:
+    """Full file size as the server reports it: the Content-Range total, else a 200's Content-Length."""
+    m = re.match(r"bytes (?:\d+-\d+|\*)/(\d+)", r.headers.get("Content-Range", ""))
+    if m:
+        return int(m.group(1))
+    if r.status_code == 200 and "Content-Length" in r.headers and not r.headers.get("Content-Encoding"):
+        return int(r.headers["Content-Length"])
+    return None
+
+
+def download_file(
+    url: str,
+    dest_path: pathlib.Path,
+    *,
+    expected_bytes: Optional[int] = None,
+    expected_sha256: Optional[str] = None,
+    retries: int = 5,
+    chunk_size: int = 1024 * 1024,
+    session: Optional[requests.Session] = None,
+) -> pathlib.Path:
+    """
+    Stream `url` to dest_path through dest_path.part, resuming the partial
+    file with an HTTP Range request after a dropped connection (up to
+    `retries` attempts, 1, 2, 4 ... s apart). `session` (e.g. api_session)
+    pools the connections of many downloads.
+
+    The file is renamed into place only once its size matches the size the
+    server reports (Content-Range total / Content-Length) and expected_bytes,
+    and its sha256 matches expected_sha256 when given. A download with no
+    size to check against is refused; a checksum mismatch deletes the
+    partial file.
+
+    A 416 to the Range request means the partial file already reaches the
+    end: it is taken as complete only if it has exactly the reported size
+    (from the 416 itself or a HEAD request); a stale or over-long partial
+    file is deleted and fetched again.
+    """
+    dest_path = pathlib.Path(dest_path)
+    part = dest_path.with_name(dest_path.name + ".part")
     # download_links URLs are direct file URLs; include Authorization header when downloading as well :contentReference[oaicite:5]{index=5}
-    with requests.get(url, headers={"Authorization": API_KEY}, stream=True, timeout=300) as r:
-        r.raise_for_status()
-        with open(dest_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    f.write(chunk)
+    auth = {"Authorization": api_key(), "Accept": "*/*"}
+    http = session or requests
+
+    total = None
+    for attempt in range(retries + 1):
+        have = part.stat().st_size if part.exists() else 0
+        h = dict(auth)
+        if have:
+            h["Range"] = f"bytes={have}-"
+        try:
+            with http.get(url, headers=h, stream=True, timeout=300) as r:
+                if r.status_code == 416 and have:
+                    total = _reported_size(r)
+                    if total is None:
+                        total = _reported_size(http.head(url, headers=auth, timeout=60, allow_redirects=True))
+                    if total == have:
+                        break
+                    # left over from another version of the file: start over
+                    part.unlink()
+                    continue
+                r.raise_for_status()
+                total = _reported_size(r)
+                # 200 means the server ignored the Range header: start over
+                mode = "ab" if have and r.status_code == 206 else "wb"
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        if chunk:
+                            f.write(chunk)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+    if total is None and expected_bytes is None:
+        raise IOError(f"{dest_path.name}: no size to check the download against")
+    size = part.stat().st_size if part.exists() else 0
+    for want in (total, expected_bytes):
+        if want is not None and size != want:
+            raise IOError(f"{dest_path.name}: got {size} bytes, expected {want}")
+    if expected_sha256 is not None and _sha256(part) != expected_sha256.lower():
+        part.unlink()
+        raise IOError(f"{dest_path.name}: sha256 mismatch")
+    os.replace(part, dest_path)
     return dest_path
 
 
-def main() -> None:
+def extract_dir(extract_number: int, out_dir: pathlib.Path = OUT_DIR) -> pathlib.Path:
+    """Cache location of one extract's files: <out_dir>/<collection>_<number>/."""
+    return pathlib.Path(out_dir) / f"{COLLECTION}_{extract_number:05d}"
+
+
+def download_extract(
+    extract_number: int,
+    links: Mapping[str, Mapping[str, Any]],
+    *,
+    out_dir: pathlib.Path = OUT_DIR,
+    workers: int = 4,
+    session: Optional[requests.Session] = None,
+) -> Dict[str, pathlib.Path]:
+    """
+    Download every download_links entry of a completed extract into its
+    cache directory, `workers` files at a time (over `session` when given).
+    Returns {link name: path}.
+
+    Each finished file is recorded in the directory's manifest.json with
+    its verified size, plus its sha256 when the link metadata provides one
+    (download_file checks both before the file is moved into place). A file
+    already in the manifest with the recorded size is not fetched or read
+    again, so rerunning main() for a finished extract does no I/O beyond a
+    stat per file; interrupted files resume from their .part.
+    """
+    root = extract_dir(extract_number, out_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    manifest_path = root / "manifest.json"
+    manifest: Dict[str, Dict[str, Any]] = {}
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    lock = threading.Lock()
+
+    def cached(name: str, dest: pathlib.Path) -> bool:
+        entry = manifest.get(name)
+        return (entry is not None and entry["file"] == dest.name
+                and dest.exists() and dest.stat().st_size == entry["bytes"])
+
+    def fetch(name: str, meta: Mapping[str, Any]) -> pathlib.Path:
+        file_url = meta["url"]
+        dest = root / pathlib.Path(file_url).name
+        if cached(name, dest):
+            return dest
+        print(" -", name, "->", dest.name)
+        download_file(file_url, dest, expected_bytes=meta.get("bytes"), expected_sha256=meta.get("sha256"),
+                      session=session)
+        entry = {"file": dest.name, "bytes": dest.stat().st_size}
+        if meta.get("sha256"):
+            entry["sha256"] = meta["sha256"]
+        with lock:
+            manifest[name] = entry
+            tmp = manifest_path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(tmp, manifest_path)
+        return dest
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {name: pool.submit(fetch, name, meta) for name, meta in links.items()}
+        return {name: fut.result() for name, fut in futures.items()}
+
+
+def payload_key(payload: Mapping[str, Any]) -> str:
+    """Stable key of an extract definition: sha256 of its canonical JSON."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _load_submitted(out_dir: pathlib.Path) -> Dict[str, int]:
+    path = pathlib.Path(out_dir) / SUBMITTED_FILE
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_submitted(out_dir: pathlib.Path, submitted: Mapping[str, int]) -> None:
+    path = pathlib.Path(out_dir) / SUBMITTED_FILE
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(submitted, f, indent=1)
+    os.replace(tmp, path)
+
+
+def backoff_delays(initial: float = 5.0, factor: float = 2.0, max_delay: float = 120.0, jitter: float = 0.5):
+    """
+    Poll intervals: initial, initial * factor, ... capped at max_delay, each
+    scaled by a random factor in [1 - jitter, 1 + jitter] so extracts
+    submitted together do not poll in lockstep.
+    """
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, max_delay)
+
+
+async def poll_extract(
+    extract_number: int,
+    session: requests.Session,
+    *,
+    initial: float = 5.0,
+    max_delay: float = 120.0,
+    timeout_seconds: int = 60 * 60,
+    base: str = BASE,
+) -> Dict[str, Any]:
+    """wait_for_extract for the event loop: jittered exponential backoff, pooled connections."""
+    start = time.monotonic()
+    for delay in backoff_delays(initial, max_delay=max_delay):
+        info = await asyncio.to_thread(get_extract, extract_number, session, base=base)
+        status = (info.get("status") or "").lower()
+        print(f"[extract {extract_number}] status={status}")
+        if status == "completed":
+            return info
+        if status in {"failed", "canceled"}:
+            raise RuntimeError(f"Extract {extract_number} ended with status={status}: {info}")
+        if time.monotonic() - start + delay > timeout_seconds:
+            raise TimeoutError(f"Timed out waiting for extract {extract_number}")
+        await asyncio.sleep(delay)
+
+
+async def _run_extract(
+    payload: Dict[str, Any],
+    session: requests.Session,
+    *,
+    out_dir: pathlib.Path,
+    workers: int,
+    base: str,
+    poll: Mapping[str, Any],
+    submitted: Dict[str, int],
+    downloads: ThreadPoolExecutor,
+) -> Tuple[int, Dict[str, pathlib.Path]]:
+    # submitted is only touched here, on the event loop thread
+    key = payload_key(payload)
+    num = submitted.get(key)
+    if num is None:
+        num = await asyncio.to_thread(submit_extract, payload, session, base=base)
+        submitted[key] = num
+        _save_submitted(out_dir, submitted)
+        print("Extract number:", num, "-", payload.get("description", ""))
+    else:
+        print("Reusing extract number:", num, "-", payload.get("description", ""))
+    try:
+        final = await poll_extract(num, session, base=base, **poll)
+    except RuntimeError:
+        # failed or canceled: the next run submits the definition again
+        submitted.pop(key, None)
+        _save_submitted(out_dir, submitted)
+        raise
+
+    links = final.get("download_links", {})
+    if not links:
+        raise RuntimeError(f"No download_links found on completed extract: {final}")
+    # own executor: a multi-GB download must not hold a thread the polls need
+    paths = await asyncio.get_running_loop().run_in_executor(
+        downloads, partial(download_extract, num, links, out_dir=out_dir, workers=workers, session=session)
+    )
+    return num, paths
+
+
+async def run_extracts(
+    payloads: Sequence[Dict[str, Any]],
+    *,
+    out_dir: pathlib.Path = OUT_DIR,
+    workers: int = 4,
+    pool_size: int = 10,
+    base: str = BASE,
+    **poll: Any,
+) -> List[Tuple[int, Dict[str, pathlib.Path]]]:
+    """
+    Submit every extract definition at once, poll them all concurrently
+    (poll_extract; `poll` takes initial / max_delay / timeout_seconds) and
+    download each extract as soon as it completes, so the whole run takes
+    about as long as the slowest extract.
+
+    Returns [(extract number, {link name: path})] in payload order. One
+    extract failing does not stop the others; the error is raised once they
+    are all done.
+
+    Every submitted extract is recorded in <out_dir>/submitted.json under
+    its payload_key, so a rerun with the same definitions (after a timeout,
+    a crash, or to pick up finished downloads) polls and downloads the
+    extracts it already has instead of submitting new ones.
+
+    Notes:
+      - An extract that ends failed or canceled is dropped from the record
+        and resubmitted on the next run; delete its entry (or the file) to
+        force a fresh extract of an unchanged definition.
+      - The HTTP calls are the blocking requests ones, run in worker threads
+        over one pooled Session; there is no async HTTP client dependency.
+        Downloads run in their own executor (one thread per extract, each
+        fetching `workers` files at a time), so they never starve the
+        polling threads.
+      - base is the API root (a local mock in tests).
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    submitted = _load_submitted(out_dir)
+    with api_session(pool_size) as s, ThreadPoolExecutor(max_workers=max(1, len(payloads))) as downloads:
+        results = await asyncio.gather(
+            *(_run_extract(p, s, out_dir=out_dir, workers=workers, base=base, poll=poll,
+                           submitted=submitted, downloads=downloads)
+              for p in payloads),
+            return_exceptions=True,
+        )
+    failed = [(i, r) for i, r in enumerate(results) if isinstance(r, BaseException)]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(payloads)} extracts failed: "
+            + "; ".join(f"#{i}: {r!r}" for i, r in failed)
+        ) from failed[0][1]
+    return list(results)
+
+
+def extract_payload(
+    samples: Sequence[str],
+    variables: Sequence[str],
+    description: str = "My IPUMS USA API-submitted extract",
+) -> Dict[str, Any]:
     # IMPORTANT: v1 expects "samples" and "variables" as objects (dicts), not lists :contentReference[oaicite:6]{index=6}
-    extract_payload: Dict[str, Any] = {
-        "description": "My IPUMS USA API-submitted extract",
+    return {
+        "description": description,
         "data_structure": {"rectangular": {"on": "P"}},  # common for person-level rectangular extracts :contentReference[oaicite:7]{index=7}
         "data_format": "fixed_width",
-        "samples": {
-            "us2022a": {}   # change to your sample(s)
-        },
-        "variables": {
-            "AGE": {},
-            "SEX": {},
-            "RACE": {},
-            "HISPAN": {},
-            "STATEFIP": {},
-        },
+        "samples": {sample: {} for sample in samples},
+        "variables": {var: {} for var in variables},
     }
 
-    print("Submitting extract...")
-    num = submit_extract(extract_payload)
-    print("Extract number:", num)
 
-    print("Waiting for completion...")
-    final = wait_for_extract(num)
+def main() -> None:
+    try:
+        api_key()
+    except RuntimeError as e:
+        raise SystemExit(str(e))
 
-    # When complete, download_links contains the file URLs (ddi, syntax, data, etc.) :contentReference[oaicite:8]{index=8}
-    links = final.get("download_links", {})
-    if not links:
-        raise RuntimeError(f"No download_links found on completed extract: {final}")
+    # one definition per sample / variable set; change to your sample(s)
+    payloads = [
+        extract_payload(["us2022a"], ["AGE", "SEX", "RACE", "HISPAN", "STATEFIP"]),
+    ]
 
-    print("Downloading files:")
-    for name, meta in links.items():
-        file_url = meta["url"]
-        filename = pathlib.Path(file_url).name
-        dest = OUT_DIR / filename
-        print(" -", name, "->", dest.name)
-        download_file(file_url, dest)
+    print("Submitting extracts...")
+    results = asyncio.run(run_extracts(payloads))
 
-    print("Done. Files saved to:", OUT_DIR)
+    for num, paths in results:
+        print("Done. Extract", num, "files saved to:", extract_dir(num))
 
 
 if __name__ == "__main__":
@@ -1,10 +1,32 @@
+from typing import Optional, Sequence
+
 import bambi as bmb
-import polars as pl
 import numpy as np
+import pandas as pd
 
+from design import Encoding
 
-def create_models(sipp_model):
-    
+
+def _model_frame(shared: pd.DataFrame, cols: Sequence[str]) -> pd.DataFrame:
+    # rows complete on this model's columns; each model keeps only the levels it
+    # sees, exactly as the old per-model dropna + astype("category") did
+    df = shared.loc[shared[list(cols)].notna().all(axis=1), list(cols)]
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+
+def _shared_frame(sipp_model, encoding: Encoding) -> pd.DataFrame:
+    outcomes = ["hh_any_asset", "hh_any_debt", "prank_assets", "prank_debts"]
+    covariates = ['state', 'hh_income', 'age', 'race_eth', 'edu', 'tenure', 'household_type',
+                  'male', 'metro', 'disability', 'class_worker', 'public_assistance',
+                  'social_security', 'poverty', 'citizen', 'english_at_home', 'homevalue',
+                  *encoding.interactions]
+    return encoding.frame(sipp_model, outcomes + covariates)
+
+
+def _any_asset_model(shared: pd.DataFrame) -> bmb.Model:
     any_asset_model_cols = ['hh_any_asset',
                             'state',
                             'hh_income',
@@ -22,10 +44,7 @@ def create_models(sipp_model):
                             'poverty',
                             'citizen']
     
-    any_asset_model_df = sipp_model.select(pl.col(any_asset_model_cols)).to_pandas().dropna(subset=any_asset_model_cols)
-    
-    for col in ['state','hh_income','age','race_eth','edu','tenure','household_type','class_worker']:
-        any_asset_model_df[col] = any_asset_model_df[col].astype('category')
+    any_asset_model_df = _model_frame(shared, any_asset_model_cols)
 
     any_asset_model_formula = """
                                 hh_any_asset ~ male + metro + disability + class_worker + public_assistance + social_security +
@@ -43,13 +62,14 @@ def create_models(sipp_model):
             )
         }
     
-    any_asset_model = bmb.Model(formula=any_asset_model_formula, 
-                            data=any_asset_model_df, 
-                            family="bernoulli",
-                            priors=any_asset_priors,
-                            noncentered=True)
-    
-    
+    return bmb.Model(formula=any_asset_model_formula,
+                     data=any_asset_model_df,
+                     family="bernoulli",
+                     priors=any_asset_priors,
+                     noncentered=True)
+
+
+def _any_debt_model(shared: pd.DataFrame) -> bmb.Model:
     any_debt_model_cols = ['hh_any_debt',
                         'state',
                         'hh_income',
@@ -67,10 +87,7 @@ def create_models(sipp_model):
                         'poverty',
                         'citizen']
     
-    any_debt_model_df = sipp_model.select(pl.col(any_debt_model_cols)).to_pandas().dropna(subset=any_debt_model_cols)
-    
-    for col in ['state','hh_income','age','race_eth','edu','tenure','household_type','class_worker']:
-        any_debt_model_df[col] = any_debt_model_df[col].astype('category')
+    any_debt_model_df = _model_frame(shared, any_debt_model_cols)
         
     any_debt_model_formula = """
     hh_any_debt ~ male + metro + disability + class_worker + public_assistance + social_security +
@@ -88,13 +105,14 @@ def create_models(sipp_model):
         )
     }
     
-    any_debt_model = bmb.Model(formula=any_debt_model_formula, 
-                            data=any_debt_model_df, 
-                            family="bernoulli",
-                            priors=any_debt_priors,
-                            noncentered=True)
-    
-    
+    return bmb.Model(formula=any_debt_model_formula,
+                     data=any_debt_model_df,
+                     family="bernoulli",
+                     priors=any_debt_priors,
+                     noncentered=True)
+
+
+def _pr_asset_model(shared: pd.DataFrame) -> bmb.Model:
     pr_asset_model_cols = ['prank_assets',
                             'state',
                             'hh_income',
@@ -118,12 +136,7 @@ def create_models(sipp_model):
                             'race_eth_age',	
                             'race_eth_income']
 
-    pr_asset_model_df = sipp_model.select(pl.col(pr_asset_model_cols)).to_pandas().dropna(subset=pr_asset_model_cols)
-    
-    for col in ['state','hh_income','age','race_eth','edu','tenure',
-            'household_type','class_worker','homevalue','race_eth_state',
-            'race_eth_edu',	'race_eth_age',	'race_eth_income']:
-        pr_asset_model_df[col] = pr_asset_model_df[col].astype('category')
+    pr_asset_model_df = _model_frame(shared, pr_asset_model_cols)
         
     # change tenure from random effect to fixed effect
     pr_asset_model_formula = """
@@ -145,14 +158,15 @@ def create_models(sipp_model):
         )
     }
     
-    pr_asset_model = bmb.Model(formula=pr_asset_model_formula, 
-                            data=pr_asset_model_df, 
-                            family="beta",
-                            link='logit',
-                            priors=pr_asset_priors,
-                            noncentered=True)
-    
-    
+    return bmb.Model(formula=pr_asset_model_formula,
+                     data=pr_asset_model_df,
+                     family="beta",
+                     link='logit',
+                     priors=pr_asset_priors,
+                     noncentered=True)
+
+
+def _pr_debt_model(shared: pd.DataFrame) -> bmb.Model:
     pr_debt_model_cols = ['prank_debts',
                         'state',
                         'hh_income',
@@ -176,16 +190,11 @@ def create_models(sipp_model):
                         'race_eth_age',	
                         'race_eth_income']
     
-    pr_debt_model_df = sipp_model.select(pl.col(pr_debt_model_cols)).to_pandas().dropna(subset=pr_debt_model_cols)
+    pr_debt_model_df = _model_frame(shared, pr_debt_model_cols)
     
     eps = 1e-6
     pr_debt_model_df["prank_debts_adj"] = np.clip(pr_debt_model_df["prank_debts"], eps, 1 - eps)
     pr_debt_model_df.drop(['prank_debts'],axis=1,inplace=True)
-    
-    for col in ['state','hh_income','age','race_eth','edu','tenure',
-            'household_type','class_worker','homevalue','race_eth_state',
-            'race_eth_edu',	'race_eth_age',	'race_eth_income']:
-        pr_debt_model_df[col] = pr_debt_model_df[col].astype('category')
         
     # change tenure from random effect to fixed effect
     pr_debt_model_formula = """
@@ -207,14 +216,53 @@ def create_models(sipp_model):
         )
     }
     
-    pr_debt_model = bmb.Model(formula=pr_debt_model_formula, 
-                            data=pr_debt_model_df, 
-                            family="beta",
-                            link='logit',
-                            priors=pr_debt_priors,
-                            noncentered=True)
-    
-    return (any_asset_model,any_debt_model,pr_asset_model,pr_debt_model)
+    return bmb.Model(formula=pr_debt_model_formula,
+                     data=pr_debt_model_df,
+                     family="beta",
+                     link='logit',
+                     priors=pr_debt_priors,
+                     noncentered=True)
 
-    
-    
\ No newline at end of file
+
+# create_models' return order (fit.MODEL_NAMES)
+MODEL_BUILDERS = {
+    "any_asset": _any_asset_model,
+    "any_debt": _any_debt_model,
+    "pr_asset": _pr_asset_model,
+    "pr_debt": _pr_debt_model,
+}
+
+
+def create_model(name: str, sipp_model, encoding: Optional[Encoding] = None) -> bmb.Model:
+    """
+    Build one of the create_models models by name ("any_asset", "any_debt",
+    "pr_asset", "pr_debt") without constructing the other three.
+    """
+    if name not in MODEL_BUILDERS:
+        raise ValueError(f"unknown model: {name!r}")
+    if encoding is None:
+        encoding = Encoding.fit(sipp_model)
+    return MODEL_BUILDERS[name](_shared_frame(sipp_model, encoding))
+
+
+def create_models(sipp_model, encoding: Optional[Encoding] = None, *, return_encoding: bool = False):
+    """
+    Build the four bambi models (any asset, any debt, asset rank, debt rank).
+
+    The covariates are encoded once through design.Encoding (fit on
+    sipp_model unless an encoding is passed) into one shared pandas frame;
+    each model's frame is a row subset of it. The race_eth_* interaction
+    columns are derived from the race_eth/state/edu/age/hh_income codes, so
+    sipp_model does not need the string-concatenated versions.
+
+    With return_encoding=True the Encoding is returned as a fifth element;
+    save it next to the fitted models (encoding.save(path)) so prediction
+    reuses the same level tables.
+    """
+    if encoding is None:
+        encoding = Encoding.fit(sipp_model)
+    shared = _shared_frame(sipp_model, encoding)
+    models = tuple(build(shared) for build in MODEL_BUILDERS.values())
+    if return_encoding:
+        return (*models, encoding)
+    return models
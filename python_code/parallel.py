@@ -0,0 +1,481 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+import polars as pl
+
+from instrument import NULL_TRACER, Tracer, current_rss_mb
+from posterior import PosteriorEngine
+from posterior_store import ALIGN, open_store
+
+
+# per-process state: set directly for workers=1, by _init_worker in the pool
+_STATE: Dict[str, object] = {}
+
+
+class SharedArrays:
+    """
+    A set of named NumPy arrays packed into one SharedMemory block.
+
+    The parent builds it; workers attach by (name, spec) and get zero-copy
+    views, so nothing but the small spec dict is ever pickled.
+    """
+
+    def __init__(
+        self,
+        arrays: Mapping[str, np.ndarray],
+        *,
+        empty: Optional[Mapping[str, Tuple[Tuple[int, ...], str]]] = None,
+    ):
+        empty = dict(empty or {})
+        layout: List[Tuple[str, Tuple[int, ...], np.dtype]] = []
+        for name, a in arrays.items():
+            if a.dtype.kind == "O":
+                raise TypeError(f"{name}: object arrays cannot live in shared memory")
+            layout.append((name, a.shape, a.dtype))
+        for name, (shape, dtype) in empty.items():
+            layout.append((name, tuple(shape), np.dtype(dtype)))
+
+        spec: Dict[str, Tuple[int, Tuple[int, ...], str]] = {}
+        offset = 0
+        for name, shape, dtype in layout:
+            offset = -(-offset // ALIGN) * ALIGN
+            spec[name] = (offset, tuple(shape), dtype.str)
+            offset += int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+
+        self.shm = SharedMemory(create=True, size=max(offset, 1))
+        self.spec = spec
+        self.arrays = self._views(self.shm, spec)
+        for name, a in arrays.items():
+            self.arrays[name][...] = a
+
+    @staticmethod
+    def _views(shm: SharedMemory, spec) -> Dict[str, np.ndarray]:
+        return {
+            name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for name, (offset, shape, dtype) in spec.items()
+        }
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @classmethod
+    def attach(cls, name: str, spec) -> Tuple[SharedMemory, Dict[str, np.ndarray]]:
+        shm = SharedMemory(name=name)
+        return shm, cls._views(shm, spec)
+
+    def close(self) -> None:
+        # views must be dropped before the buffer can be released
+        self.arrays = {}
+        self.shm.close()
+        self.shm.unlink()
+
+
+def task_rng(entropy: int, block: int, model: int, chunk: int) -> np.random.Generator:
+    """
+    Generator for one (draw block, model, chunk) task.
+
+    Seeds depend only on the task key, never on which worker runs it or in
+    what order, which is what makes the output identical for any worker count.
+    """
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(block, model, chunk)))
+
+
+def _set_state(engines, encoded, outputs, settings) -> None:
+    _STATE.clear()
+    _STATE.update(engines=engines, encoded=encoded, outputs=outputs, **settings)
+
+
+def _init_worker(shm_name: str, spec, metas, encoded_keys, settings) -> None:
+    shm, arrays = SharedArrays.attach(shm_name, spec)
+    engines = []
+    for j, meta in enumerate(metas):
+        if "store" in meta:
+            # memory-mapped store: map the file again instead of copying it
+            engines.append(open_store(meta["store"]))
+            continue
+        prefix = f"engine/{j}/"
+        engines.append(
+            PosteriorEngine.from_arrays(
+                meta, {k[len(prefix):]: v for k, v in arrays.items() if k.startswith(prefix)}
+            )
+        )
+    encoded = [
+        {col: arrays[f"encoded/{j}/{col}"] for col in cols} for j, cols in enumerate(encoded_keys)
+    ]
+    outputs = None
+    if "y/0" in arrays:
+        outputs = [(arrays[f"y/{j}"], arrays.get(f"draw/{j}")) for j in range(len(metas))]
+    _set_state(engines, encoded, outputs, settings)
+    _STATE["shm"] = shm  # keep the mapping alive for the life of the worker
+    if "base_path" in settings:
+        _STATE["base"] = partial(_read_base, settings["base_path"])
+
+
+def _sample(j: int, k: int, c: int, rows) -> Tuple[np.ndarray, np.ndarray]:
+    engine: PosteriorEngine = _STATE["engines"][j]
+    return engine.sample_rows(
+        _STATE["encoded"][j],
+        rows,
+        rng=task_rng(_STATE["entropy"], k, j, c),
+        include_group_specific=_STATE["include_group_specific"],
+        sample_new_groups=_STATE["sample_new_groups"],
+    )
+
+
+def _sample_hurdle(p: int, k: int, c: int, start: int, stop: int):
+    """
+    Class/rank pair p (engines 2p, 2p + 1) as one two-part draw: the class
+    outcome for rows start:stop, then the rank model only on the rows whose
+    class draw is 1. Returns (class y, class draw ids), (kept row offsets,
+    rank y, rank draw ids).
+    """
+    y, d = _sample(2 * p, k, c, slice(start, stop))
+    held = np.flatnonzero(y == 1)
+    y_rank, d_rank = _sample(2 * p + 1, k, c, start + held)
+    return (y, d), (held, y_rank, d_rank)
+
+
+def _run_task(task: Tuple[int, int, int, int, int]) -> None:
+    k, j, c, start, stop = task
+    if not _STATE.get("hurdle"):
+        y, d = _sample(j, k, c, slice(start, stop))
+        y_out, d_out = _STATE["outputs"][j]
+        y_out[k, start:stop] = y
+        if d_out is not None:
+            d_out[k, start:stop] = d
+        return
+
+    # j is the pair: class rows go out as they are, rank rows are scattered
+    # into zeros (draw id -1) so nothing full-length is built on the side
+    (y, d), (held, y_rank, d_rank) = _sample_hurdle(j, k, c, start, stop)
+    y_out, d_out = _STATE["outputs"][2 * j]
+    y_out[k, start:stop] = y
+    if d_out is not None:
+        d_out[k, start:stop] = d
+    y_out, d_out = _STATE["outputs"][2 * j + 1]
+    y_out[k, start:stop] = 0
+    y_out[k, start + held] = y_rank
+    if d_out is not None:
+        d_out[k, start:stop] = -1
+        d_out[k, start + held] = d_rank
+
+
+def _read_base(path: str, start: int, stop: int) -> pl.DataFrame:
+    return pl.scan_parquet(path).slice(start, stop - start).collect()
+
+
+def _run_sink_task(task: Tuple[int, int, int, int]) -> str:
+    k, c, start, stop = task
+    n_engines = len(_STATE["engines"])
+    if not _STATE.get("hurdle"):
+        results = [_sample(j, k, c, slice(start, stop)) for j in range(n_engines)]
+    else:
+        results = []
+        for p in range(n_engines // 2):
+            cls, (held, y_rank, d_rank) = _sample_hurdle(p, k, c, start, stop)
+            y = np.zeros(stop - start, dtype=np.float64)
+            d = np.full(stop - start, -1, dtype=np.int32)
+            y[held] = y_rank
+            d[held] = d_rank
+            results += [cls, (y, d)]
+    frame = _STATE["assemble"](_STATE["base"](start, stop), results)
+    path = partition_path(_STATE["sink"], k, c)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    frame.write_parquet(path)
+    return path
+
+
+def partition_path(sink: str, block: int, chunk: int) -> str:
+    """Hive-style location of one finished (draw block, chunk) file."""
+    return os.path.join(sink, f"draw_block={block}", f"part-{chunk:05d}.parquet")
+
+
+def scan_sink(sink: str) -> pl.LazyFrame:
+    """Lazy view over a sink directory; draw_block comes from the partition path."""
+    return pl.scan_parquet(
+        os.path.join(sink, "**", "*.parquet"),
+        hive_partitioning=True,
+        hive_schema={"draw_block": pl.Int32},
+    )
+
+
+def prepare_sink(sink: str) -> None:
+    if os.path.isdir(sink) and os.listdir(sink):
+        raise FileExistsError(f"sink directory is not empty: {sink}")
+    os.makedirs(sink, exist_ok=True)
+
+
+def _share(
+    engines: Sequence[PosteriorEngine],
+    encoded: Sequence[Mapping[str, np.ndarray]],
+    empty: Optional[Mapping[str, Tuple[Tuple[int, ...], str]]] = None,
+) -> Tuple[SharedArrays, list, list]:
+    arrays: Dict[str, np.ndarray] = {}
+    metas = []
+    for j, e in enumerate(engines):
+        if e.store is not None:
+            metas.append({"store": e.store})
+        else:
+            meta, tables = e.to_arrays()
+            metas.append(meta)
+            arrays.update({f"engine/{j}/{k}": v for k, v in tables.items()})
+        arrays.update({f"encoded/{j}/{col}": v for col, v in encoded[j].items()})
+    return SharedArrays(arrays, empty=empty), metas, [e.columns for e in engines]
+
+
+def _timed(fn, task):
+    start = time.perf_counter()
+    fn(task)
+    return time.perf_counter() - start, current_rss_mb(), os.getpid()
+
+
+def _pool_map(fn, tasks, shared, metas, encoded_keys, settings, workers,
+              *, tracer: Tracer = NULL_TRACER, stage: str = "", fields=None) -> None:
+    # spawn, not fork: polars' thread pool is not fork-safe and workers that
+    # touch polars (the Parquet sink) can deadlock in a forked child
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(shared.name, shared.spec, metas, encoded_keys, settings),
+    ) as pool:
+        chunksize = max(1, len(tasks) // (workers * 4))
+        if not tracer.enabled:
+            # consume the iterator so worker exceptions surface here
+            for _ in pool.map(fn, tasks, chunksize=chunksize):
+                pass
+            return
+        for task, (seconds, rss, pid) in zip(tasks, pool.map(partial(_timed, fn), tasks, chunksize=chunksize)):
+            tracer.record(stage, seconds, **fields(task), rss_mb=rss, worker=pid)
+
+
+def _task_fields(task, names) -> dict:
+    k, j, c, start, stop = task
+    return {"model": names[j], "draw_block": k, "chunk": c, "rows": stop - start}
+
+
+def _sink_task_fields(task) -> dict:
+    k, c, start, stop = task
+    return {"draw_block": k, "chunk": c, "rows": stop - start}
+
+
+def run_native(
+    engines: Sequence[PosteriorEngine],
+    data,
+    *,
+    ndraw: int = 1,
+    seed: Optional[int] = None,
+    chunk_size: int = 50_000,
+    workers: int = 1,
+    include_group_specific: bool = True,
+    sample_new_groups: bool = False,
+    hurdle: bool = False,
+    tracer: Tracer = NULL_TRACER,
+    names: Optional[Sequence[str]] = None,
+    out: Optional[Sequence[Tuple[np.ndarray, Optional[np.ndarray]]]] = None,
+) -> Tuple[List[np.ndarray], List[Optional[np.ndarray]]]:
+    """
+    Posterior-predictive draws for several engines over the same rows.
+
+    Work is cut into (draw block, model, chunk) tasks and fanned out over
+    `workers` processes. Posterior tables, the encoded base frame and the
+    output arrays all sit in one shared-memory block; tasks only carry their
+    key and row range, and write results in place.
+
+    Returns (ys, draw_ids): per engine, (ndraw, N) arrays.
+
+    Notes:
+      - Output is bit-identical for a given (seed, chunk_size) whatever the
+        worker count: each task seeds its own generator from the task key.
+      - workers=1 runs in-process without a pool or shared memory.
+      - workers=0 / None uses os.cpu_count().
+      - hurdle=True treats engines (0, 1), (2, 3), ... as (class, rank)
+        pairs: each task draws the class outcome, then runs the rank model
+        only on the rows drawn 1. Rank rows drawn 0 are 0 with draw id -1.
+        Class draws are identical to hurdle=False (same task seeds).
+      - tracer gets an "encode" stage per engine and a "sample" stage per
+        task (model, draw_block, chunk, rows); `names` labels the engines
+        in its events (default: their index).
+      - out: per engine, preallocated (ndraw, N) (y, draw ids) arrays to
+        fill instead of allocating new ones (any dtype the draws cast to,
+        e.g. PredictionDraws' float32 ranks); a None draw-id array is not
+        written. With workers > 1 the shared block takes the same dtypes
+        and is copied into `out` once the pool is done.
+    """
+    if ndraw < 1:
+        raise ValueError("ndraw must be >= 1")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be >= 1")
+    if hurdle and len(engines) % 2:
+        raise ValueError("hurdle=True needs (class, rank) engine pairs")
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    entropy = seed if seed is not None else np.random.SeedSequence().entropy
+    settings = dict(
+        entropy=entropy,
+        include_group_specific=include_group_specific,
+        sample_new_groups=sample_new_groups,
+        hurdle=hurdle,
+    )
+
+    N = len(data)
+    label = list(names) if names is not None else list(range(len(engines)))
+    encoded = []
+    for j, e in enumerate(engines):
+        with tracer.stage("encode", model=label[j], rows=N):
+            encoded.append(e.encode(data))
+    if out is None:
+        out = [
+            (np.empty((ndraw, N), dtype=np.int8 if e.family == "bernoulli" else np.float64),
+             np.empty((ndraw, N), dtype=np.int32))
+            for e in engines
+        ]
+    elif len(out) != len(engines):
+        raise ValueError("out needs one (y, draw ids) pair per engine")
+
+    if hurdle:
+        # tasks run per pair; events are labelled "<class>+<rank>"
+        label = [f"{label[2 * p]}+{label[2 * p + 1]}" for p in range(len(engines) // 2)]
+    tasks = [
+        (k, j, c, start, min(start + chunk_size, N))
+        for k in range(ndraw)
+        for j in range(len(label))
+        for c, start in enumerate(range(0, N, chunk_size))
+    ]
+
+    ys, ids = [y for y, _ in out], [d for _, d in out]
+
+    if workers == 1:
+        _set_state(list(engines), encoded, list(out), settings)
+        try:
+            for task in tasks:
+                with tracer.stage("sample", **_task_fields(task, label)):
+                    _run_task(task)
+        finally:
+            _STATE.clear()
+        return ys, ids
+
+    empty = {}
+    for j, (y, d) in enumerate(out):
+        empty[f"y/{j}"] = ((ndraw, N), y.dtype.str)
+        if d is not None:
+            empty[f"draw/{j}"] = ((ndraw, N), d.dtype.str)
+
+    shared, metas, encoded_keys = _share(engines, encoded, empty)
+    del encoded
+    try:
+        _pool_map(_run_task, tasks, shared, metas, encoded_keys, settings, workers,
+                  tracer=tracer, stage="sample", fields=partial(_task_fields, names=label))
+        for j, (y, d) in enumerate(out):
+            np.copyto(y, shared.arrays[f"y/{j}"])
+            if d is not None:
+                np.copyto(d, shared.arrays[f"draw/{j}"])
+    finally:
+        shared.close()
+    return ys, ids
+
+
+def sink_native(
+    engines: Sequence[PosteriorEngine],
+    data: pl.DataFrame,
+    sink: str,
+    *,
+    assemble: Callable[[pl.DataFrame, list], pl.DataFrame],
+    ndraw: int = 1,
+    seed: Optional[int] = None,
+    chunk_size: int = 50_000,
+    workers: int = 1,
+    include_group_specific: bool = True,
+    sample_new_groups: bool = False,
+    hurdle: bool = False,
+    tracer: Tracer = NULL_TRACER,
+) -> pl.LazyFrame:
+    """
+    Like run_native, but every finished (draw block, chunk) is assembled into
+    its output rows and written straight to
+
+        <sink>/draw_block=<k>/part-<chunk>.parquet
+
+    instead of being held in memory. Returns a LazyFrame over the dataset.
+
+    `assemble(base_chunk, [(y, draw_id) per engine])` builds the output rows;
+    it must be a module-level function so workers can unpickle it.
+
+    Notes:
+      - Uses the same task seeds as run_native, so the rows are identical to
+        the in-memory result for the same (seed, chunk_size).
+      - Peak memory per process is one chunk of output plus the encoded
+        frame, independent of ndraw. With workers > 1 the base frame is
+        spilled once to a temporary Parquet file (one row group per chunk)
+        that workers slice from.
+      - hurdle: as in run_native; rank results for rows drawn 0 are 0 with
+        draw id -1.
+      - tracer gets a "sink_task" stage per (draw block, chunk): sampling
+        every engine, assembling and writing the part file.
+    """
+    if ndraw < 1:
+        raise ValueError("ndraw must be >= 1")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be >= 1")
+    if hurdle and len(engines) % 2:
+        raise ValueError("hurdle=True needs (class, rank) engine pairs")
+    if not workers:
+        workers = os.cpu_count() or 1
+
+    prepare_sink(sink)
+
+    entropy = seed if seed is not None else np.random.SeedSequence().entropy
+    settings = dict(
+        entropy=entropy,
+        include_group_specific=include_group_specific,
+        sample_new_groups=sample_new_groups,
+        sink=sink,
+        assemble=assemble,
+        hurdle=hurdle,
+    )
+
+    N = data.height
+    encoded = [e.encode(data) for e in engines]
+    tasks = [
+        (k, c, start, min(start + chunk_size, N))
+        for k in range(ndraw)
+        for c, start in enumerate(range(0, N, chunk_size))
+    ]
+
+    if workers == 1:
+        _set_state(list(engines), encoded, None, settings)
+        _STATE["base"] = lambda start, stop: data.slice(start, stop - start)
+        try:
+            for task in tasks:
+                with tracer.stage("sink_task", **_sink_task_fields(task)):
+                    _run_sink_task(task)
+        finally:
+            _STATE.clear()
+        return scan_sink(sink)
+
+    tmp = tempfile.mkdtemp(prefix="predict_base_")
+    base_path = os.path.join(tmp, "base.parquet")
+    data.write_parquet(base_path, row_group_size=chunk_size)
+    settings["base_path"] = base_path
+
+    shared, metas, encoded_keys = _share(engines, encoded)
+    del encoded
+    try:
+        _pool_map(_run_sink_task, tasks, shared, metas, encoded_keys, settings, workers,
+                  tracer=tracer, stage="sink_task", fields=_sink_task_fields)
+    finally:
+        shared.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return scan_sink(sink)
@@ -0,0 +1,455 @@
+from __future__ import annotations
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import types
+from dataclasses import dataclass
+from typing import Callable, Dict, Mapping, Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+
+
+# kinds of artefact a stage can produce: what its function returns and how it is stored
+#   parquet: a pl.DataFrame / pl.LazyFrame   -> data.parquet, loaded as a DataFrame
+#   json:    anything json.dump takes        -> data.json
+#   dir:     the function writes into the out_dir it is given; loaded by `load`
+KINDS = ("parquet", "json", "dir")
+
+MANIFEST_FILE = "manifest.json"
+_DIGESTS_FILE = "_digests.json"
+_CHUNK = 1 << 20
+
+
+def _jsonable(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    if isinstance(obj, Artefact):
+        return {"stage": obj.stage, "key": obj.key}
+    return repr(obj)
+
+
+def _canonical(obj) -> str:
+    return json.dumps(obj, sort_keys=True, default=_jsonable)
+
+
+def _sha256_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def code_digest(obj) -> str:
+    """
+    Hash of a code dependency: a module (its source file), a function or
+    class (its source, so notebook-defined functions work too), or the
+    path of a source file.
+    """
+    if isinstance(obj, str):
+        with open(obj, "rb") as f:
+            return _sha256_bytes(f.read())
+    if isinstance(obj, types.ModuleType) and getattr(obj, "__file__", None):
+        with open(obj.__file__, "rb") as f:
+            return _sha256_bytes(f.read())
+    return _sha256_bytes(inspect.getsource(obj).encode())
+
+
+def _code_name(obj) -> str:
+    if isinstance(obj, str):
+        return os.path.basename(obj)
+    return getattr(obj, "__qualname__", None) or getattr(obj, "__name__", repr(obj))
+
+
+@dataclass(frozen=True)
+class Artefact:
+    """A finished stage output: <root>/<stage>/<key>/."""
+
+    stage: str
+    key: str
+    path: str
+    kind: str
+
+    def load(self, loader: Optional[Callable[[str], object]] = None):
+        """The stored value (parquet -> DataFrame, json -> object, dir -> loader(path) or the path)."""
+        if self.kind == "parquet":
+            return pl.read_parquet(os.path.join(self.path, "data.parquet"))
+        if self.kind == "json":
+            with open(os.path.join(self.path, "data.json")) as f:
+                return json.load(f)
+        return loader(self.path) if loader is not None else self.path
+
+    @property
+    def manifest(self) -> dict:
+        with open(os.path.join(self.path, MANIFEST_FILE)) as f:
+            return json.load(f)
+
+
+class Pipeline:
+    """
+    Content-addressed cache for pipeline stages (SIPP cleaning output ->
+    model fits -> prediction runs).
+
+    Each stage's key is the SHA-256 of everything it depends on:
+
+      files:    input files or directories, by content
+      params:   JSON-able settings (filters, sampler settings, seeds, ...)
+      code:     modules / functions / source files whose code shapes the
+                output (e.g. models for the fits, a notebook's cleaning
+                function)
+      upstream: the artefacts of earlier stages, by key
+
+    Its output lives in <root>/<stage>/<key>/. A stage runs only when no
+    artefact with that key exists, so after changing one recode only the
+    stages downstream of it rerun; anything else is a cache hit. Artefacts
+    are written to a temporary directory and renamed into place, so an
+    interrupted stage never looks finished.
+
+    Notes:
+      - File digests are remembered per (path, size, mtime) in
+        <root>/_digests.json, so multi-GB SIPP/ACS files are hashed once.
+      - Upstream artefacts enter the key by their own key, never by
+        re-hashing their contents.
+      - Old artefacts are kept (switching a parameter back is a cache hit);
+        prune() removes them, along with the partial directories of failed
+        "dir" runs.
+    """
+
+    def __init__(self, root: str, *, log: Optional[Callable[[str], None]] = print):
+        self.root = root
+        self.log = log
+        os.makedirs(root, exist_ok=True)
+        self._digests_path = os.path.join(root, _DIGESTS_FILE)
+        self._digests: Dict[str, dict] = {}
+        if os.path.exists(self._digests_path):
+            with open(self._digests_path) as f:
+                self._digests = json.load(f)
+
+    def _say(self, msg: str) -> None:
+        if self.log is not None:
+            self.log(msg)
+
+    def _file_digest(self, path: str) -> str:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        cached = self._digests.get(path)
+        if cached is not None and cached["stamp"] == stamp:
+            return cached["sha256"]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(_CHUNK), b""):
+                h.update(block)
+        self._digests[path] = {"stamp": stamp, "sha256": h.hexdigest()}
+        tmp = f"{self._digests_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._digests, f)
+        os.replace(tmp, self._digests_path)
+        return h.hexdigest()
+
+    def digest(self, path: str) -> str:
+        """Content hash of a file, or of a directory (relative paths + file hashes)."""
+        if not os.path.isdir(path):
+            return self._file_digest(path)
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                full = os.path.join(dirpath, name)
+                entries.append((os.path.relpath(full, path), self._file_digest(full)))
+        return _sha256_bytes(_canonical(entries).encode())
+
+    def inputs(
+        self,
+        stage: str,
+        *,
+        files: Union[Sequence[str], Mapping[str, str]] = (),
+        params: Optional[Mapping] = None,
+        code: Sequence = (),
+        upstream: Union[Sequence[Artefact], Mapping[str, Artefact]] = (),
+    ) -> dict:
+        """The recorded inputs of a stage (what its key is the hash of)."""
+        if not isinstance(files, Mapping):
+            files = {os.path.basename(os.path.normpath(p)): p for p in files}
+        if not isinstance(upstream, Mapping):
+            upstream = {a.stage: a for a in upstream}
+        return json.loads(_canonical({
+            "stage": stage,
+            "files": {name: self.digest(p) for name, p in files.items()},
+            "params": dict(params or {}),
+            "code": {_code_name(c): code_digest(c) for c in code},
+            "upstream": {name: a.key for name, a in upstream.items()},
+        }))
+
+    def _stage_dir(self, stage: str) -> str:
+        return os.path.join(self.root, stage)
+
+    def lookup(self, stage: str, key: str) -> Optional[Artefact]:
+        path = os.path.join(self._stage_dir(stage), key)
+        manifest = os.path.join(path, MANIFEST_FILE)
+        if not os.path.exists(manifest):
+            return None
+        with open(manifest) as f:
+            kind = json.load(f)["kind"]
+        return Artefact(stage, key, path, kind)
+
+    def latest(self, stage: str) -> Optional[Artefact]:
+        """The most recently built artefact of a stage, whatever its key."""
+        found = [a for a in (self.lookup(stage, k) for k in self._keys(stage)) if a is not None]
+        return max(found, key=lambda a: a.manifest["created"], default=None)
+
+    def _keys(self, stage: str) -> list:
+        d = self._stage_dir(stage)
+        return [k for k in os.listdir(d) if not k.startswith(".")] if os.path.isdir(d) else []
+
+    def _explain(self, stage: str, inputs: dict) -> str:
+        previous = self.latest(stage)
+        if previous is None:
+            return "no cached artefact"
+        before = previous.manifest["inputs"]
+        changed = [
+            f"{part}:{name}"
+            for part in ("files", "params", "code", "upstream")
+            for name in sorted(set(before.get(part, {})) | set(inputs[part]))
+            if before.get(part, {}).get(name) != inputs[part].get(name)
+        ]
+        return "changed " + ", ".join(changed) if changed else "forced"
+
+    def run(
+        self,
+        stage: str,
+        fn: Callable,
+        *,
+        kind: str = "parquet",
+        files: Union[Sequence[str], Mapping[str, str]] = (),
+        params: Optional[Mapping] = None,
+        code: Sequence = (),
+        upstream: Union[Sequence[Artefact], Mapping[str, Artefact]] = (),
+        force: bool = False,
+    ) -> Artefact:
+        """
+        The artefact of `stage` for these inputs, running fn only on a miss.
+
+        fn is called with no arguments for kind "parquet" / "json" and must
+        return the value to store; for kind "dir" it is called with the
+        directory to write into, which after a failed run still holds what
+        that run wrote (so fit_all picks up its checkpoints). Read upstream
+        artefacts inside fn (artefact.load()), so a cache hit never loads
+        them.
+
+        force: rebuild even when the artefact exists.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}")
+        inputs = self.inputs(stage, files=files, params=params, code=code, upstream=upstream)
+        key = _sha256_bytes(_canonical(inputs).encode())[:20]
+
+        found = self.lookup(stage, key)
+        if found is not None and not force:
+            self._say(f"[{stage}] cached ({key})")
+            return found
+
+        self._say(f"[{stage}] running ({self._explain(stage, inputs)})")
+        final = os.path.join(self._stage_dir(stage), key)
+        tmp = os.path.join(self._stage_dir(stage), f".partial-{key}")
+        if kind != "dir" or force:
+            shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp, exist_ok=True)
+        start = time.perf_counter()
+        try:
+            if kind == "dir":
+                fn(tmp)
+            elif kind == "json":
+                with open(os.path.join(tmp, "data.json"), "w") as f:
+                    json.dump(fn(), f, default=_jsonable)
+            else:
+                out = fn()
+                target = os.path.join(tmp, "data.parquet")
+                if isinstance(out, pl.LazyFrame):
+                    out.sink_parquet(target)
+                else:
+                    out.write_parquet(target)
+            with open(os.path.join(tmp, MANIFEST_FILE), "w") as f:
+                json.dump({"stage": stage, "key": key, "kind": kind, "inputs": inputs,
+                           "created": time.time(), "seconds": time.perf_counter() - start}, f, indent=1)
+        except BaseException:
+            # a "dir" stage keeps what it wrote, so checkpointing functions
+            # (fit.fit_all) resume on the next run
+            if kind != "dir":
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.replace(tmp, final)
+        self._say(f"[{stage}] done in {time.perf_counter() - start:.1f} s ({key})")
+        return Artefact(stage, key, final, kind)
+
+    def prune(self, stage: str, keep: int = 1) -> list:
+        """
+        Delete all but the `keep` most recent artefacts of a stage, and every
+        .partial-<key> directory a failed "dir" run left behind (its
+        checkpoints are lost, so that run starts over). Returns the removed
+        keys; partial directories are reported by name.
+        """
+        found = [a for a in (self.lookup(stage, k) for k in self._keys(stage)) if a is not None]
+        found.sort(key=lambda a: a.manifest["created"], reverse=True)
+        removed = []
+        for a in found[keep:]:
+            shutil.rmtree(a.path)
+            removed.append(a.key)
+        d = self._stage_dir(stage)
+        partials = [k for k in os.listdir(d) if k.startswith(".partial-")] if os.path.isdir(d) else []
+        for name in sorted(partials):
+            shutil.rmtree(os.path.join(d, name))
+            removed.append(name)
+        return removed
+
+
+def _library_versions(*names: str) -> dict:
+    import importlib.metadata as md
+
+    return {name: md.version(name) for name in names}
+
+
+def fit_stage(
+    pipe: Pipeline,
+    sipp_model: Artefact,
+    *,
+    models: Optional[Sequence[str]] = None,
+    cores: Optional[int] = None,
+    chains: int = 4,
+    settings: Optional[Mapping[str, Mapping]] = None,
+    random_seed: Optional[int] = None,
+    force: bool = False,
+) -> Artefact:
+    """
+    fit.fit_all on a cached model frame (an Artefact of kind "parquet", e.g.
+    the cleaning stage's sipp_model), keyed on the frame, the sampler
+    settings, the seed and the model code (models, design, fit) plus the
+    bambi / pymc versions. `cores` only changes speed, so it is not part of
+    the key.
+
+    Load with load_fits(artefact) -> ({name: InferenceData}, Encoding).
+    """
+    import design
+    import fit
+    import models as models_module
+
+    names = tuple(models or fit.MODEL_NAMES)
+    merged = {name: {**fit.FIT_SETTINGS[name], "chains": chains, **(settings or {}).get(name, {})}
+              for name in names}
+
+    def run(out_dir: str) -> None:
+        fit.fit_all(sipp_model.load(), out_dir, models=names, cores=cores, chains=chains,
+                    settings=settings, random_seed=random_seed)
+
+    return pipe.run(
+        "fit", run, kind="dir",
+        params={"models": names, "settings": merged, "random_seed": random_seed,
+                "versions": _library_versions("bambi", "pymc")},
+        code=(models_module, design, fit),
+        upstream={"sipp_model": sipp_model},
+        force=force,
+    )
+
+
+def load_fits(artefact: Artefact):
+    """({name: InferenceData}, Encoding) of a fit_stage artefact."""
+    import arviz as az
+
+    from design import Encoding
+    from fit import ENCODING_FILE, MODEL_NAMES, checkpoint_path
+
+    idata = {
+        name: az.from_netcdf(checkpoint_path(artefact.path, name))
+        for name in MODEL_NAMES
+        if os.path.exists(checkpoint_path(artefact.path, name))
+    }
+    return idata, Encoding.load(os.path.join(artefact.path, ENCODING_FILE))
+
+
+def predict_stage(
+    pipe: Pipeline,
+    population: Union[str, Artefact],
+    fits: Artefact,
+    sipp_model: Artefact,
+    *,
+    ndraw: int = 1,
+    seed: int = 0,
+    engine: str = "native",
+    chunk_size: int = 50_000,
+    workers: int = 1,
+    include_group_specific: bool = True,
+    sample_new_groups: bool = False,
+    force: bool = False,
+) -> Artefact:
+    """
+    predict_allmodels over a population (a Parquet file such as
+    ipums_post_stratification_<state>.parquet, or a "parquet" artefact)
+    with the fitted models of fit_stage, written as a sink dataset.
+
+    The key covers the population, both upstream artefacts, every setting
+    that changes the draws (ndraw, seed, engine, chunk_size, ...) and the
+    prediction code (predict, posterior, posterior_store, parallel, draws); `workers` does not change the output, so it is not
+    part of the key. A fixed seed is required: an unseeded run could not
+    be reproduced from its key.
+
+    Load with load_predictions(artefact) -> pl.LazyFrame.
+    """
+    import draws
+    import parallel
+    import posterior
+    import posterior_store
+    import predict
+    from fit import MODEL_NAMES
+
+    if seed is None:
+        raise ValueError("predict_stage needs a fixed seed")
+    files, upstream = {}, {"fit": fits, "sipp_model": sipp_model}
+    if isinstance(population, Artefact):
+        upstream["population"] = population
+    else:
+        files["population"] = population
+
+    def run(out_dir: str) -> None:
+        from models import create_models
+
+        sink = os.path.join(out_dir, "draws")
+        shutil.rmtree(sink, ignore_errors=True)  # left by a failed run
+        pop = population.load() if isinstance(population, Artefact) else pl.read_parquet(population)
+        idata, encoding = load_fits(fits)
+        built = dict(zip(MODEL_NAMES, create_models(sipp_model.load(), encoding)))
+        predict.predict_allmodels(
+            pop,
+            asset_class_model=built["any_asset"], asset_class_idata=idata["any_asset"],
+            asset_model=built["pr_asset"], asset_idata=idata["pr_asset"],
+            debt_class_model=built["any_debt"], debt_class_idata=idata["any_debt"],
+            debt_model=built["pr_debt"], debt_idata=idata["pr_debt"],
+            ndraw=ndraw, seed=seed, engine=engine, chunk_size=chunk_size, workers=workers,
+            include_group_specific=include_group_specific, sample_new_groups=sample_new_groups,
+            sink=sink,
+        )
+
+    return pipe.run(
+        "predict", run, kind="dir",
+        files=files,
+        params={"ndraw": ndraw, "seed": seed, "engine": engine, "chunk_size": chunk_size,
+                "include_group_specific": include_group_specific,
+                "sample_new_groups": sample_new_groups},
+        code=(predict, posterior, posterior_store, parallel, draws),
+        upstream=upstream,
+        force=force,
+    )
+
+
+def load_predictions(artefact: Artefact) -> pl.LazyFrame:
+    """The predict_allmodels rows of a predict_stage artefact (with draw_block)."""
+    from parallel import scan_sink
+
+    return scan_sink(os.path.join(artefact.path, "draws"))
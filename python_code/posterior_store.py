@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import json
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+from posterior import PosteriorEngine
+
+
+STORE_VERSION = 1
+INDEX_FILE = "index.json"
+DATA_FILE = "posterior.bin"
+
+# byte alignment of every array in a packed buffer (here and parallel.SharedArrays)
+ALIGN = 64
+
+
+def _common_columns(meta: dict, has_kappa: bool) -> list:
+    # column order of the packed (sample, param) matrix of scalar terms
+    cols = ["intercept"] + [f"numeric/{col}" for col in meta["numeric"]]
+    if has_kappa:
+        cols.append("kappa")
+    return cols
+
+
+def export_store(
+    engine: PosteriorEngine,
+    path: str,
+    *,
+    dtype=np.float32,
+    overwrite: bool = False,
+) -> str:
+    """
+    Write the posterior tables prediction needs to a memory-mappable store.
+
+    Layout of `path/`:
+      index.json     family, chain/draw counts, factor levels per column,
+                     group term factors/shapes, and (offset, shape, dtype) of
+                     every array in posterior.bin
+      posterior.bin  one file of 64-byte aligned, C-contiguous arrays:
+                       common               (sample, 1 + n_numeric [+ kappa])
+                       categorical/<col>    (sample, n_levels)
+                       group/<term>/values  (sample, n_groups)
+                       group/<term>/lookup  int32 factor codes -> group column
+
+    Only what from_idata keeps ends up here (no sampler stats, hyperparameters
+    or deterministics), and samples are rows, so gathering a handful of draws
+    touches only their pages.
+
+    Notes:
+      - dtype applies to the posterior values (float32 by default; the
+        predictive draws are insensitive to the ~1e-7 rounding).
+      - Build the engine with PosteriorEngine.from_bambi(model, idata) right
+        after fitting (or from a saved NetCDF plus model.data).
+    """
+    index_path = os.path.join(path, INDEX_FILE)
+    if os.path.exists(index_path) and not overwrite:
+        raise FileExistsError(f"posterior store already exists: {path}")
+    os.makedirs(path, exist_ok=True)
+
+    meta, tables = engine.to_arrays()
+    has_kappa = "kappa" in tables
+    common = _common_columns(meta, has_kappa)
+
+    arrays: Dict[str, np.ndarray] = {
+        "common": np.column_stack([np.asarray(tables[c], dtype=dtype) for c in common]),
+    }
+    for name, a in tables.items():
+        if name in common:
+            continue
+        if name.endswith("/lookup"):
+            arrays[name] = np.ascontiguousarray(a, dtype=np.int32)
+        else:
+            arrays[name] = np.ascontiguousarray(a, dtype=dtype)
+
+    spec: Dict[str, Tuple[int, Tuple[int, ...], str]] = {}
+    offset = 0
+    for name, a in arrays.items():
+        offset = -(-offset // ALIGN) * ALIGN
+        spec[name] = (offset, a.shape, a.dtype.str)
+        offset += a.nbytes
+
+    tmp = os.path.join(path, DATA_FILE + ".tmp")
+    with open(tmp, "wb") as f:
+        for name, a in arrays.items():
+            f.seek(spec[name][0])
+            f.write(a.tobytes())
+        f.truncate(max(offset, 1))
+    os.replace(tmp, os.path.join(path, DATA_FILE))
+
+    index = {
+        "version": STORE_VERSION,
+        "meta": meta,
+        "common": common,
+        "arrays": {name: [off, list(shape), dt] for name, (off, shape, dt) in spec.items()},
+    }
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+    return path
+
+
+def is_store(path) -> bool:
+    return isinstance(path, (str, os.PathLike)) and os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def open_store(path: str) -> PosteriorEngine:
+    """
+    Open a store written by export_store as a PosteriorEngine.
+
+    posterior.bin is memory-mapped read-only and every table is a view into
+    the mapping (no copies), so opening is O(index size) and only the pages
+    holding the sampled draws are ever read. Worker processes opening the
+    same store share the OS page cache.
+    """
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    if index.get("version") != STORE_VERSION:
+        raise ValueError(f"unsupported posterior store version {index.get('version')!r} in {path}")
+
+    data_path = os.path.join(path, DATA_FILE)
+    mm = np.memmap(data_path, dtype=np.uint8, mode="r") if os.path.getsize(data_path) else None
+
+    arrays: Dict[str, np.ndarray] = {}
+    for name, (offset, shape, dt) in index["arrays"].items():
+        arrays[name] = np.ndarray(tuple(shape), dtype=np.dtype(dt), buffer=mm, offset=offset)
+
+    common = arrays.pop("common")
+    for i, name in enumerate(index["common"]):
+        arrays[name] = common[:, i]
+
+    engine = PosteriorEngine.from_arrays(index["meta"], arrays)
+    engine.store = os.fspath(path)
+    return engine
+
+
+def resolve_engine(model, idata) -> PosteriorEngine:
+    """
+    PosteriorEngine for a (model, idata) pair as passed to predict_allmodels.
+
+    `idata` may be an arviz.InferenceData (unpacked with the model's
+    training data), an already built PosteriorEngine, or the path of a store
+    from export_store (model is then unused and may be None).
+    """
+    if isinstance(idata, PosteriorEngine):
+        return idata
+    if is_store(idata):
+        return open_store(idata)
+    if model is None:
+        raise ValueError("a bambi model is required unless idata is a posterior store or engine")
+    return PosteriorEngine.from_bambi(model, idata)
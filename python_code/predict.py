@@ -1,12 +1,22 @@
 from __future__ import annotations
 
-from typing import Optional, Tuple, List
+import os
+from typing import Optional, Sequence, Tuple, List, Union
 
 import numpy as np
 import pandas as pd
 import polars as pl
 import xarray as xr
 
+from draws import PredictionDraws
+from instrument import NULL_TRACER, Observer, Tracer, tracing
+from parallel import partition_path, prepare_sink, run_native, scan_sink, sink_native
+from posterior_store import is_store, resolve_engine
+
+
+# predict_allmodels' model order, as labelled in trace events
+MODEL_LABELS = ("any_asset", "pr_asset", "any_debt", "pr_debt")
+
 
 def _posterior_predictive_draw_per_row(
     model,  # bambi.Model
@@ -19,6 +29,7 @@ def _posterior_predictive_draw_per_row(
     random_seed: Optional[int] = None,
     # NEW: memory control
     chunk_size: int = 50_000,
+    tracer: Tracer = NULL_TRACER,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """
     DROP-IN replacement (same signature + returns) that avoids allocating
@@ -34,8 +45,12 @@ def _posterior_predictive_draw_per_row(
       - draw_id is an integer index into the *flattened* (chain, draw) space:
             draw_id = chain_idx * n_draws + draw_idx
       - This is not "independent draw per row" across all N rows; it's "one draw
-        per chunk". It’s the only practical way to keep memory bounded at 1.7M rows.
+        per chunk". It’s the only practical way to keep memory bounded at 1.7M rows
+        through model.predict(); predict_allmodels(engine="native") uses
+        posterior.PosteriorEngine instead, which draws independently per row.
       - Increase/decrease chunk_size to balance speed vs RAM.
+      - tracer (instrument.Tracer) gets "isel", "predict" and "extract"
+        stages per chunk.
     """
     if chunk_size < 1:
         raise ValueError("chunk_size must be >= 1")
@@ -49,9 +64,10 @@ def _posterior_predictive_draw_per_row(
     N = len(new_data_pd)
 
     # Iterate over pandas slices to avoid copying the whole table repeatedly
-    for start in range(0, N, chunk_size):
+    for chunk, start in enumerate(range(0, N, chunk_size)):
         stop = min(start + chunk_size, N)
         chunk_pd = new_data_pd.iloc[start:stop]
+        traced = tracer.bind(chunk=chunk)
 
         # Pick one posterior draw for this chunk
         c = int(rng.integers(0, n_chain))
@@ -59,28 +75,31 @@ def _posterior_predictive_draw_per_row(
         flat_draw_id = c * n_draw + d
 
         # Reduce idata to a single draw to keep predict() tiny in memory
-        idata_1 = idata.isel(chain=[c], draw=[d])
-
-        pred_idata = model.predict(
-            idata_1,
-            kind="response",
-            data=chunk_pd,
-            inplace=False,
-            include_group_specific=include_group_specific,
-            sample_new_groups=sample_new_groups,
-            random_seed=random_seed,
-        )
-
-        pp_group = pred_idata.posterior_predictive
-        var_name = list(pp_group.data_vars)[0]
-        da: xr.DataArray = pp_group[var_name]
-
-        # Find the obs dimension name (not chain/draw)
-        obs_dim = [dim for dim in da.dims if dim not in ("chain", "draw")][0]
-
-        # For chain=1, draw=1 this is safe and small
-        # shape typically (1, 1, n_obs_chunk) -> flatten to (n_obs_chunk,)
-        y_chunk = np.asarray(da.transpose("chain", "draw", obs_dim).values).reshape(-1)
+        with traced.stage("isel"):
+            idata_1 = idata.isel(chain=[c], draw=[d])
+
+        with traced.stage("predict", rows=stop - start):
+            pred_idata = model.predict(
+                idata_1,
+                kind="response",
+                data=chunk_pd,
+                inplace=False,
+                include_group_specific=include_group_specific,
+                sample_new_groups=sample_new_groups,
+                random_seed=random_seed,
+            )
+
+        with traced.stage("extract", rows=stop - start):
+            pp_group = pred_idata.posterior_predictive
+            var_name = list(pp_group.data_vars)[0]
+            da: xr.DataArray = pp_group[var_name]
+
+            # Find the obs dimension name (not chain/draw)
+            obs_dim = [dim for dim in da.dims if dim not in ("chain", "draw")][0]
+
+            # For chain=1, draw=1 this is safe and small
+            # shape typically (1, 1, n_obs_chunk) -> flatten to (n_obs_chunk,)
+            y_chunk = np.asarray(da.transpose("chain", "draw", obs_dim).values).reshape(-1)
 
         ys.append(y_chunk)
         draw_ids.append(np.full((stop - start,), flat_draw_id, dtype=np.int32))
@@ -88,6 +107,27 @@ def _posterior_predictive_draw_per_row(
     return np.concatenate(ys, axis=0), np.concatenate(draw_ids, axis=0)
 
 
+def _posterior_predictive_hurdle(
+    model,  # bambi.Model
+    idata,  # arviz.InferenceData
+    new_data_pd: pd.DataFrame,
+    flags: np.ndarray,
+    **kwargs,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The rank part of a hurdle: _posterior_predictive_draw_per_row on the
+    rows whose class draw (`flags`) is 1 only; 0 with draw_id -1 elsewhere.
+    """
+    held = np.flatnonzero(flags == 1)
+    y = np.zeros(len(flags), dtype=np.float64)
+    draw_ids = np.full(len(flags), -1, dtype=np.int32)
+    if held.size:
+        y[held], draw_ids[held] = _posterior_predictive_draw_per_row(
+            model, idata, new_data_pd.iloc[held], **kwargs
+        )
+    return y, draw_ids
+
+
 def predict_allmodels(
     data: pl.DataFrame,
     *,
@@ -105,90 +145,510 @@ def predict_allmodels(
     sample_new_groups: bool = False,
     # NEW: control memory/speed tradeoff
     chunk_size: int = 50_000,
-) -> pl.DataFrame:
+    engine: str = "bambi",
+    workers: int = 1,
+    sink: Optional[str] = None,
+    compact: bool = False,
+    hurdle: bool = False,
+    observer: Union[None, Observer, Tracer] = None,
+    trace: Optional[str] = None,
+) -> Union[pl.DataFrame, pl.LazyFrame, PredictionDraws]:
     """
     DROP-IN replacement for your current predict_allmodels() that avoids the
     50+ GiB allocation by chunking + selecting a single posterior draw per chunk.
 
     Output columns match your version:
       any_asset, asset_pred, asset_draw, any_debt, debt_pred, debt_draw
+
+    engine:
+      - "bambi":  model.predict() per chunk, one posterior draw per chunk
+      - "native": posterior.PosteriorEngine, an independent posterior draw per
+                  row straight from the posterior arrays (no design matrices)
+
+    workers (native engine only):
+      number of processes the (draw block, model, chunk) tasks are spread
+      over, sharing posterior arrays and the encoded frame through shared
+      memory (see parallel.run_native). 0 uses every core. Results are
+      identical for a given seed and chunk_size whatever the worker count.
+
+    sink:
+      directory for a streaming Parquet dataset. Each finished (draw block,
+      chunk) is written to <sink>/draw_block=<k>/part-<chunk>.parquet as soon
+      as it is done and a pl.LazyFrame over the dataset is returned (with a
+      draw_block column even for ndraw=1). Peak memory is then one chunk of
+      output regardless of ndraw. The directory must be empty or missing.
+
+    compact:
+      return a draws.PredictionDraws instead of a long frame: the covariates
+      once (with a row_id) plus a (ndraw, N) array per prediction column
+      (int8 flags, float32 ranks, int32 draw ids). Rows for a block are joined
+      back on demand and per-draw group summaries are vectorized, so 100+
+      draws cost ~14 bytes per row per draw (engine="native" samples straight
+      into these arrays; with workers > 1 they are filled from a shared block
+      of the same size). Not combinable with sink.
+
+    With engine="native" each *_idata may also be the path of a store written
+    by posterior_store.export_store (the matching *_model can then be None):
+    the posterior is memory-mapped instead of deserialized from NetCDF.
+
+    hurdle:
+      evaluate each class/rank pair as one two-part predictor: draw
+      any_asset (any_debt) first, then run the asset (debt) rank model only
+      on the rows drawn 1, within the same task. Output keeps the zeros for
+      class 0, but asset_draw/debt_draw are -1 there (no rank sample was
+      taken). With engine="native" the class columns are identical to
+      hurdle=False for the same seed and chunk_size; the rank columns are
+      equally distributed, not equal. The saving is the class-0 share of
+      the rank-model work.
+
+    observer / trace:
+      stage-level instrumentation (see instrument.Tracer). `observer` is
+      called with one event dict per finished stage (or is a Tracer shared
+      across calls); `trace` writes the same events to a JSON-lines file.
+      Events carry stage, model, draw_block, chunk, rows, seconds,
+      rows_per_s and RSS (rss_mb, rss_delta_mb), e.g.
+        bambi:  to_pandas, then per model and block "draw" with per-chunk
+                isel / predict / extract inside it
+        native: resolve_engine and encode per model, "sample" per
+                (block, model, chunk)
+        both:   "assemble" per block, "concat", and one "predict_allmodels"
+                event for the whole call.
+      Off by default, at the cost of one no-op call per stage.
     """
     rng = np.random.default_rng(seed)
 
     if ndraw < 1:
         raise ValueError("ndraw must be >= 1")
-
-    # Convert once for Bambi
-    base_pd = data.to_pandas()
-
-    out_frames = []
-
-    for k in range(ndraw):
-        block_seed = None if seed is None else (seed + k)
-
-        any_asset, _ = _posterior_predictive_draw_per_row(
-            asset_class_model,
-            asset_class_idata,
-            base_pd,
+    if engine not in ("bambi", "native"):
+        raise ValueError("engine must be 'bambi' or 'native'")
+    if engine == "bambi" and workers != 1:
+        raise ValueError("workers is only supported with engine='native'")
+    if compact and sink is not None:
+        raise ValueError("compact and sink are mutually exclusive")
+
+    models = [
+        (asset_class_model, asset_class_idata),
+        (asset_model, asset_idata),
+        (debt_class_model, debt_class_idata),
+        (debt_model, debt_idata),
+    ]
+    if engine == "bambi" and any(is_store(i) for _, i in models):
+        raise ValueError("posterior stores can only be used with engine='native'")
+
+    with tracing(observer, trace) as tracer, \
+            tracer.stage("predict_allmodels", engine=engine, rows=data.height * ndraw):
+        return _predict_allmodels(
+            data,
+            models,
             rng=rng,
+            ndraw=ndraw,
+            seed=seed,
             include_group_specific=include_group_specific,
             sample_new_groups=sample_new_groups,
-            random_seed=block_seed,
             chunk_size=chunk_size,
+            engine=engine,
+            workers=workers,
+            sink=sink,
+            compact=compact,
+            hurdle=hurdle,
+            tracer=tracer,
         )
 
-        asset_pred, asset_draw = _posterior_predictive_draw_per_row(
-            asset_model,
-            asset_idata,
-            base_pd,
+
+def _predict_allmodels(
+    data: pl.DataFrame,
+    models,
+    *,
+    rng: np.random.Generator,
+    ndraw: int,
+    seed: Optional[int],
+    include_group_specific: bool,
+    sample_new_groups: bool,
+    chunk_size: int,
+    engine: str,
+    workers: int,
+    sink: Optional[str],
+    compact: bool,
+    hurdle: bool,
+    tracer: Tracer,
+) -> Union[pl.DataFrame, pl.LazyFrame, PredictionDraws]:
+    if sink is not None:
+        return _sink_allmodels(
+            data,
+            models,
+            sink,
+            engine=engine,
             rng=rng,
+            ndraw=ndraw,
+            seed=seed,
+            chunk_size=chunk_size,
+            workers=workers,
             include_group_specific=include_group_specific,
             sample_new_groups=sample_new_groups,
-            random_seed=block_seed,
-            chunk_size=chunk_size,
+            hurdle=hurdle,
+            tracer=tracer,
         )
 
-        any_debt, _ = _posterior_predictive_draw_per_row(
-            debt_class_model,
-            debt_class_idata,
-            base_pd,
-            rng=rng,
+    compact_out = PredictionDraws.empty(data, ndraw) if compact else None
+
+    if engine == "native":
+        # unpack each posterior once; the lookup tables are reused for every block
+        engines = []
+        for name, (m, i) in zip(MODEL_LABELS, models):
+            with tracer.stage("resolve_engine", model=name):
+                engines.append(resolve_engine(m, i))
+        out = None
+        if compact_out is not None:
+            # draws land in the compact arrays themselves (class draw ids are dropped)
+            out = [
+                (compact_out.any_asset, None),
+                (compact_out.asset_pred, compact_out.asset_draw),
+                (compact_out.any_debt, None),
+                (compact_out.debt_pred, compact_out.debt_draw),
+            ]
+        ys, ids = run_native(
+            engines,
+            data,
+            ndraw=ndraw,
+            seed=seed,
+            chunk_size=chunk_size,
+            workers=workers,
             include_group_specific=include_group_specific,
             sample_new_groups=sample_new_groups,
-            random_seed=block_seed,
-            chunk_size=chunk_size,
+            hurdle=hurdle,
+            tracer=tracer,
+            names=MODEL_LABELS,
+            out=out,
         )
+        if compact_out is not None:
+            if not hurdle:
+                # same zeroing as _with_predictions (a hurdle's rank draws are already zero)
+                for k in range(ndraw):
+                    with tracer.stage("assemble", draw_block=k, rows=data.height):
+                        compact_out.asset_pred[k][compact_out.any_asset[k] == 0] = 0.0
+                        compact_out.debt_pred[k][compact_out.any_debt[k] == 0] = 0.0
+            return compact_out
+
+        def draw(j: int, k: int, block_seed: Optional[int], flags=None) -> Tuple[np.ndarray, np.ndarray]:
+            return ys[j][k], ids[j][k]
+    else:
+        # Convert once for Bambi
+        with tracer.stage("to_pandas", rows=data.height):
+            base_pd = data.to_pandas()
+
+        def draw(j: int, k: int, block_seed: Optional[int], flags=None) -> Tuple[np.ndarray, np.ndarray]:
+            model, idata = models[j]
+            kwargs = dict(
+                rng=rng,
+                include_group_specific=include_group_specific,
+                sample_new_groups=sample_new_groups,
+                random_seed=block_seed,
+                chunk_size=chunk_size,
+                tracer=tracer.bind(model=MODEL_LABELS[j], draw_block=k),
+            )
+            with tracer.stage("draw", model=MODEL_LABELS[j], draw_block=k, rows=data.height):
+                if hurdle and flags is not None:
+                    return _posterior_predictive_hurdle(model, idata, base_pd, flags, **kwargs)
+                return _posterior_predictive_draw_per_row(model, idata, base_pd, **kwargs)
 
-        debt_pred, debt_draw = _posterior_predictive_draw_per_row(
-            debt_model,
-            debt_idata,
-            base_pd,
-            rng=rng,
+    out_frames = []
+
+    for k in range(ndraw):
+        block_seed = None if seed is None else (seed + k)
+
+        any_asset, _ = draw(0, k, block_seed)
+        asset_pred, asset_draw = draw(1, k, block_seed, any_asset)
+        any_debt, _ = draw(2, k, block_seed)
+        debt_pred, debt_draw = draw(3, k, block_seed, any_debt)
+
+        if compact_out is not None:
+            # same zeroing as _with_predictions, written straight into the block
+            # (a hurdle's rank draws are already zero for class 0)
+            with tracer.stage("assemble", draw_block=k, rows=data.height):
+                compact_out.set_block(
+                    k,
+                    any_asset=any_asset,
+                    asset_pred=asset_pred if hurdle else np.where(any_asset == 0, 0.0, asset_pred),
+                    asset_draw=asset_draw,
+                    any_debt=any_debt,
+                    debt_pred=debt_pred if hurdle else np.where(any_debt == 0, 0.0, debt_pred),
+                    debt_draw=debt_draw,
+                )
+            continue
+
+        with tracer.stage("assemble", draw_block=k, rows=data.height):
+            df_k = _with_predictions(
+                data, any_asset, asset_pred, asset_draw, any_debt, debt_pred, debt_draw,
+                zeroed=hurdle,
+            )
+
+            if ndraw > 1:
+                df_k = df_k.with_columns(pl.lit(k).alias("draw_block").cast(pl.Int32))
+
+        out_frames.append(df_k)
+
+    if compact_out is not None:
+        return compact_out
+
+    if ndraw == 1:
+        return out_frames[0]
+    with tracer.stage("concat", rows=data.height * ndraw):
+        return pl.concat(out_frames, how="vertical")
+
+
+def _sink_allmodels(
+    data: pl.DataFrame,
+    models,
+    sink: str,
+    *,
+    engine: str,
+    rng: np.random.Generator,
+    ndraw: int,
+    seed: Optional[int],
+    chunk_size: int,
+    workers: int,
+    include_group_specific: bool,
+    sample_new_groups: bool,
+    hurdle: bool = False,
+    tracer: Tracer = NULL_TRACER,
+) -> pl.LazyFrame:
+    if engine == "native":
+        engines = []
+        for name, (m, i) in zip(MODEL_LABELS, models):
+            with tracer.stage("resolve_engine", model=name):
+                engines.append(resolve_engine(m, i))
+        return sink_native(
+            engines,
+            data,
+            sink,
+            assemble=_assemble_chunk,
+            ndraw=ndraw,
+            seed=seed,
+            chunk_size=chunk_size,
+            workers=workers,
             include_group_specific=include_group_specific,
             sample_new_groups=sample_new_groups,
-            random_seed=block_seed,
-            chunk_size=chunk_size,
+            hurdle=hurdle,
+            tracer=tracer,
         )
 
-        # Match your R semantics: treat any_asset/any_debt as 0/1 and zero-out preds when class=0
-        any_asset_i = any_asset.astype(np.int8)
-        any_debt_i = any_debt.astype(np.int8)
+    prepare_sink(sink)
+    N = data.height
+    for k in range(ndraw):
+        block_seed = None if seed is None else (seed + k)
+        for c, start in enumerate(range(0, N, chunk_size)):
+            traced = tracer.bind(draw_block=k, chunk=c)
+            chunk = data.slice(start, chunk_size)
+            with traced.stage("to_pandas", rows=chunk.height):
+                chunk_pd = chunk.to_pandas()
+            results = []
+            # one model.predict call per model here, so "draw" is the chunk's time
+            for j, (name, (model, idata)) in enumerate(zip(MODEL_LABELS, models)):
+                kwargs = dict(
+                    rng=rng,
+                    include_group_specific=include_group_specific,
+                    sample_new_groups=sample_new_groups,
+                    random_seed=block_seed,
+                    chunk_size=chunk_size,
+                )
+                with traced.stage("draw", model=name, rows=chunk.height):
+                    if hurdle and j % 2:
+                        # rank model of the pair: only the rows its class draw kept
+                        results.append(_posterior_predictive_hurdle(
+                            model, idata, chunk_pd, results[j - 1][0], **kwargs))
+                    else:
+                        results.append(_posterior_predictive_draw_per_row(model, idata, chunk_pd, **kwargs))
+            path = partition_path(sink, k, c)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with traced.stage("write", rows=chunk.height):
+                _assemble_chunk(chunk, results).write_parquet(path)
+    return scan_sink(sink)
+
+
+def _with_predictions(
+    base: pl.DataFrame,
+    any_asset: np.ndarray,
+    asset_pred: np.ndarray,
+    asset_draw: np.ndarray,
+    any_debt: np.ndarray,
+    debt_pred: np.ndarray,
+    debt_draw: np.ndarray,
+    *,
+    zeroed: bool = False,
+) -> pl.DataFrame:
+    # Match your R semantics: treat any_asset/any_debt as 0/1 and zero-out preds when class=0
+    any_asset_i = any_asset.astype(np.int8)
+    any_debt_i = any_debt.astype(np.int8)
 
+    # zeroed: hurdle draws, where the rank is already 0 for class 0
+    if not zeroed:
         asset_pred = np.where(any_asset_i == 0, 0.0, asset_pred)
         debt_pred = np.where(any_debt_i == 0, 0.0, debt_pred)
 
-        df_k = data.with_columns(
-            pl.Series("any_asset", any_asset_i).cast(pl.Int8),
-            pl.Series("asset_pred", asset_pred).cast(pl.Float64),
-            pl.Series("asset_draw", asset_draw).cast(pl.Int32),
-            pl.Series("any_debt", any_debt_i).cast(pl.Int8),
-            pl.Series("debt_pred", debt_pred).cast(pl.Float64),
-            pl.Series("debt_draw", debt_draw).cast(pl.Int32),
-        )
+    return base.with_columns(
+        pl.Series("any_asset", any_asset_i).cast(pl.Int8),
+        pl.Series("asset_pred", asset_pred).cast(pl.Float64),
+        pl.Series("asset_draw", asset_draw).cast(pl.Int32),
+        pl.Series("any_debt", any_debt_i).cast(pl.Int8),
+        pl.Series("debt_pred", debt_pred).cast(pl.Float64),
+        pl.Series("debt_draw", debt_draw).cast(pl.Int32),
+    )
+
+
+def _assemble_chunk(base: pl.DataFrame, results: Sequence[Tuple[np.ndarray, np.ndarray]]) -> pl.DataFrame:
+    """results: (y, draw_id) per model, in predict_allmodels' model order."""
+    (any_asset, _), (asset_pred, asset_draw), (any_debt, _), (debt_pred, debt_draw) = results
+    return _with_predictions(base, any_asset, asset_pred, asset_draw, any_debt, debt_pred, debt_draw)
+
+
+def collapse_cells(
+    data: pl.DataFrame,
+    columns: Sequence[str],
+    *,
+    weight: Optional[str] = "WGT",
+) -> pl.DataFrame:
+    """
+    Deduplicate `data` to its unique covariate patterns ("cells").
+
+    Weights are summed per cell into a WGT column; with weight=None every row
+    counts as one unit (e.g. a frame that was already uncount()-ed). Adds a
+    cell_id row index.
+    """
+    w = pl.col(weight).sum() if weight is not None else pl.len()
+    return (data
+            .group_by(list(columns), maintain_order=True)
+            .agg(w.cast(pl.Float64).alias("WGT"))
+            .with_row_index("cell_id")
+           )
+
+
+def predict_allmodels_cells(
+    data: pl.DataFrame,
+    *,
+    asset_class_model,
+    asset_class_idata,
+    asset_model,
+    asset_idata,
+    debt_class_model,
+    debt_class_idata,
+    debt_model,
+    debt_idata,
+    weight: Optional[str] = "WGT",
+    by: Sequence[str] = (),
+    ndraw: int = 1,
+    seed: Optional[int] = None,
+    include_group_specific: bool = True,
+    sample_new_groups: bool = False,
+    expand: bool = True,
+) -> pl.DataFrame:
+    """
+    Cell-collapsed post-stratification: replaces uncount(WGT) + predict_allmodels.
+
+    `data` is collapsed to unique patterns of the model covariates (plus any
+    `by` columns to carry along, e.g. PUMA) with summed weights, and each model
+    is evaluated once per cell through posterior.PosteriorEngine. Model work
+    and memory scale with the number of cells, not the population.
+
+    expand=True:
+        per-unit outcomes are drawn from the cell predictions, round(WGT) rows
+        per cell, with the same columns as predict_allmodels:
+          any_asset, asset_pred, asset_draw, any_debt, debt_pred, debt_draw
+        Only these cheap Bernoulli/Beta draws scale with the population.
+    expand=False:
+        one row per cell with WGT and the cell-level response params:
+          p_any_asset, asset_mu, asset_draw, p_any_debt, debt_mu, debt_draw
+        (see summarize_cells for weighted summaries).
+
+    Notes:
+      - Within a draw block every unit of a cell shares the cell's posterior
+        sample (the old "one draw per chunk" compromise, at cell level);
+        different cells and blocks draw independently.
+      - With ndraw > 1 a draw_block column is added, as in predict_allmodels.
+    """
+    if ndraw < 1:
+        raise ValueError("ndraw must be >= 1")
+
+    rng = np.random.default_rng(seed)
+
+    engines = [
+        resolve_engine(asset_class_model, asset_class_idata),
+        resolve_engine(asset_model, asset_idata),
+        resolve_engine(debt_class_model, debt_class_idata),
+        resolve_engine(debt_model, debt_idata),
+    ]
+
+    needed = {c for e in engines for c in e.columns}
+    columns = list(by) + [c for c in data.columns if c in needed and c not in by]
+    cells = collapse_cells(data, columns, weight=weight)
+    encoded = [e.encode(cells) for e in engines]
+
+    if expand:
+        counts = np.rint(cells["WGT"].to_numpy()).astype(np.int64)
+        if (counts < 0).any():
+            raise ValueError("weights must be non-negative")
+        rows = np.repeat(np.arange(cells.height), counts)
+        base = cells.drop("WGT").select(pl.all().gather(rows))
+
+    out_frames = []
+
+    for k in range(ndraw):
+        mus, draws = [], []
+        for e, enc in zip(engines, encoded):
+            d = rng.integers(0, e.n_samples, size=cells.height)
+            mus.append(
+                e.mean(
+                    enc,
+                    d,
+                    include_group_specific=include_group_specific,
+                    sample_new_groups=sample_new_groups,
+                    rng=rng,
+                )
+            )
+            draws.append(d)
+
+        if expand:
+            df_k = _assemble_chunk(
+                base,
+                [(e.sample_response(mu[rows], d[rows], rng), d[rows])
+                 for e, mu, d in zip(engines, mus, draws)],
+            )
+        else:
+            df_k = cells.with_columns(
+                pl.Series("p_any_asset", mus[0]).cast(pl.Float64),
+                pl.Series("asset_mu", mus[1]).cast(pl.Float64),
+                pl.Series("asset_draw", draws[1]).cast(pl.Int32),
+                pl.Series("p_any_debt", mus[2]).cast(pl.Float64),
+                pl.Series("debt_mu", mus[3]).cast(pl.Float64),
+                pl.Series("debt_draw", draws[3]).cast(pl.Int32),
+            )
 
         if ndraw > 1:
             df_k = df_k.with_columns(pl.lit(k).alias("draw_block").cast(pl.Int32))
 
         out_frames.append(df_k)
 
-    return pl.concat(out_frames, how="vertical") if ndraw > 1 else out_frames[0]
\ No newline at end of file
+    return pl.concat(out_frames, how="vertical") if ndraw > 1 else out_frames[0]
+
+
+def summarize_cells(cell_preds: pl.DataFrame, by: Sequence[str] = ()) -> pl.DataFrame:
+    """
+    Weighted summaries straight from predict_allmodels_cells(expand=False).
+
+      share_any_asset / share_any_debt: weighted share predicted to hold any
+      assets / debts; asset_rank_mean / debt_rank_mean: weighted mean
+      predicted percent rank among those holders.
+    """
+    keys = list(by) + (["draw_block"] if "draw_block" in cell_preds.columns else [])
+    w = pl.col("WGT")
+    exprs = [
+        w.sum().alias("WGT"),
+        ((w * pl.col("p_any_asset")).sum() / w.sum()).alias("share_any_asset"),
+        ((w * pl.col("p_any_asset") * pl.col("asset_mu")).sum()
+         / (w * pl.col("p_any_asset")).sum()).alias("asset_rank_mean"),
+        ((w * pl.col("p_any_debt")).sum() / w.sum()).alias("share_any_debt"),
+        ((w * pl.col("p_any_debt") * pl.col("debt_mu")).sum()
+         / (w * pl.col("p_any_debt")).sum()).alias("debt_rank_mean"),
+    ]
+    if not keys:
+        return cell_preds.select(exprs)
+    return cell_preds.group_by(keys, maintain_order=True).agg(exprs).sort(keys)
@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Mapping, Sequence, Tuple, Union
+
+import polars as pl
+
+from sipp import REFERENCE_PERSON
+
+
+HOUSEHOLD = ("SSUID", "SHHADID")
+PERSON = ("SSUID", "PNUM")
+
+_OPS = {"==": "eq", "!=": "ne", ">": "gt", ">=": "ge", "<": "lt", "<=": "le", "in": "is_in"}
+
+# a flag term: (column, op, value), or a tuple of terms that must all hold
+Term = Union[Tuple[str, str, Any], Tuple["Term", ...]]
+
+
+def _bin_index(expr: pl.Expr, edges: Sequence[float]) -> pl.Expr:
+    # polars 2.x replaced cut with bin_intervals (labels=False gives the bin index)
+    if hasattr(pl.Expr, "bin_intervals"):
+        return expr.bin_intervals(list(edges), labels=False)
+    labels = [str(i) for i in range(len(edges) + 1)]
+    return expr.cut(list(edges), labels=labels, left_closed=True).cast(pl.String).cast(pl.Int64)
+
+
+@dataclass(frozen=True)
+class Bins:
+    """
+    Left-closed bins of `column`: code `start + i` for edges[i-1] <= x < edges[i]
+    (below edges[0] is `start`); nulls stay null.
+    """
+
+    column: str
+    edges: Tuple[float, ...]
+    start: int = 1
+
+    def expr(self) -> pl.Expr:
+        return (_bin_index(pl.col(self.column), self.edges) + self.start).cast(pl.Int8)
+
+
+@dataclass(frozen=True)
+class CodeMap:
+    """
+    Values of `column` to codes; anything unmapped (null included) becomes
+    `default`. Keys may be ranges or tuples of values sharing a code.
+    """
+
+    column: str
+    codes: Mapping[Any, Any]
+    default: Any = None
+    dtype: pl.DataType = pl.Int8
+
+    def expr(self) -> pl.Expr:
+        flat = {}
+        for key, code in self.codes.items():
+            for value in (key if isinstance(key, (range, tuple)) else (key,)):
+                flat[value] = code
+        return pl.col(self.column).replace_strict(flat, default=self.default, return_dtype=self.dtype)
+
+
+def _term(term: Term) -> pl.Expr:
+    if isinstance(term[0], tuple):
+        return pl.all_horizontal([_term(t) for t in term])
+    column, op, value = term
+    return getattr(pl.col(column), _OPS[op])(value)
+
+
+@dataclass(frozen=True)
+class AnyOf:
+    """True if any term holds; nulls count as not holding."""
+
+    terms: Tuple[Term, ...]
+
+    def expr(self) -> pl.Expr:
+        return pl.any_horizontal([_term(t) for t in self.terms]).fill_null(False)
+
+
+def _flag(condition: pl.Expr) -> pl.Expr:
+    return condition.fill_null(False).cast(pl.Int8)
+
+
+# --- code tables ------------------------------------------------------------
+# (hh_inc_yr is whole dollars, so the `<= 0` bin ends at 1)
+HH_INCOME = Bins("hh_inc_yr", (
+    1, 5_000, 15_000, 20_000, 25_000, 30_000, 35_000, 45_000, 55_000, 65_000,
+    75_000, 90_000, 105_000, 125_000, 150_000, 200_000, 500_000,
+))
+AGE = Bins("TAGE", (15, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85))
+# owners only; renters (ETENURE 2, 3) are code 1
+HOMEVALUE = Bins("THVAL_HOME", (50_000, 100_000, 300_000, 500_000, 750_000, 1_000_000), start=2)
+
+MALE = CodeMap("ESEX", {1: 1, 2: 0})
+EDU = CodeMap("EEDUC", {range(31, 39): 1, 39: 2, range(40, 43): 3, 43: 4, range(44, 47): 5})
+# non-Hispanic race; Hispanic (EORIGIN 1) is race_eth 3
+RACE = CodeMap("TRACE", {1: 1, 2: 2, 4: 4}, default=5)
+CITIZEN = CodeMap("ECITIZEN", {1: 1, 2: 0})
+DISABILITY = CodeMap("RDIS", {1: 1, 2: 0})
+ENGLISH_AT_HOME = CodeMap("ESPEAK", {1: 0, 2: 1})
+# first job's class of worker: self-employed (incorporated / not), wage and salary
+JOB_CLASS = CodeMap("EJB1_CLWRK", {7: 1, 8: 2, range(1, 7): 3})
+# household_type of a married / single person with children; +1 without children
+MARITAL = CodeMap("EMS", {(1, 2): 1, range(3, 7): 3})
+METRO = CodeMap("TEHC_METRO", {1: "metro", 2: "nonmetro"}, dtype=pl.String)
+OWNED_WITH_DEBT = CodeMap("EPRDEBT", {1: 2, 2: 1})
+
+BUSINESS_OWNER = AnyOf(tuple((f"EJB{j}_JBORSE", "==", 2) for j in range(1, 8)))
+ANY_DEBT = AnyOf((
+    *((c, "==", 1) for c in (
+        "EDEBT_CC", "EDEBT_MED", "EDEBT_ED", "EDEBT_OT", "EPRDEBT", "EMHDEBT",
+        "EVEH1DEBT", "EVEH2DEBT", "EVEH3DEBT", "EMCYCDEBT", "EBOATDEBT", "ERVDEBT", "EORECDEBT",
+    )),
+    ("TDEBT_BUS", ">", 0),
+))
+ANY_ASSET = AnyOf((
+    *((c, "==", 1) for c in (
+        "EOWN_TREQ", "EOWN_ANNEQ", "EOWN_BSI", "EOWN_BSJ", "EOWN_CD", "EOWN_CHK",
+        "EOWN_GOVS", "EOWN_IRAKEO",
+    )),
+    (("EOWN_LIFE", "==", 1), ("ELIFE_TYPE", "==", 1)),
+    *((c, "==", 1) for c in (
+        "EOWN_MCBD", "EOWN_MF", "EOWN_MM", "EOWN_OINV", "EOWN_RE", "EOWN_RP",
+        "EOWN_SAV", "EOWN_ST", "EOWN_THR401", "EOWN_ESAV", "EOWN_RECV",
+    )),
+    (("EOWN_VEH", "==", 1), ("TVEH_NUM", ">", 0)),
+    ("ETENURE", "==", 1),
+))
+
+# monthly amounts summed to person-year totals
+PERSON_YEAR_SUMS = {"TSSI_yr": "TSSI_AMT", "TTANF_yr": "TTANF_AMT", "TGA_yr": "TGA_AMT", "TSSS_yr": "TSSSAMT"}
+
+# kNN imputation predictors (VIM uses every column for the distance, keys included)
+RANKS = {"hh_income_rank": "hh_income", "edu_rank": "edu", "homevalue_rank": "homevalue", "age_rank": "age"}
+DUMMIES = {
+    "race_eth": {"white": [1], "black": [2], "hispanic": [3], "asian": [4], "other_race": [5]},
+    "ETENURE": {"own_home": [1]},
+    "class_worker": {"self_emp": [1, 2], "wage_salary_emp": [3], "not_employed": [4, 5]},
+    "household_type": {
+        "married_withkids": [1], "married_nokids": [2], "single_withkids": [3], "single_nokids": [4],
+    },
+}
+_RACE_DUMMIES = ("white", "black", "hispanic", "asian", "other_race")
+_WORK_AND_FAMILY = (
+    "disability", "self_emp", "wage_salary_emp", "not_employed",
+    "married_withkids", "married_nokids", "single_withkids", "single_nokids",
+    "english_at_home", "public_assistance", "social_security", "poverty",
+)
+METRO_PREDICTORS = (
+    "SSUID", "SHHADID", "state", "TEHC_METRO", "hh_income_rank", "male", "age_rank", "edu_rank",
+    *_RACE_DUMMIES, "own_home", "homevalue_rank", *_WORK_AND_FAMILY,
+)
+TENURE_PREDICTORS = (
+    "SSUID", "SHHADID", "state", "TEHC_METRO", "hh_income_rank", "male", "age_rank", "edu_rank",
+    *_RACE_DUMMIES, "owned_withdebt", *_WORK_AND_FAMILY,
+)
+
+
+# --- feature build ----------------------------------------------------------
+def _class_worker(sample_month: pl.Expr) -> pl.Expr:
+    in_month = pl.col("MONTHCODE") == sample_month
+    age = pl.col("TAGE")
+    job = pl.col("EJB1_JBORSE")
+    return (pl.when(in_month & (age >= 16) & job.is_in([1, 2, 3])).then(JOB_CLASS.expr())
+            .when(in_month & (age >= 65) & job.is_null()).then(4)
+            .when(in_month & age.is_between(16, 64) & job.is_null()).then(5)
+            .cast(pl.Int8))
+
+
+def _household_type() -> pl.Expr:
+    # a minor's own family is the household minus themself: married needs
+    # more than 2 people for children, single more than 1
+    size = pl.col("RHNUMPER")
+    kids = pl.col("child_sum") > 0
+    threshold = pl.when(MARITAL.expr() == 1).then(2).otherwise(1)
+    with_kids = (pl.when(pl.col("TAGE") >= 18).then(kids)
+                 .when((pl.col("TAGE") < 18) & kids & (size >= threshold)).then(size > threshold))
+    return (MARITAL.expr() + (~with_kids).cast(pl.Int8)).cast(pl.Int8)
+
+
+def sipp_features(
+    lf: Union[pl.LazyFrame, pl.DataFrame],
+    *,
+    month: int = 12,
+    seed: int = 0,
+) -> pl.LazyFrame:
+    """
+    The SIPP household feature build of the cleaning notebook as one lazy
+    plan: the `month` rows of every person, with the model covariates
+    (hh_income, age, male, edu, race_eth, citizen, disability, class_worker,
+    household_type, english_at_home, public_assistance, social_security,
+    poverty, homevalue, state) and the outcome flags (pp_any_debt,
+    pp_any_asset, hh_any_debt, hh_any_asset).
+
+    Recodes come from the code tables above (Bins, CodeMap, AnyOf). The
+    aggregates over all person-months (annual household income, welfare and
+    Social Security totals, class of worker, children) are one group-by at
+    person x household level, rolled up to persons and households and joined
+    to the `month` rows; the outcome sums are one group-by over those rows.
+
+    Notes:
+      - sample_month (the month class_worker is read from; 0 never matches,
+        as in the notebook) is drawn per household from a hash of its keys,
+        so a given `seed` reproduces it.
+      - child_sum, welfare_hh and ss_hh sum over person-months, as the
+        notebook's windows do; only their sign is used.
+    """
+    lf = lf.lazy()
+    grain = [*PERSON, "SHHADID"]
+    sample_month = (pl.struct(list(HOUSEHOLD)).hash(seed) % 13).cast(pl.Int8)
+
+    person_hh = (lf
+                 .with_columns(sample_month.alias("sample_month"))
+                 .with_columns(_class_worker(pl.col("sample_month")).alias("_cw"))
+                 .group_by(grain)
+                 .agg(
+                     pl.when(REFERENCE_PERSON).then(pl.col("THTOTINC")).sum().alias("hh_inc_yr"),
+                     pl.col("sample_month").first(),
+                     pl.len().alias("_months"),
+                     (pl.col("TAGE") < 18).sum().alias("_child_months"),
+                     pl.col("_cw").drop_nulls().last(),
+                     pl.col("MONTHCODE").filter(pl.col("_cw").is_not_null()).last().alias("_cw_month"),
+                     *(pl.col(src).cast(pl.Int64, strict=True).sum().alias(name)
+                       for name, src in PERSON_YEAR_SUMS.items()),
+                 )
+                )
+    person = (person_hh
+              .group_by(list(PERSON))
+              .agg(
+                  *(pl.col(name).sum() for name in PERSON_YEAR_SUMS),
+                  # last non-null by month, as the notebook's row-order last()
+                  pl.col("_cw").sort_by("_cw_month", nulls_last=False).last().alias("class_worker"),
+              )
+              .with_columns(
+                  welfare_pp=pl.col("TSSI_yr") + pl.col("TTANF_yr") + pl.col("TGA_yr"),
+                  ss_pp=pl.col("TSSS_yr"),
+              )
+             )
+    household = (person_hh
+                 .join(person.select(*PERSON, "welfare_pp", "ss_pp"), on=list(PERSON), how="left")
+                 .group_by(list(HOUSEHOLD))
+                 .agg(
+                     pl.col("_child_months").sum().alias("child_sum"),
+                     (pl.col("welfare_pp") * pl.col("_months")).sum().alias("welfare_hh"),
+                     (pl.col("ss_pp") * pl.col("_months")).sum().alias("ss_hh"),
+                 )
+                )
+
+    rows = (lf
+            .filter(pl.col("MONTHCODE") == month)
+            .join(person_hh.select(*grain, "hh_inc_yr", "sample_month"), on=grain,
+                  how="left", maintain_order="left")
+            .join(person, on=list(PERSON), how="left", maintain_order="left")
+            .join(household, on=list(HOUSEHOLD), how="left", maintain_order="left")
+            .with_columns(
+                hh_inc_over200k=_flag(pl.col("hh_inc_yr") >= 200_000),
+                hh_income=HH_INCOME.expr(),
+                age=AGE.expr(),
+                male=MALE.expr(),
+                edu=EDU.expr(),
+                race_eth=(pl.when(pl.col("EORIGIN") == 1).then(3)
+                          .when(pl.col("EORIGIN") == 2).then(RACE.expr())
+                          .cast(pl.Int8)),
+                citizen=CITIZEN.expr(),
+                disability=DISABILITY.expr(),
+                household_type=_household_type(),
+                english_at_home=ENGLISH_AT_HOME.expr(),
+                poverty=_flag(pl.col("TFINCPOV") <= 1),
+                public_assistance=_flag(pl.col("welfare_hh") > 0),
+                social_security=_flag(pl.col("ss_hh") > 0),
+                homevalue=(pl.when(pl.col("ETENURE").is_in([2, 3])).then(1)
+                           .otherwise(HOMEVALUE.expr())
+                           .cast(pl.Int8)),
+                state=pl.col("TEHC_ST"),
+                EOWN_BSJ=pl.when(BUSINESS_OWNER.expr()).then(1).cast(pl.Int8),
+            )
+            .with_columns(
+                pp_any_debt=_flag(pl.col("TLIVQTR").is_in([1, 2]) & ANY_DEBT.expr()),
+                pp_any_asset=_flag(pl.col("TLIVQTR").is_in([1, 2]) & ANY_ASSET.expr()),
+            )
+           )
+
+    holders = (rows
+               .group_by(list(HOUSEHOLD))
+               .agg(
+                   pl.col("pp_any_debt").sum().alias("sum_pp_debt"),
+                   pl.col("pp_any_asset").sum().alias("sum_pp_asset"),
+               )
+              )
+    return (rows
+            .join(holders, on=list(HOUSEHOLD), how="left", maintain_order="left")
+            .with_columns(
+                hh_any_debt=_flag(REFERENCE_PERSON & (pl.col("sum_pp_debt") > 0) & (pl.col("THDEBT_AST") > 0)),
+                hh_any_asset=_flag(REFERENCE_PERSON & (pl.col("sum_pp_asset") > 0) & (pl.col("THVAL_AST") > 0)),
+            )
+           )
+
+
+# --- kNN imputation frames -------------------------------------------------
+def impute_predictors(features: Union[pl.LazyFrame, pl.DataFrame], month: int = 12) -> pl.LazyFrame:
+    """
+    Reference persons of sipp_features with the shared kNN predictors
+    (RANKS aliases, DUMMIES 0/1 indicators, owned_withdebt), computed once
+    for both metro_impute_frame and tenure_impute_frame.
+    """
+    dummies = [
+        _flag(pl.col(column).is_in(values)).alias(name)
+        for column, levels in DUMMIES.items()
+        for name, values in levels.items()
+    ]
+    return (features.lazy()
+            .filter((pl.col("MONTHCODE") == month) & REFERENCE_PERSON)
+            .with_columns(
+                *(pl.col(src).alias(name) for name, src in RANKS.items()),
+                *dummies,
+                OWNED_WITH_DEBT.expr().alias("owned_withdebt"),
+            )
+           )
+
+
+def metro_impute_frame(predictors: pl.LazyFrame) -> pl.LazyFrame:
+    """Complete cases of METRO_PREDICTORS with metro_fct (null where TEHC_METRO is 0) to impute."""
+    return (predictors
+            .select(METRO_PREDICTORS)
+            .drop_nulls()
+            .with_columns(metro_fct=METRO.expr().cast(pl.Categorical))
+           )
+
+
+def tenure_impute_frame(predictors: pl.LazyFrame) -> pl.LazyFrame:
+    """Owner households with TENURE_PREDICTORS; owned_withdebt null where EPRDEBT is missing."""
+    other = pl.col("EPRDEBT").is_not_null() & ~pl.col("EPRDEBT").is_in([1, 2])
+    return (predictors
+            .filter((pl.col("ETENURE") == 1) & ~other)
+            .select(TENURE_PREDICTORS)
+            .drop_nulls(pl.exclude("owned_withdebt"))
+           )
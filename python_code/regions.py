@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional, Sequence, Union
+
+import numpy as np
+import polars as pl
+
+from draws import PredictionDraws
+from predict import collapse_cells, predict_allmodels, predict_allmodels_cells, summarize_cells
+from posterior_store import resolve_engine
+
+
+# a region: {column: allowed values}, e.g. {"STATEFIP": [22], "PUMA": [1500, 1600]},
+# or any boolean polars expression over the IPUMS frame
+RegionSpec = Union[pl.Expr, Mapping[str, Sequence]]
+
+
+def region_expr(spec: RegionSpec) -> pl.Expr:
+    """Row filter of a region: every column of a mapping must match (AND)."""
+    if isinstance(spec, pl.Expr):
+        return spec
+    if not spec:
+        raise ValueError("a region needs at least one column filter")
+    return pl.all_horizontal([pl.col(col).is_in(list(values)) for col, values in spec.items()])
+
+
+def region_members(data: pl.DataFrame, regions: Mapping[str, RegionSpec]) -> Dict[str, np.ndarray]:
+    """Row positions of `data` in each region (regions may overlap)."""
+    if not regions:
+        raise ValueError("no regions given")
+    masks = data.select(
+        region_expr(spec).fill_null(False).alias(f"_r{i}") for i, spec in enumerate(regions.values())
+    )
+    return {name: np.flatnonzero(masks[f"_r{i}"].to_numpy()) for i, name in enumerate(regions)}
+
+
+def _subset(draws: PredictionDraws, rows: np.ndarray) -> PredictionDraws:
+    return PredictionDraws(
+        covariates=draws.covariates[rows],
+        row_id=draws.row_id,
+        any_asset=draws.any_asset[:, rows],
+        asset_pred=draws.asset_pred[:, rows],
+        asset_draw=draws.asset_draw[:, rows],
+        any_debt=draws.any_debt[:, rows],
+        debt_pred=draws.debt_pred[:, rows],
+        debt_draw=draws.debt_draw[:, rows],
+    )
+
+
+@dataclass
+class RegionDraws:
+    """
+    One prediction pass over the union of several regions, with each
+    region's rows.
+
+    `draws` holds every person in at least one region exactly once and
+    `members` each region's row positions in it. group_summary and
+    group_intervals aggregate the shared arrays over those positions, a
+    block at a time, so a region costs its own aggregation and no copy of
+    the draws; its outputs are those of a prediction run on that region
+    alone.
+    """
+
+    draws: PredictionDraws
+    members: Dict[str, np.ndarray]
+
+    @property
+    def names(self) -> list:
+        return list(self.members)
+
+    def region(self, name: str) -> PredictionDraws:
+        """
+        The region's rows as their own PredictionDraws (row_id is kept from
+        the shared pass), for PredictionDraws.block, crosswalk.to_dollars,
+        GroupQuantileSketch.update_draws, ... This copies the region's
+        slice of every (ndraw, N) array; the summaries above do not need it.
+        """
+        return _subset(self.draws, self.members[name])
+
+    def group_summary(
+        self,
+        by: Sequence[str] = (),
+        *,
+        weight: Optional[str] = "WGT",
+        regions: Optional[Sequence[str]] = None,
+    ) -> pl.DataFrame:
+        """PredictionDraws.group_summary per region, stacked with a leading `region` column."""
+        return pl.concat([
+            self.draws.group_summary(by, weight=weight, rows=self.members[name])
+                .select(pl.lit(name).alias("region"), pl.all())
+            for name in (regions or self.names)
+        ])
+
+    def group_intervals(
+        self,
+        by: Sequence[str] = (),
+        *,
+        weight: Optional[str] = "WGT",
+        prob: float = 0.9,
+        regions: Optional[Sequence[str]] = None,
+    ) -> pl.DataFrame:
+        """PredictionDraws.group_intervals per region, with a leading `region` column."""
+        return pl.concat([
+            self.draws.group_intervals(by, weight=weight, prob=prob, rows=self.members[name])
+                .select(pl.lit(name).alias("region"), pl.all())
+            for name in (regions or self.names)
+        ])
+
+
+def predict_regions(
+    data: pl.DataFrame,
+    regions: Mapping[str, RegionSpec],
+    **kwargs,
+) -> RegionDraws:
+    """
+    Batch post-stratification for many named regions over one IPUMS frame
+    (metro PUMAs, parishes, the whole state, ...), with a single prediction
+    run:
+
+      regions = {
+          "new_orleans_msa": {"PUMA": NOmsa_pumacodes},
+          "orleans_parish":  {"PUMA": [2401, 2402]},
+          "louisiana":       {"STATEFIP": [22]},
+      }
+      out = predict_regions(ipums, regions, asset_class_model=..., ..., ndraw=50, seed=1)
+      out.group_intervals(["race_eth"])
+
+    Each person in any region is predicted once by
+    predict_allmodels(..., compact=True) (kwargs: the models, ndraw, seed,
+    engine, workers, hurdle, ...); people outside every region are not
+    predicted. Adding a region only adds its aggregation.
+    """
+    if kwargs.pop("compact", True) is not True or kwargs.get("sink") is not None:
+        raise ValueError("predict_regions needs compact=True and no sink")
+    members = region_members(data, regions)
+    union = np.unique(np.concatenate(list(members.values())))
+    positions = np.searchsorted(union, np.arange(data.height))
+    draws = predict_allmodels(data[union], compact=True, **kwargs)
+    return RegionDraws(draws=draws, members={name: positions[rows] for name, rows in members.items()})
+
+
+def predict_regions_cells(
+    data: pl.DataFrame,
+    regions: Mapping[str, RegionSpec],
+    *,
+    asset_class_model,
+    asset_class_idata,
+    asset_model,
+    asset_idata,
+    debt_class_model,
+    debt_class_idata,
+    debt_model,
+    debt_idata,
+    weight: Optional[str] = "WGT",
+    by: Sequence[str] = (),
+    ndraw: int = 1,
+    seed: Optional[int] = None,
+    include_group_specific: bool = True,
+    sample_new_groups: bool = False,
+) -> pl.DataFrame:
+    """
+    Cell-collapsed batch post-stratification: summarize_cells for every
+    region from one predict_allmodels_cells(expand=False) pass.
+
+    The union of all regions is collapsed to unique patterns of the model
+    covariates only, so a cell shared by several regions (or PUMAs) is
+    predicted once; each region then weights the cells by its own summed
+    weight in them.
+
+    Returns region, by..., (draw_block,) WGT, share_any_asset,
+    asset_rank_mean, share_any_debt, debt_rank_mean.
+
+    Notes:
+      - A cell's posterior draw is shared by every region containing it,
+        so differences between overlapping regions are not blurred by
+        independent draws.
+    """
+    # unpack each posterior once: predict_allmodels_cells takes the engines as they are
+    engines = [resolve_engine(asset_class_model, asset_class_idata), resolve_engine(asset_model, asset_idata),
+               resolve_engine(debt_class_model, debt_class_idata), resolve_engine(debt_model, debt_idata)]
+    models = dict(
+        asset_class_model=asset_class_model, asset_class_idata=engines[0],
+        asset_model=asset_model, asset_idata=engines[1],
+        debt_class_model=debt_class_model, debt_class_idata=engines[2],
+        debt_model=debt_model, debt_idata=engines[3],
+    )
+    needed = {c for e in engines for c in e.columns}
+    columns = [c for c in data.columns if c in needed]
+
+    members = region_members(data, regions)
+    union = np.unique(np.concatenate(list(members.values())))
+    people = data[union]
+    cells = collapse_cells(people, columns, weight=weight)
+
+    # cell of every person in the union (nulls are a level, as in group_by)
+    w = pl.col(weight).cast(pl.Float64) if weight is not None else pl.lit(1.0)
+    people = (people
+              .select(*columns, *[c for c in by if c not in columns], w.alias("WGT"))
+              .join(cells.select("cell_id", *columns), on=columns, how="left",
+                    nulls_equal=True, maintain_order="left")
+             )
+    positions = np.searchsorted(union, np.arange(data.height))
+    membership = (pl.concat([
+                      people[positions[rows]].select(pl.lit(name).alias("region"), "cell_id", *by, "WGT")
+                      for name, rows in members.items()
+                  ])
+                  .group_by(["region", *by, "cell_id"], maintain_order=True)
+                  .agg(pl.col("WGT").sum())
+                 )
+
+    # cells are already unique, so predict_allmodels_cells keeps their order and cell_id
+    preds = predict_allmodels_cells(
+        cells.drop("cell_id"),
+        **models,
+        weight="WGT",
+        ndraw=ndraw,
+        seed=seed,
+        include_group_specific=include_group_specific,
+        sample_new_groups=sample_new_groups,
+        expand=False,
+    )
+    params = ["p_any_asset", "asset_mu", "p_any_debt", "debt_mu"]
+    preds = preds.select("cell_id", *params, *(["draw_block"] if ndraw > 1 else []))
+    return summarize_cells(membership.join(preds, on="cell_id", how="inner"), by=["region", *by])
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from typing import Mapping, Optional, Sequence
+
+import polars as pl
+import polars.selectors as cs
+
+
+# keys shared by the PU (person-month core) and RW (replicate weight) files
+JOIN_KEYS = ("SSUID", "PNUM", "MONTHCODE", "SPANEL", "SWAVE")
+
+# the cache is hive-partitioned on the reference month, so month filters
+# skip whole files instead of scanning them
+PARTITION_BY = "MONTHCODE"
+
+_MANIFEST = "_source.json"
+
+# household reference person living in a regular housing unit
+REFERENCE_PERSON = pl.col("ERELRPE").is_in([1, 2]) & pl.col("TLIVQTR").is_in([1, 2])
+
+
+def _partition_target(path: str, by: str):
+    # polars renamed the partitioned-sink API between 1.x and 2.x
+    if hasattr(pl, "PartitionBy"):
+        return pl.PartitionBy(path, key=by)
+    return pl.PartitionByKey(path, by=by)
+
+
+def _source_stamp(source: str, columns: Optional[Sequence[str]], schema_overrides) -> dict:
+    st = os.stat(source)
+    return {
+        "source": os.path.abspath(source),
+        "size": st.st_size,
+        "mtime": int(st.st_mtime),
+        "columns": None if columns is None else sorted(columns),
+        "schema_overrides": None if schema_overrides is None else {
+            k: str(v) for k, v in schema_overrides.items()
+        },
+    }
+
+
+def scan_sipp_csv(
+    source: str,
+    *,
+    schema_overrides: Optional[Mapping[str, pl.DataType]] = None,
+    infer_schema_length: Optional[int] = None,
+) -> pl.LazyFrame:
+    """
+    Lazy scan of a pipe-delimited SIPP file (pu2018.csv[.gz], rw2018.csv[.gz])
+    with upper-cased column names.
+
+    infer_schema_length=None infers types from the whole file; that is slow
+    but only ever happens once, during convert_sipp.
+    """
+    return pl.scan_csv(
+        source,
+        separator="|",
+        infer_schema_length=infer_schema_length,
+        schema_overrides=schema_overrides,
+        with_column_names=lambda cols: [c.upper() for c in cols],
+    )
+
+
+def convert_sipp(
+    source: str,
+    cache_dir: str,
+    *,
+    columns: Optional[Sequence[str]] = None,
+    schema_overrides: Optional[Mapping[str, pl.DataType]] = None,
+    overwrite: bool = False,
+) -> str:
+    """
+    Convert a SIPP PU or RW file into a typed Parquet cache partitioned by
+    MONTHCODE (cache_dir/MONTHCODE=<m>/...parquet).
+
+    columns: optional projection (the join keys are always kept); None keeps
+    every column, which is what the RW replicate weights need.
+
+    Conversion is skipped when cache_dir already holds a cache built from the
+    same file (path, size, mtime) with the same columns and overrides, so it
+    is safe to call at the top of every session.
+    """
+    keep = None if columns is None else list(dict.fromkeys([*JOIN_KEYS, *(c.upper() for c in columns)]))
+    stamp = _source_stamp(source, keep, schema_overrides)
+    manifest = os.path.join(cache_dir, _MANIFEST)
+
+    if os.path.exists(manifest) and not overwrite:
+        with open(manifest) as f:
+            if json.load(f) == stamp:
+                return cache_dir
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+
+    lf = scan_sipp_csv(source, schema_overrides=schema_overrides)
+    if keep is not None:
+        lf = lf.select(keep)
+    lf.sink_parquet(_partition_target(cache_dir, PARTITION_BY), mkdir=True)
+
+    # written last: a half-finished conversion never looks valid
+    with open(manifest, "w") as f:
+        json.dump(stamp, f)
+    return cache_dir
+
+
+def scan_sipp_cache(cache_dir: str) -> pl.LazyFrame:
+    """LazyFrame over a cache written by convert_sipp (MONTHCODE from the partition path)."""
+    return pl.scan_parquet(
+        os.path.join(cache_dir, "**", "*.parquet"),
+        hive_partitioning=True,
+        hive_schema={PARTITION_BY: pl.Int64},
+    )
+
+
+def scan_sipp(
+    pu_cache: str,
+    rw_cache: str,
+    *,
+    pu_columns: Optional[Sequence[str]] = None,
+    rw_columns=None,
+    months: Optional[Sequence[int]] = None,
+) -> pl.LazyFrame:
+    """
+    The PU x RW inner join on JOIN_KEYS as one lazy query.
+
+    pu_columns: PU columns to read (None = all cached columns).
+    rw_columns: RW columns to read, as names or a selector; defaults to the
+                replicate weights (REPWGT*), the only thing used from RW.
+    months:     reference months to keep; pruned at the partition level on
+                both sides before the join.
+
+    Nothing is read until collect; downstream selects and filters push into
+    the Parquet scans (only the touched columns and row groups are read).
+    Collect with `.collect(engine="streaming")` to process a full panel in
+    bounded memory.
+
+    Notes:
+      - The cleaning features (hh_inc_yr, welfare/ss sums, class_worker) are
+        aggregates over all 12 months, so only filter to MONTHCODE == 12
+        (`months=[12]`) for queries that need the reference month alone.
+    """
+    pu = scan_sipp_cache(pu_cache)
+    rw = scan_sipp_cache(rw_cache)
+    if months is not None:
+        month_filter = pl.col(PARTITION_BY).is_in(list(months))
+        pu = pu.filter(month_filter)
+        rw = rw.filter(month_filter)
+    if pu_columns is not None:
+        pu = pu.select(list(dict.fromkeys([*JOIN_KEYS, *(c.upper() for c in pu_columns)])))
+    rw_select = cs.starts_with("REPWGT") if rw_columns is None else rw_columns
+    if isinstance(rw_select, (list, tuple)):
+        rw_select = cs.by_name([c.upper() for c in rw_select])
+    rw = rw.select(cs.by_name(list(JOIN_KEYS)) | rw_select)
+    return pu.join(rw, on=list(JOIN_KEYS), how="inner")
+
+
+def reference_persons(lf: pl.LazyFrame, month: int = 12) -> pl.LazyFrame:
+    """Household reference persons in `month` (the modelling sample filter)."""
+    return lf.filter((pl.col("MONTHCODE") == month) & REFERENCE_PERSON)
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import glob
+import os
+import re
+from dataclasses import dataclass, field
+from typing import List, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import polars as pl
+
+from survey import quantile_label
+
+
+# the quantiles of quantile_plotdata / distribution_quantile_chart
+PLOT_QUANTILES = (0.1, 0.3, 0.5, 0.7, 0.9)
+
+_DRAW = "draw_block"
+
+
+@dataclass
+class GroupQuantileSketch:
+    """
+    Mergeable weighted quantile sketches for every (group, draw block,
+    measure), filled chunk by chunk, queried for any coarser grouping.
+
+    The state is a list of small frames of weighted centroids:
+
+      <by...>, draw_block, measure, value, weight
+
+    `by` is the finest grouping that will ever be asked for (e.g. race_eth,
+    PUMA, tenure); a query for a subset of it merges the centroids of the
+    finer groups, so no query touches the rows again.
+
+    capacity:
+      - None: exact. Each chunk is reduced to its distinct values (weights
+        summed) and the chunk summaries are merged once, at the first query
+        after an update. This stays small for cell-collapsed predictions,
+        where many rows share a value.
+      - an int: KLL-style levels. A chunk summary enters level 0; two
+        summaries meeting at a level are merged and carried to the next one,
+        like a binary counter. Whenever a group has more than 2 * capacity
+        distinct values it is compacted to at most capacity + 1 equal-weight
+        buckets, which moves any of its quantiles by at most 1/capacity of
+        its weight in rank. A group's weight passes through one compaction
+        per level, so after n chunks its bound is about
+        (1 + log2(n)) / capacity, tracked per group (rank_errors).
+
+    Quantiles use survey's qrule="math" (the smallest value whose weighted
+    CDF reaches q), so with capacity=None they match the full-sample
+    estimate of ReplicateDesign.quantile on the full table.
+    """
+
+    by: Tuple[str, ...]
+    measures: Tuple[str, ...]
+    weight: Optional[str] = "WGT"
+    capacity: Optional[int] = None
+    # exact: chunk summaries; bounded: parts[level] is that level's summary or None
+    parts: List[Optional[pl.DataFrame]] = field(default_factory=list, repr=False)
+    # keys + "error": rank weight a group's answers may be off by (bounded only)
+    errors: Optional[pl.DataFrame] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        self.by = tuple(self.by)
+        self.measures = tuple(self.measures)
+        if self.capacity is not None and self.capacity < 1:
+            raise ValueError("capacity must be a positive int or None")
+
+    @property
+    def _keys(self) -> list:
+        return [*self.by, _DRAW, "measure"]
+
+    @property
+    def centroids(self) -> pl.DataFrame:
+        """Every centroid of the sketch, equal values merged."""
+        frames = [f for f in self.parts if f is not None]
+        if not frames:
+            return pl.DataFrame(schema={
+                **{c: pl.Null for c in self.by},
+                _DRAW: pl.Int32,
+                "measure": pl.String,
+                "value": pl.Float64,
+                "weight": pl.Float64,
+            })
+        merged = self._summarize(pl.concat(frames, how="vertical_relaxed"))
+        if self.capacity is None:
+            # merge the chunk summaries once; later queries start from the result
+            self.parts = [merged]
+        return merged
+
+    def rank_errors(self, by: Sequence[str] = ()) -> pl.DataFrame:
+        """
+        Rank error bound per group of `by` (a subset of the sketch's by),
+        draw block and measure, as a share of the group's weight.
+        """
+        return self._rank_errors(self.centroids, self.errors, [*by, _DRAW, "measure"])
+
+    @property
+    def rank_error(self) -> float:
+        """Largest rank error bound of any (finest) group, as a share of its weight."""
+        if self.errors is None or self.errors.height == 0:
+            return 0.0
+        return float(self.rank_errors(self.by)["rank_error"].max())
+
+    @staticmethod
+    def _rank_errors(centroids: pl.DataFrame, errors: Optional[pl.DataFrame], keys: list) -> pl.DataFrame:
+        totals = centroids.group_by(keys).agg(pl.col("weight").sum())
+        if errors is None:
+            return totals.select(*keys, pl.lit(0.0).alias("rank_error"))
+        errors = errors.group_by(keys).agg(pl.col("error").sum())
+        return (totals
+                .join(errors, on=keys, how="left", nulls_equal=True)
+                .select(*keys, (pl.col("error").fill_null(0.0) / pl.col("weight")).alias("rank_error"))
+                )
+
+    def _summarize(self, frame: pl.DataFrame) -> pl.DataFrame:
+        return (frame
+                .group_by([*self._keys, "value"])
+                .agg(pl.col("weight").sum())
+                )
+
+    def _add_errors(self, errors: pl.DataFrame) -> None:
+        if self.errors is not None:
+            errors = (pl.concat([self.errors, errors], how="vertical_relaxed")
+                      .group_by(self._keys)
+                      .agg(pl.col("error").sum())
+                      )
+        self.errors = errors
+
+    def _compact(self, frame: pl.DataFrame) -> pl.DataFrame:
+        keys = self._keys
+        n = pl.len().over(keys)
+        small = frame.filter(n <= 2 * self.capacity)
+        large = frame.filter(n > 2 * self.capacity)
+        if large.height == 0:
+            return frame
+        w = pl.col("weight")
+        self._add_errors(large.group_by(keys).agg((w.sum() / self.capacity).alias("error")))
+        large = (large
+                 .sort([*keys, "value"], nulls_last=True)
+                 .with_columns(
+                     ((w.cum_sum().over(keys) - w) / w.sum().over(keys) * self.capacity)
+                     .floor()
+                     .alias("_bucket"))
+                 .group_by([*keys, "_bucket"])
+                 .agg(((pl.col("value") * w).sum() / w.sum()).alias("value"), w.sum())
+                 .drop("_bucket"))
+        return pl.concat([small, large.select(small.columns)], how="vertical_relaxed")
+
+    def _push(self, summary: pl.DataFrame, level: int = 0) -> None:
+        # binary-counter carry: equal levels merge and move up one level
+        while level < len(self.parts) and self.parts[level] is not None:
+            summary = self._compact(self._summarize(
+                pl.concat([self.parts[level], summary], how="vertical_relaxed")))
+            self.parts[level] = None
+            level += 1
+        if level == len(self.parts):
+            self.parts.append(None)
+        self.parts[level] = summary
+
+    def update(self, chunk: pl.DataFrame, *, draw_block: Optional[int] = None) -> "GroupQuantileSketch":
+        """
+        Add a chunk of predicted rows: the `by` columns, the measures, the
+        weight and a draw_block column (or pass draw_block for the whole
+        chunk). Rows with a null measure or non-positive weight are skipped
+        for that measure.
+        """
+        if draw_block is not None:
+            chunk = chunk.with_columns(pl.lit(draw_block).alias(_DRAW))
+        elif _DRAW not in chunk.columns:
+            chunk = chunk.with_columns(pl.lit(0).alias(_DRAW))
+        w = pl.lit(1.0) if self.weight is None else pl.col(self.weight).cast(pl.Float64)
+
+        long = (chunk
+                .select([*self.by, pl.col(_DRAW).cast(pl.Int32), w.alias("weight"),
+                         *(pl.col(m).cast(pl.Float64) for m in self.measures)])
+                .unpivot(on=list(self.measures), index=[*self.by, _DRAW, "weight"],
+                         variable_name="measure", value_name="value")
+                .filter(pl.col("value").is_not_null() & (pl.col("weight") > 0))
+                .select([*self._keys, "value", "weight"]))
+
+        summary = self._summarize(long)
+        if self.capacity is None:
+            self.parts.append(summary)
+        else:
+            self._push(self._compact(summary))
+        return self
+
+    def update_draws(self, draws, extra: Optional[Mapping[str, np.ndarray]] = None) -> "GroupQuantileSketch":
+        """
+        Add every block of a draws.PredictionDraws. `extra` holds further
+        (ndraw, N) measures such as crosswalk.to_dollars' output.
+        """
+        extra = dict(extra or {})
+        columns = [*self.by, *([self.weight] if self.weight else [])]
+        for k in range(draws.ndraw):
+            block = draws.block(k, columns).with_columns(
+                pl.Series(name, values[k]) for name, values in extra.items()
+            )
+            self.update(block, draw_block=k)
+        return self
+
+    def update_sink(self, sink: str) -> "GroupQuantileSketch":
+        """Add a predict_allmodels(sink=...) dataset, one Parquet partition at a time."""
+        pattern = re.compile(rf"{_DRAW}=(\d+)")
+        for path in sorted(glob.glob(os.path.join(sink, "**", "*.parquet"), recursive=True)):
+            m = pattern.search(path)
+            block = pl.read_parquet(path)
+            self.update(block, draw_block=int(m.group(1)) if m else None)
+        return self
+
+    def merge(self, other: "GroupQuantileSketch") -> "GroupQuantileSketch":
+        """Combine two sketches built on disjoint rows (e.g. by two workers)."""
+        if (self.by, self.measures, self.capacity) != (other.by, other.measures, other.capacity):
+            raise ValueError("sketches must share by, measures and capacity")
+        out = GroupQuantileSketch(self.by, self.measures, self.weight, self.capacity,
+                                  parts=list(self.parts), errors=self.errors)
+        if other.errors is not None:
+            out._add_errors(other.errors)
+        if out.capacity is None:
+            out.parts += other.parts
+            return out
+        for level, summary in enumerate(other.parts):
+            if summary is not None:
+                out._push(summary, level)
+        return out
+
+    def quantiles(
+        self,
+        quantiles: Union[float, Sequence[float]] = PLOT_QUANTILES,
+        by: Sequence[str] = (),
+        *,
+        measures: Optional[Sequence[str]] = None,
+        per_draw: bool = False,
+        draws: Optional[Sequence[int]] = None,
+    ) -> pl.DataFrame:
+        """
+        Weighted quantiles for the grouping `by` (any subset of the sketch's
+        by), one column per quantile (q10, q30, ...).
+
+        per_draw: one row per draw block; otherwise the draw blocks selected
+                  by `draws` (default all) are pooled.
+
+        With a capacity, a rank_error column gives each row's bound (as a
+        share of its WGT).
+        """
+        unknown = set(by) - set(self.by)
+        if unknown:
+            raise ValueError(f"not in the sketch's grouping: {sorted(unknown)}")
+        qs = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+        keys = [*by, *([_DRAW] if per_draw else []), "measure"]
+
+        c, errors = self.centroids, self.errors
+        if measures is not None:
+            c = c.filter(pl.col("measure").is_in(list(measures)))
+            errors = None if errors is None else errors.filter(pl.col("measure").is_in(list(measures)))
+        if draws is not None:
+            c = c.filter(pl.col(_DRAW).is_in(list(draws)))
+            errors = None if errors is None else errors.filter(pl.col(_DRAW).is_in(list(draws)))
+
+        w = pl.col("weight")
+        # the 1e-12 slack absorbs cumsum rounding at exact boundaries
+        reached = [
+            pl.col("value").filter(pl.col("_cum") >= q * pl.col("_total") * (1 - 1e-12)).first()
+            .alias(quantile_label(q))
+            for q in qs
+        ]
+        out = (c
+               .group_by([*keys, "value"])
+               .agg(w.sum())
+               .sort([*keys, "value"], nulls_last=True)
+               .with_columns(w.cum_sum().over(keys).alias("_cum"), w.sum().over(keys).alias("_total"))
+               .group_by(keys, maintain_order=True)
+               .agg(w.sum().alias("WGT"), *reached)
+               .sort(keys, nulls_last=True))
+        if self.capacity is None:
+            return out
+        return out.join(self._rank_errors(c, errors, keys), on=keys, how="left",
+                        nulls_equal=True, maintain_order="left")
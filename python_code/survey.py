@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import polars as pl
+
+
+# the 240 SIPP replicate weights (REPWGT0 is a copy of the full-sample weight)
+REPLICATE_PATTERN = r"^REPWGT[1-9][0-9]*$"
+
+
+def group_codes(data: pl.DataFrame, by: Sequence[str]) -> Tuple[np.ndarray, pl.DataFrame]:
+    """
+    Dense group code per row of `data` (groups of `by` in sorted key order,
+    nulls a group of their own) and the key table in code order. No `by`
+    puts every row in group 0 with an empty key table.
+    """
+    if not by:
+        return np.zeros(data.height, dtype=np.int64), pl.DataFrame()
+    codes = data.select(
+        (pl.struct(list(by)).rank("dense") - 1).cast(pl.Int64).alias("_g")
+    )["_g"].to_numpy()
+    keys = (data.select(list(by))
+            .with_columns(pl.Series("_g", codes))
+            .unique("_g")
+            .sort("_g")
+            .drop("_g"))
+    return codes, keys
+
+
+def quantile_label(q: float) -> str:
+    """Column label of quantile q, srvyr style: .99 -> "q99", .5 -> "q50", .125 -> "q12.5"."""
+    pct = q * 100
+    return f"q{int(round(pct))}" if abs(pct - round(pct)) < 1e-9 else f"q{pct:g}"
+
+
+@dataclass
+class ReplicateDesign:
+    """
+    BRR replicate-weight design (srvyr::as_survey_rep(type = "BRR")) held as
+    one (N, 1 + R) float32 weight matrix: column 0 the full-sample weight,
+    then the R replicates.
+
+    Every statistic is computed for all 1 + R weight columns at once: totals
+    are one segmented sum of the weight matrix, quantiles one sort per group
+    plus a cumulative-weight search per column.
+
+      estimate = statistic under the full-sample weight
+      se       = sqrt(scale * sum_r (theta_r - center)^2)
+      scale    = 1 / (R * (1 - rho)^2)      (rho > 0: Fay's BRR)
+      center   = mean_r theta_r, or the full-sample estimate with mse=True
+
+    which is survey::svrepdesign's BRR variance with its default mse=FALSE.
+
+    Notes:
+      - Build it from the rows being analysed (filter first); the matrix is
+        4 * (1 + R) bytes per row.
+      - Rows with a null in the analysed column are dropped for that
+        statistic (na.rm = TRUE).
+    """
+
+    data: pl.DataFrame
+    weights: np.ndarray
+    scale: float
+    mse: bool = False
+
+    @classmethod
+    def from_frame(
+        cls,
+        data: Union[pl.DataFrame, pl.LazyFrame],
+        *,
+        weight: str = "WPFINWGT",
+        replicates: Optional[Sequence[str]] = None,
+        columns: Optional[Sequence[str]] = None,
+        rho: float = 0.0,
+        mse: bool = False,
+    ) -> "ReplicateDesign":
+        """
+        replicates: replicate weight columns, default every REPWGT1..REPWGTn.
+                    The cleaning notebook's srvyr call used REPWGT0:REPWGT240;
+                    pass those names to reproduce it exactly.
+        columns:    analysis columns to keep (default: all non-weight columns).
+        """
+        names = data.collect_schema().names() if isinstance(data, pl.LazyFrame) else data.columns
+        if replicates is None:
+            replicates = sorted((c for c in names if re.match(REPLICATE_PATTERN, c)),
+                                key=lambda c: int(c[len("REPWGT"):]))
+        replicates = list(replicates)
+        if not replicates:
+            raise ValueError("no replicate weight columns found")
+        if not 0 <= rho < 1:
+            raise ValueError("rho must be in [0, 1)")
+
+        weight_cols = [weight, *replicates]
+        if columns is None:
+            columns = [c for c in names if c not in weight_cols]
+        frame = data.select([*columns, *weight_cols])
+        if isinstance(frame, pl.LazyFrame):
+            frame = frame.collect()
+
+        W = frame.select(pl.col(weight_cols).cast(pl.Float32)).to_numpy(order="c")
+        return cls(
+            data=frame.select(columns),
+            weights=W,
+            scale=1.0 / (len(replicates) * (1.0 - rho) ** 2),
+            mse=mse,
+        )
+
+    @property
+    def n_replicates(self) -> int:
+        return self.weights.shape[1] - 1
+
+    def filter(self, predicate: pl.Expr) -> "ReplicateDesign":
+        """Subset rows (domain estimation; identical to svrepdesign subset)."""
+        keep = self.data.select(predicate.fill_null(False))[:, 0].to_numpy()
+        return ReplicateDesign(self.data.filter(pl.Series(keep)), self.weights[keep], self.scale, self.mse)
+
+    def _se(self, thetas: np.ndarray) -> np.ndarray:
+        """thetas: (..., 1 + R) -> BRR standard error over the last axis."""
+        reps = thetas[..., 1:]
+        center = thetas[..., :1] if self.mse else reps.mean(axis=-1, keepdims=True)
+        return np.sqrt(self.scale * ((reps - center) ** 2).sum(axis=-1))
+
+    def _grouped_sums(self, values: np.ndarray, codes: np.ndarray, n_groups: int) -> np.ndarray:
+        """(G, 1 + R) float64 sums of values[:, None] * W per group."""
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        starts = np.searchsorted(sorted_codes, np.arange(n_groups))
+        weighted = self.weights[order].astype(np.float64) * values[order, None]
+        out = np.zeros((n_groups, self.weights.shape[1]))
+        present = np.unique(sorted_codes)
+        if present.size:
+            out[present] = np.add.reduceat(weighted, starts[present], axis=0)
+        return out
+
+    def _frame(self, keys: pl.DataFrame, by: Sequence[str], cols: dict) -> pl.DataFrame:
+        out = pl.DataFrame(cols)
+        return pl.concat([keys, out], how="horizontal") if by else out
+
+    def total(self, columns: Union[str, Sequence[str]], by: Sequence[str] = ()) -> pl.DataFrame:
+        """Weighted totals with BRR SEs: <col>, <col>_se per group of `by`."""
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        codes, keys = group_codes(self.data, by)
+        G = int(codes.max()) + 1 if codes.size else 1
+        cols = {}
+        for col in columns:
+            s = self.data[col].cast(pl.Float64)
+            values = s.fill_null(0.0).to_numpy()
+            t = self._grouped_sums(values, codes, G)
+            cols[col] = t[:, 0]
+            cols[f"{col}_se"] = self._se(t)
+        return self._frame(keys, by, cols)
+
+    def mean(self, columns: Union[str, Sequence[str]], by: Sequence[str] = ()) -> pl.DataFrame:
+        """
+        Weighted means (ratio of totals) with BRR SEs: <col>, <col>_se.
+        For proportions pass a 0/1 column, e.g.
+        survey_mean(hh_any_asset == 1) is mean("hh_any_asset").
+        """
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        codes, keys = group_codes(self.data, by)
+        G = int(codes.max()) + 1 if codes.size else 1
+        cols = {}
+        for col in columns:
+            s = self.data[col].cast(pl.Float64)
+            valid = (~s.is_null()).cast(pl.Float64).to_numpy()
+            num = self._grouped_sums(s.fill_null(0.0).to_numpy(), codes, G)
+            den = self._grouped_sums(valid, codes, G)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                m = num / den
+            cols[col] = m[:, 0]
+            cols[f"{col}_se"] = self._se(m)
+        return self._frame(keys, by, cols)
+
+    def quantile(
+        self,
+        column: str,
+        quantiles: Union[float, Sequence[float]],
+        by: Sequence[str] = (),
+    ) -> pl.DataFrame:
+        """
+        Weighted quantiles with BRR SEs: <col>_q<pct>, <col>_q<pct>_se.
+
+        Each weight column uses survey's default qrule="math": the smallest
+        value whose weighted CDF reaches q. The SE is the BRR spread of the
+        replicate quantiles (svyquantile's interval.type = "quantile").
+        """
+        qs = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+        if np.any((qs < 0) | (qs > 1)):
+            raise ValueError("quantiles must be in [0, 1]")
+
+        s = self.data[column].cast(pl.Float64)
+        valid = ~s.is_null().to_numpy()
+        codes, keys = group_codes(self.data, by)
+        G = int(codes.max()) + 1 if codes.size else 1
+
+        x = s.to_numpy()[valid]
+        W = self.weights[valid]
+        g = codes[valid]
+        order = np.lexsort((x, g))
+        x, W, g = x[order], W[order], g[order]
+        bounds = np.searchsorted(g, np.arange(G + 1))
+
+        K = W.shape[1]
+        est = np.full((G, len(qs), K), np.nan)
+        for j in range(G):
+            lo, hi = bounds[j], bounds[j + 1]
+            if hi == lo:
+                continue
+            cum = np.cumsum(W[lo:hi], axis=0, dtype=np.float64)  # (n_j, K)
+            total = cum[-1]
+            for i, q in enumerate(qs):
+                # first row whose cumulative weight reaches q * total, per column
+                # (the 1e-12 slack absorbs cumsum rounding at exact boundaries)
+                idx = (cum < q * total[None, :] * (1 - 1e-12)).sum(axis=0)
+                est[j, i] = x[lo:hi][np.minimum(idx, hi - lo - 1)]
+
+        cols = {}
+        for i, q in enumerate(qs):
+            name = f"{column}_{quantile_label(q)}"
+            cols[name] = est[:, i, 0]
+            cols[f"{name}_se"] = self._se(est[:, i, :])
+        return self._frame(keys, by, cols)
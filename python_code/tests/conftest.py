@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules are flat files in python_code/, imported by name as the notebooks do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,49 @@
+import gzip
+
+import polars as pl
+import pytest
+
+from fixed_width import Variable, iter_fixed_width
+
+
+LAYOUT = [Variable("STATEFIP", 0, 2), Variable("INCTOT", 2, 5), Variable("NAME", 7, 3, numeric=False)]
+RECORDS = [b"22  150abc", b"22-0042xyz", b"01     foo"]
+
+
+def write(tmp_path, data: bytes, gz: bool) -> str:
+    path = tmp_path / ("x.dat.gz" if gz else "x.dat")
+    if gz:
+        with gzip.open(path, "wb") as f:
+            f.write(data)
+    else:
+        path.write_bytes(data)
+    return str(path)
+
+
+def read(path, **kwargs):
+    return pl.concat(list(iter_fixed_width(path, LAYOUT, **kwargs)))
+
+
+@pytest.mark.parametrize("gz", [False, True])
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+@pytest.mark.parametrize("final_newline", [True, False])
+def test_reads_every_record(tmp_path, gz, newline, final_newline):
+    data = newline.join(RECORDS) + (newline if final_newline else b"")
+    frame = read(write(tmp_path, data, gz), batch_rows=2)
+    assert frame["STATEFIP"].to_list() == [22, 22, 1]
+    assert frame["INCTOT"].to_list() == [150, -42, None]
+    assert frame["NAME"].to_list() == ["abc", "xyz", "foo"]
+
+
+@pytest.mark.parametrize("gz", [False, True])
+def test_truncated_last_record_raises(tmp_path, gz):
+    path = write(tmp_path, b"\n".join(RECORDS) + b"\n22 1", gz)
+    with pytest.raises(ValueError, match="truncated last record"):
+        read(path)
+
+
+@pytest.mark.parametrize("field", [b"  1x0", b" 1 20", b"1-200", b"    -"])
+def test_malformed_numeric_field_raises(tmp_path, field):
+    path = write(tmp_path, b"22" + field + b"abc\n", False)
+    with pytest.raises(ValueError, match="INCTOT: malformed numeric field"):
+        read(path)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+
+from impute import GowerDesign, gower_distance, knn_impute
+
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+FIXTURE = os.path.join(DATA, "knn_fixture.csv")
+VIM_OUTPUT = os.path.join(DATA, "knn_vim.csv")  # written by data/make_vim_knn.R
+IMPUTED = ["x1", "tenure"]
+CATEGORICAL = {"grp", "tenure"}
+
+
+def fixture() -> pl.DataFrame:
+    return pl.read_csv(FIXTURE)
+
+
+def brute_gower(data: pl.DataFrame, i: int, j: int, columns) -> float:
+    """VIM::gowerD for one pair, column by column."""
+    num = den = 0.0
+    for col in columns:
+        a, b = data[col][i], data[col][j]
+        if a is None or b is None:
+            continue
+        if col in CATEGORICAL:
+            d = float(a != b)
+        else:
+            present = data[col].drop_nulls()
+            span = present.max() - present.min()
+            d = abs(a - b) / span if span else 0.0
+        num += d
+        den += 1.0
+    return num / den if den else np.inf
+
+
+def brute_knn(data: pl.DataFrame, variables, k: int) -> pl.DataFrame:
+    """Reference kNN: sort every donor by (distance, row), median or mode of the first k."""
+    out = data
+    for var in variables:
+        columns = [c for c in data.columns if c != var]
+        values = out[var].to_list()
+        donors = [j for j, v in enumerate(values) if v is not None]
+        filled = list(values)
+        for i, v in enumerate(values):
+            if v is not None:
+                continue
+            ranked = sorted(donors, key=lambda j: (brute_gower(out, i, j, columns), j))[:k]
+            picked = [values[j] for j in ranked]
+            if var in CATEGORICAL:
+                counts = {level: picked.count(level) for level in picked}
+                top = max(counts.values())
+                modes = sorted(level for level, c in counts.items() if c == top)
+                assert len(modes) == 1, "fixture should not have tied modes"
+                filled[i] = modes[0]
+            else:
+                filled[i] = float(np.median(picked))
+        out = out.with_columns(pl.Series(var, filled, dtype=out[var].dtype if var in CATEGORICAL else pl.Float64))
+    return out
+
+
+def test_gower_distance_matches_pairwise_reference():
+    data = fixture()
+    columns = [c for c in data.columns if c != "x1"]
+    design = GowerDesign.build(data, columns, [1.0] * len(columns))
+    rows = np.arange(data.height)
+    got = gower_distance(design, rows[:15], rows)
+    expected = np.array([[brute_gower(data, i, j, columns) for j in range(data.height)] for i in range(15)])
+    np.testing.assert_allclose(got, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("block_size", [None, 3])
+def test_knn_impute_matches_brute_force(block_size):
+    data = fixture()
+    ours = knn_impute(data, IMPUTED, k=5, imp_var=False, block_size=block_size, seed=1)
+    ref = brute_knn(data, IMPUTED, k=5)
+    np.testing.assert_allclose(ours["x1"].to_numpy(), ref["x1"].to_numpy())
+    assert ours["tenure"].to_list() == ref["tenure"].to_list()
+
+
+@pytest.mark.skipif(not os.path.exists(VIM_OUTPUT), reason="run tests/data/make_vim_knn.R to write knn_vim.csv")
+def test_knn_impute_matches_vim():
+    data = fixture()
+    ours = knn_impute(data, IMPUTED, k=5, imp_var=False)
+    vim = pl.read_csv(VIM_OUTPUT)
+    np.testing.assert_allclose(ours["x1"].to_numpy(), vim["x1"].cast(pl.Float64).to_numpy())
+    assert ours["tenure"].to_list() == vim["tenure"].to_list()
@@ -0,0 +1,256 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+import requests
+
+import ipums
+
+
+class FileServer:
+    """Local stand-in for the IPUMS download host: Range, HEAD and dropped connections."""
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.drop = {}  # name -> bytes to send before closing the connection (once)
+        self.refuse = set()  # names answered 416 whatever the request
+        self.hits = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self._serve(head=True)
+
+            def do_GET(self):
+                self._serve(head=False)
+
+            def _serve(self, head):
+                name = self.path.strip("/")
+                rng = self.headers.get("Range")
+                server.hits.append((self.command, name, rng))
+                body = server.files[name]
+                start = 0
+                if name in server.refuse:
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                if rng:
+                    start = int(re.match(r"bytes=(\d+)-", rng).group(1))
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(body)}")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(body) - start))
+                self.end_headers()
+                if head:
+                    return
+                cut = server.drop.pop(name, None)
+                if cut is not None:
+                    self.wfile.write(body[start:start + cut])
+                    self.wfile.flush()
+                    self.connection.close()
+                    return
+                self.wfile.write(body[start:])
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def url(self, name):
+        return f"{self.base}/{name}"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv("IPUMS_API_KEY", "test-key")
+    monkeypatch.setattr(ipums.time, "sleep", lambda s: None)
+    srv = FileServer({"a.dat": os.urandom(3_000_000), "b.xml": os.urandom(50_000)})
+    yield srv
+    srv.httpd.shutdown()
+
+
+def test_resumes_after_dropped_connection(server, tmp_path):
+    server.drop["a.dat"] = 1_000_000
+    data = server.files["a.dat"]
+    dest = ipums.download_file(server.url("a.dat"), tmp_path / "a.dat", chunk_size=2 ** 16,
+                               expected_sha256=hashlib.sha256(data).hexdigest())
+    assert dest.read_bytes() == data
+    # every whole chunk received before the drop was kept
+    assert [rng for _, _, rng in server.hits] == [None, f"bytes={1_000_000 // 2 ** 16 * 2 ** 16}-"]
+    assert not (tmp_path / "a.dat.part").exists()
+
+
+def test_complete_partial_file_is_accepted_on_416(server, tmp_path):
+    (tmp_path / "b.xml.part").write_bytes(server.files["b.xml"])
+    dest = ipums.download_file(server.url("b.xml"), tmp_path / "b.xml")
+    assert dest.read_bytes() == server.files["b.xml"]
+
+
+def test_overlong_partial_file_is_fetched_again(server, tmp_path):
+    (tmp_path / "b.xml.part").write_bytes(server.files["b.xml"] + b"stale")
+    dest = ipums.download_file(server.url("b.xml"), tmp_path / "b.xml")
+    assert dest.read_bytes() == server.files["b.xml"]
+    assert [rng for _, _, rng in server.hits] == ["bytes=50005-", None]
+
+
+def test_416_without_partial_file_is_an_error(server, tmp_path):
+    server.refuse.add("b.xml")
+    # no bytes on disk: a 416 cannot mean "already complete"
+    with pytest.raises(requests.HTTPError):
+        ipums.download_file(server.url("b.xml"), tmp_path / "b.xml")
+
+
+def test_size_and_checksum_mismatch(server, tmp_path):
+    with pytest.raises(IOError, match="expected 10"):
+        ipums.download_file(server.url("b.xml"), tmp_path / "b.xml", expected_bytes=10)
+    assert not (tmp_path / "b.xml").exists()
+    with pytest.raises(IOError, match="sha256"):
+        ipums.download_file(server.url("b.xml"), tmp_path / "c.xml", expected_sha256="0" * 64)
+    assert not (tmp_path / "c.xml.part").exists()
+
+
+def test_download_extract_caches_finished_files(server, tmp_path):
+    links = {
+        "data": {"url": server.url("a.dat"), "bytes": 3_000_000,
+                 "sha256": hashlib.sha256(server.files["a.dat"]).hexdigest()},
+        "ddi": {"url": server.url("b.xml")},
+    }
+    paths = ipums.download_extract(7, links, out_dir=tmp_path)
+    assert paths["data"].read_bytes() == server.files["a.dat"]
+    assert paths["ddi"].read_bytes() == server.files["b.xml"]
+
+    server.hits.clear()
+    assert ipums.download_extract(7, links, out_dir=tmp_path) == paths
+    assert server.hits == []
+
+
+class MockApi:
+    """Local mock of the IPUMS v1 extract API: submit, status polls, file links."""
+
+    def __init__(self, polls_until_done, fail=()):
+        self.polls_until_done = dict(polls_until_done)  # description -> polls before "completed"
+        self.fail = set(fail)  # descriptions that end "failed"
+        self.extracts = {}  # number -> [description, polls so far]
+        self.events = []
+        self.lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _json(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                assert self.headers["Authorization"] == "test-key"
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with api.lock:
+                    number = len(api.extracts) + 1
+                    api.extracts[number] = [payload["description"], 0]
+                    api.events.append(("submit", payload["description"]))
+                self._json({"number": number})
+
+            def do_GET(self):
+                assert self.headers["Authorization"] == "test-key"
+                path = urlparse(self.path).path
+                if path.startswith("/files/"):
+                    body = path.encode()
+                    with api.lock:
+                        api.events.append(("download", path))
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                number = int(path.rsplit("/", 1)[1])
+                with api.lock:
+                    entry = api.extracts[number]
+                    entry[1] += 1
+                    desc, polls = entry
+                    if desc in api.fail:
+                        status = "failed"
+                    elif polls >= api.polls_until_done[desc]:
+                        status = "completed"
+                    else:
+                        status = "started"
+                    api.events.append((status, desc))
+                body = {"number": number, "status": status}
+                if status == "completed":
+                    body["download_links"] = {"data": {"url": f"{api.base}/files/{desc}.dat"}}
+                self._json(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.httpd.server_port}"
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    monkeypatch.setenv("IPUMS_API_KEY", "test-key")
+    apis = []
+
+    def make(polls_until_done, fail=()):
+        apis.append(MockApi(polls_until_done, fail))
+        return apis[-1]
+
+    yield make
+    for api in apis:
+        api.httpd.shutdown()
+
+
+def _run(api, payloads, out_dir):
+    return asyncio.run(ipums.run_extracts(payloads, out_dir=out_dir, base=api.base,
+                                          initial=0.01, max_delay=0.02))
+
+
+def test_run_extracts_downloads_each_extract_as_it_completes(mock_api, tmp_path):
+    api = mock_api({"fast": 1, "slow": 8})
+    payloads = [ipums.extract_payload(["us2022a"], ["AGE"], description="slow"),
+                ipums.extract_payload(["us2021a"], ["AGE"], description="fast")]
+    results = _run(api, payloads, tmp_path)
+
+    assert sorted(num for num, _ in results) == [1, 2]
+    assert results[1][1]["data"].read_bytes() == b"/files/fast.dat"
+    assert results[0][1]["data"].read_bytes() == b"/files/slow.dat"
+    # the fast extract is fetched while the slow one is still being polled
+    assert api.events.index(("download", "/files/fast.dat")) < api.events.index(("completed", "slow"))
+
+    # a rerun reuses both extracts: no new submission and no file is fetched again
+    api.events.clear()
+    assert _run(api, payloads, tmp_path) == results
+    assert [e for e in api.events if e[0] in ("submit", "download")] == []
+
+
+def test_failed_extract_is_reported_and_resubmitted(mock_api, tmp_path):
+    api = mock_api({"ok": 1}, fail={"bad"})
+    payloads = [ipums.extract_payload(["us2022a"], ["AGE"], description="ok"),
+                ipums.extract_payload(["us2022a"], ["SEX"], description="bad")]
+    with pytest.raises(RuntimeError, match="1 of 2 extracts failed"):
+        _run(api, payloads, tmp_path)
+    # the other extract still finished and downloaded
+    assert len(list(tmp_path.glob("usa_*/ok.dat"))) == 1
+
+    with pytest.raises(RuntimeError):
+        _run(api, payloads, tmp_path)
+    submits = [e[1] for e in api.events if e[0] == "submit"]
+    assert sorted(submits) == ["bad", "bad", "ok"] and submits[-1] == "bad"